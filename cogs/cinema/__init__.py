@@ -1,9 +1,10 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from run import Sphynx
 from .cog import CinemaCog
-from .models import TmdbClient
+from .models import TmdbClient, ImdbIndex
 
 _log = logging.getLogger(__name__)
 
@@ -15,7 +16,15 @@ async def setup(bot: Sphynx):
     except KeyError:
         _log.warning(f'"{env_var}" environment variable not set: Cinema cog will not be available.')
         return
-    tmdb_client = TmdbClient(tmdb_api_key)
+    # Large payload hydration and page rendering can be moved off the event loop, see `TmdbClient.run_cpu_bound`
+    executors = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+    executor_type = os.environ.get('SPHYNX_TMDB_EXECUTOR')
+    executor = executors[executor_type](max_workers=2) if executor_type in executors else None
+    streaming = os.environ.get('SPHYNX_TMDB_STREAMING', '1') != '0'
+    imdb_index = ImdbIndex()
+    await imdb_index.load()
+    _log.info(f'Loaded {len(imdb_index)} IMDb id mappings.')
+    tmdb_client = TmdbClient(tmdb_api_key, streaming=streaming, executor=executor, imdb_index=imdb_index)
     await tmdb_client.update_configuration()
     _log.info('Retrieved configuration from TMDB.')
     await bot.add_cog(CinemaCog(bot, tmdb_client))
@@ -0,0 +1,240 @@
+import array
+import asyncio
+import collections
+import datetime as dt
+import functools
+import heapq
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class CacheEntry:
+    __slots__ = ('value', 'stored_at')
+
+    def __init__(self, value: Any, stored_at: dt.datetime):
+        self.value = value
+        self.stored_at = stored_at
+
+
+class FrequencySketch:
+    """Count-min sketch estimating how often keys were seen recently.
+
+    Every `sample_size` increments all counters are halved, so that popularity from long ago fades away.
+    """
+    _seeds = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+    _max_count = 0xFFFF
+
+    def __init__(self, width: int, sample_size: int):
+        self.width = 1 << max(width - 1, 1).bit_length()  # Power of two, so that indexes are just masked hashes
+        self.sample_size = sample_size
+        self.additions = 0
+        self._rows = [array.array('H', bytes(2 * self.width)) for _ in self._seeds]
+
+    def _indexes(self, key: Hashable) -> list[int]:
+        h = hash(key)
+        mask = self.width - 1
+        return [(((h * seed) & 0xFFFFFFFFFFFFFFFF) >> 32) & mask for seed in self._seeds]
+
+    def increment(self, key: Hashable) -> int:
+        """Records an occurrence of the key and returns its new estimated frequency."""
+        estimate = self._max_count
+        for row, idx in zip(self._rows, self._indexes(key)):
+            count = row[idx]
+            if count < self._max_count:
+                count += 1
+                row[idx] = count
+            if count < estimate:
+                estimate = count
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+        return estimate
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[idx] for row, idx in zip(self._rows, self._indexes(key)))
+
+    def _age(self) -> None:
+        for i, row in enumerate(self._rows):
+            self._rows[i] = array.array('H', (count >> 1 for count in row))
+        self.additions //= 2
+
+    def memory(self) -> int:
+        """Returns the amount of bytes taken up by the counters."""
+        return sum(row.itemsize * len(row) for row in self._rows)
+
+
+class TmdbCache:
+    """Cache of hydrated TMDB entities.
+
+    Keys are tuples starting with the media type and the id of the entity (e.g. ``('tv', 1396, 2)`` for a season), so
+    that everything belonging to an entity can be evicted at once when TMDB reports it as changed.
+
+    Entries are considered fresh for `ttl`. While the change feeds are polled regularly (see `TmdbClient.sync_changes`),
+    entries stored within the period covered by the feeds stay fresh for `feed_ttl` instead, as any change to them would
+    have been reported and evicted. The feeds count as polled regularly if the last successful poll is no older than
+    `feed_grace`, which must exceed the interval between polls (hourly in `CinemaCog`) so that a poll running a bit late
+    doesn't expire the whole cache at once.
+
+    Admission and eviction follow W-TinyLFU: new entries land in a small LRU window. Once pushed out of it, an entry
+    only gets into the main LRU segment if it's been requested more often than the entry it would replace, according to
+    a frequency sketch of recent requests. This keeps popular titles cached through bursts of one-off lookups.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 512,
+            ttl: dt.timedelta = dt.timedelta(hours=1),
+            feed_ttl: dt.timedelta = dt.timedelta(days=7),
+            feed_grace: dt.timedelta = dt.timedelta(hours=2),
+            window_ratio: float = 0.01,
+            heavy_hitter_count: int = 10,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.feed_ttl = feed_ttl
+        self.feed_grace = feed_grace
+        self.feed_synced_at: dt.datetime | None = None
+        self.feed_covered_since: dt.datetime | None = None
+        self.window_size = max(1, int(maxsize * window_ratio))
+        self.sketch = FrequencySketch(width=4 * maxsize, sample_size=10 * maxsize)
+        self.heavy_hitter_count = heavy_hitter_count
+        self._heavy_hitters: dict[tuple, int] = {}
+        self._heavy_hitter_floor = 0
+        self._window: collections.OrderedDict[tuple, CacheEntry] = collections.OrderedDict()
+        self._main: collections.OrderedDict[tuple, CacheEntry] = collections.OrderedDict()
+        self._pending: dict[tuple, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._window) + len(self._main)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._window or key in self._main
+
+    def _segment(self, key: tuple) -> collections.OrderedDict | None:
+        if key in self._window:
+            return self._window
+        if key in self._main:
+            return self._main
+        return None
+
+    def _record_access(self, key: tuple) -> None:
+        frequency = self.sketch.increment(key)
+        top = self._heavy_hitters
+        if key in top or len(top) < self.heavy_hitter_count:
+            top[key] = frequency
+        elif frequency > self._heavy_hitter_floor:
+            del top[min(top, key=top.get)]
+            top[key] = frequency
+        else:
+            return
+        self._heavy_hitter_floor = min(top.values())
+
+    def heavy_hitters(self, count: int | None = None) -> list[tuple[tuple, int]]:
+        """Returns keys requested most often recently, with their estimated frequencies, most frequent first."""
+        ranked = [(key, self.sketch.estimate(key)) for key in self._heavy_hitters]
+        return heapq.nlargest(count or self.heavy_hitter_count, ranked, key=lambda x: x[1])
+
+    @staticmethod
+    def _now() -> dt.datetime:
+        return dt.datetime.now(dt.timezone.utc)
+
+    def _is_fresh(self, entry: CacheEntry, now: dt.datetime) -> bool:
+        age = now - entry.stored_at
+        if age < self.ttl:
+            return True
+        return (
+                self.feed_synced_at is not None
+                and now - self.feed_synced_at < self.feed_grace
+                and entry.stored_at >= self.feed_covered_since
+                and age < self.feed_ttl
+        )
+
+    def get(self, key: tuple) -> Any | None:
+        """Returns the cached value, or None if there's no fresh entry for the key."""
+        self._record_access(key)
+        segment = self._segment(key)
+        if segment is None:
+            return None
+        entry = segment[key]
+        if not self._is_fresh(entry, self._now()):
+            del segment[key]
+            return None
+        segment.move_to_end(key)
+        return entry.value
+
+    def put(self, key: tuple, value: Any, stored_at: dt.datetime | None = None) -> None:
+        entry = CacheEntry(value, stored_at or self._now())
+        if segment := self._segment(key):
+            segment[key] = entry
+            segment.move_to_end(key)
+            return
+        self._window[key] = entry
+        if len(self._window) > self.window_size:
+            candidate_key, candidate = self._window.popitem(last=False)
+            self._admit(candidate_key, candidate)
+
+    def _admit(self, key: tuple, entry: CacheEntry) -> None:
+        """Moves an entry pushed out of the window into the main segment if it's worth more than the one it replaces."""
+        if len(self._main) >= self.maxsize - self.window_size:
+            victim_key = next(iter(self._main))
+            if self.sketch.estimate(key) <= self.sketch.estimate(victim_key):
+                return
+            del self._main[victim_key]
+        self._main[key] = entry
+
+    async def get_or_fetch(self, key: tuple, fetch: Callable[[], Awaitable]) -> Any:
+        """Returns the cached value, fetching it if necessary. Concurrent fetches of the same key are merged."""
+        if (value := self.get(key)) is not None:
+            return value
+        if not (future := self._pending.get(key)):
+            future = asyncio.ensure_future(fetch())
+            self._pending[key] = future
+            future.add_done_callback(functools.partial(self._fetched, key, self._now()))
+        # Shielded, so that one of the waiting interactions going away doesn't cancel the fetch for everyone else
+        return await asyncio.shield(future)
+
+    def _fetched(self, key: tuple, started_at: dt.datetime, future: asyncio.Future) -> None:
+        failed = future.cancelled() or future.exception() is not None
+        # If the entity was evicted while being fetched, the result may predate the change and is not stored
+        if self._pending.get(key) is not future:
+            return
+        del self._pending[key]
+        if not failed:
+            self.put(key, future.result(), stored_at=started_at)
+
+    def evict(self, media_type: str, ids: set[int]) -> int:
+        """Removes every entry belonging to the given entities. Returns the amount of removed entries."""
+        stale = 0
+        for segment in (self._window, self._main):
+            for key in [key for key in segment if key[0] == media_type and key[1] in ids]:
+                del segment[key]
+                stale += 1
+        for key in [key for key in self._pending if key[0] == media_type and key[1] in ids]:
+            del self._pending[key]
+        return stale
+
+    def mark_synced(self, window_start: dt.datetime, window_end: dt.datetime) -> None:
+        """Records a successful poll of all change feeds for the given time window."""
+        if self.feed_covered_since is None or self.feed_synced_at is None or window_start > self.feed_synced_at:
+            # First poll, or some time went unreported: only entries stored since the window start are covered
+            self.feed_covered_since = window_start
+        self.feed_synced_at = window_end
+
+    def clear(self) -> None:
+        self._window.clear()
+        self._main.clear()
+        self._pending.clear()
+
+
+def cached_entity(key_func: Callable[..., tuple]):
+    """Caches results of a `TmdbClient` coroutine method in the client's cache, under the key built by `key_func` from
+    the method's arguments."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args):
+            return await self.cache.get_or_fetch(key_func(*args), functools.partial(func, self, *args))
+
+        return wrapper
+
+    return decorator
+
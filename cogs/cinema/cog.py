@@ -1,102 +1,179 @@
+import logging
+from typing import Any, Awaitable, Callable
+
 import discord
 from discord import app_commands
 from discord.app_commands import Choice
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from run import Sphynx
-from .helpers import deduplicate_autocomplete_labels, prepare_production_autocomplete_choices, CinemaEntity
-from .models import TmdbClient, TmdbApiException
+from utils.admission import admission_controlled
+from utils.interactions import AutoDefer
+from .helpers import deduplicate_autocomplete_labels, prepare_production_autocomplete_choices, CinemaEntity, \
+    parse_imdb_id, cinema_admission
+from .models import TmdbClient, TmdbApiException, ExternalMapping
 from .views import PersonView, MovieView, TvView, PersonPaginatingView, ProductionPaginatingView
 
+_log = logging.getLogger(__name__)
+
 
 class CinemaCog(commands.GroupCog, group_name='cinema'):
     def __init__(self, bot: Sphynx, tmdb_client: TmdbClient):
         self.bot = bot
         self.tmdb_client = tmdb_client
+        self.poll_changes.start()
+
+    async def cog_unload(self):
+        self.poll_changes.cancel()
+        self.tmdb_client.close()
+
+    @tasks.loop(hours=1)
+    async def poll_changes(self):
+        """Evicts cached entities reported as changed by TMDB. Unchanged ones can be kept much longer this way."""
+        try:
+            evicted = await self.tmdb_client.sync_changes()
+            _log.debug(f'Synced TMDB change feeds, evicted cache entries: {evicted}.')
+            heavy_hitters = ', '.join(f'{media_type}/{tmdb_id} ({count})'
+                                      for (media_type, tmdb_id, *_), count in self.tmdb_client.cache.heavy_hitters())
+            _log.info(f'Most requested TMDB entities: {heavy_hitters or "-"}.')
+        except Exception:
+            # The loop would stop for good otherwise, as it's only restarted after network errors. Stale entries would
+            # then stay cached until their TTL runs out.
+            _log.exception('Failed to poll TMDB change feeds, retrying on the next poll.')
+
+    async def _find_imdb_id(self, imdb_id: str, media_type: str) -> ExternalMapping | None:
+        """Resolves an IMDb id into a TMDB entity, if it points to the right kind of entity."""
+        try:
+            mapping = await self.tmdb_client.find_imdb_id(imdb_id)
+        except TmdbApiException:
+            return None
+        if mapping is None or mapping.media_type != media_type:
+            return None
+        return mapping
+
+    async def _imdb_autocomplete(self, imdb_id: str, media_type: str) -> list[Choice[str]]:
+        """Resolves a pasted IMDb id or link into a single choice."""
+        if mapping := await self._find_imdb_id(imdb_id, media_type):
+            return [app_commands.Choice(name=mapping.label, value=str(mapping.tmdb_id))]
+        return []
+
+    async def _resolve_tmdb_id(self, value: str, media_type: str) -> int | None:
+        """Turns the value of a lookup option into a TMDB id.
+
+        The value is a TMDB id when picked from autocomplete, but may also be an IMDb id or link submitted without
+        waiting for the suggestions.
+        """
+        if value.isdigit():
+            return int(value)
+        if imdb_id := parse_imdb_id(value):
+            if mapping := await self._find_imdb_id(imdb_id, media_type):
+                return mapping.tmdb_id
+        return None
+
+    async def _lookup(self, getter: Callable[[int], Awaitable[Any]], value: str, media_type: str) -> Any | None:
+        """Fetches the entity a lookup option points to, None if there's no such entity."""
+        tmdb_id = await self._resolve_tmdb_id(value, media_type)
+        if tmdb_id is None:
+            return None
+        try:
+            return await getter(tmdb_id)
+        except TmdbApiException:
+            return None
 
     @app_commands.command()
     @app_commands.rename(movie_id='name')
-    @app_commands.describe(movie_id='Name of the movie you want to look up')
-    async def movie(self, interaction: discord.Interaction, movie_id: int):
+    @app_commands.describe(movie_id='Name or IMDb link of the movie you want to look up')
+    @admission_controlled(cinema_admission)
+    async def movie(self, interaction: discord.Interaction, movie_id: str):
         """Displays movie details."""
-        try:
-            movie = await self.tmdb_client.get_movie(movie_id)
-        except TmdbApiException:
-            await interaction.response.send_message('Invalid choice.', ephemeral=True)
-            return
-        view = MovieView(interaction, movie, self.tmdb_client)
-        embed = view.embed()
-        await interaction.response.send_message(view=view, embed=embed)
+        async with AutoDefer(interaction) as responder:
+            movie = await self._lookup(self.tmdb_client.get_movie, movie_id, 'movie')
+            if movie is None:
+                await responder.reject('Invalid choice.')
+                return
+            view = MovieView(interaction, movie, self.tmdb_client)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
     @movie.autocomplete('movie_id')
-    async def movie_autocomplete(self, interaction: discord.Interaction, current: str) -> list[Choice[int]]:
+    async def movie_autocomplete(self, interaction: discord.Interaction, current: str) -> list[Choice[str]]:
         """Autocompletes `movie_id` by pulling suggestions from TMDB API and displaying them as the movie's title."""
         if not current:
             return []
+        if imdb_id := parse_imdb_id(current):
+            return await self._imdb_autocomplete(imdb_id, 'movie')
         candidates = await self.tmdb_client.query_movie(current)
         choices = prepare_production_autocomplete_choices(candidates)
         return choices[:25]
 
     @app_commands.command()
     @app_commands.rename(tv_id='name')
-    @app_commands.describe(tv_id='Name of the show you want to look up')
-    async def tv(self, interaction: discord.Interaction, tv_id: int):
+    @app_commands.describe(tv_id='Name or IMDb link of the show you want to look up')
+    @admission_controlled(cinema_admission)
+    async def tv(self, interaction: discord.Interaction, tv_id: str):
         """Displays tv details."""
-        try:
-            tv = await self.tmdb_client.get_tv(tv_id)
-        except TmdbApiException:
-            await interaction.response.send_message('Invalid choice.', ephemeral=True)
-            return
-        view = TvView(interaction, tv, self.tmdb_client)
-        embed = view.embed()
-        await interaction.response.send_message(view=view, embed=embed)
+        async with AutoDefer(interaction) as responder:
+            tv = await self._lookup(self.tmdb_client.get_tv, tv_id, 'tv')
+            if tv is None:
+                await responder.reject('Invalid choice.')
+                return
+            view = TvView(interaction, tv, self.tmdb_client)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
     @tv.autocomplete('tv_id')
-    async def tv_autocomplete(self, interaction: discord.Interaction, current: str) -> list[Choice[int]]:
+    async def tv_autocomplete(self, interaction: discord.Interaction, current: str) -> list[Choice[str]]:
         """Autocompletes `tv_id` by pulling suggestions from TMDB API and displaying them as the show's title."""
         if not current:
             return []
+        if imdb_id := parse_imdb_id(current):
+            return await self._imdb_autocomplete(imdb_id, 'tv')
         candidates = await self.tmdb_client.query_tv(current)
         choices = prepare_production_autocomplete_choices(candidates)
         return choices[:25]
 
     @app_commands.command()
     @app_commands.rename(person_id='name')
-    @app_commands.describe(person_id='Name of the person you want to look up')
-    async def person(self, interaction: discord.Interaction, person_id: int):
+    @app_commands.describe(person_id='Name or IMDb link of the person you want to look up')
+    @admission_controlled(cinema_admission)
+    async def person(self, interaction: discord.Interaction, person_id: str):
         """Displays personal details."""
-        try:
-            person = await self.tmdb_client.get_person(person_id)
-        except TmdbApiException:
-            await interaction.response.send_message('Invalid choice.', ephemeral=True)
-            return
-        view = PersonView(interaction, person, self.tmdb_client)
-        embed = view.embed()
-        await interaction.response.send_message(view=view, embed=embed)
+        async with AutoDefer(interaction) as responder:
+            person = await self._lookup(self.tmdb_client.get_person, person_id, 'person')
+            if person is None:
+                await responder.reject('Invalid choice.')
+                return
+            view = PersonView(interaction, person, self.tmdb_client)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
     @person.autocomplete('person_id')
-    async def person_autocomplete(self, interaction: discord.Interaction, current: str) -> list[Choice[int]]:
+    async def person_autocomplete(self, interaction: discord.Interaction, current: str) -> list[Choice[str]]:
         """Autocompletes `person_id` by pulling suggestions from TMDB API and displaying them as the person's name."""
         if not current:
             return []
+        if imdb_id := parse_imdb_id(current):
+            return await self._imdb_autocomplete(imdb_id, 'person')
         candidates = await self.tmdb_client.query_person(current)
         candidates = sorted(candidates, key=lambda x: x.popularity, reverse=True)
-        choices = [app_commands.Choice(name=f'{c.name}', value=c.id) for c in candidates]
+        choices = [app_commands.Choice(name=c.title, value=str(c.id)) for c in candidates]
         choices = deduplicate_autocomplete_labels(choices)
         return choices[:25]
 
     @app_commands.command()
     @app_commands.describe(entity='Type of currently popular cinema-related object you want to list')
+    @admission_controlled(cinema_admission)
     async def popular(self, interaction: discord.Interaction, entity: CinemaEntity):
         """Displays currently popular entities."""
-        if entity == CinemaEntity.person:
-            people = await self.tmdb_client.get_popular_people()
-            view = PersonPaginatingView(interaction, people, self.tmdb_client)
-        elif entity == CinemaEntity.movie:
-            productions = await self.tmdb_client.get_popular_movies()
-            view = ProductionPaginatingView(interaction, productions, self.tmdb_client)
-        else:
-            productions = await self.tmdb_client.get_popular_tv()
-            view = ProductionPaginatingView(interaction, productions, self.tmdb_client)
-        embed = view.embed()
-        await interaction.response.send_message(view=view, embed=embed)
+        async with AutoDefer(interaction) as responder:
+            if entity == CinemaEntity.person:
+                people = await self.tmdb_client.get_popular_people()
+                view = PersonPaginatingView(interaction, people, self.tmdb_client)
+            elif entity == CinemaEntity.movie:
+                productions = await self.tmdb_client.get_popular_movies()
+                view = ProductionPaginatingView(interaction, productions, self.tmdb_client)
+            else:
+                productions = await self.tmdb_client.get_popular_tv()
+                view = ProductionPaginatingView(interaction, productions, self.tmdb_client)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
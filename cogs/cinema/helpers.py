@@ -1,10 +1,16 @@
 import collections
 import datetime as dt
+import re
 from enum import Enum, auto
 
 from discord import app_commands
 
-from .models import Production
+from utils.admission import AdmissionController
+from .models import Credit, SearchHit
+
+
+# Shared by all commands and components that fetch from TMDB or do heavy processing, see `admission_controlled`
+cinema_admission = AdmissionController('cinema')
 
 
 class CinemaEntity(Enum):
@@ -26,14 +32,36 @@ def deduplicate_autocomplete_labels(choices: list[app_commands.Choice]) -> list[
     return choices
 
 
-def prepare_production_autocomplete_choices(candidates: list[Production]) -> list[app_commands.Choice]:
+def prepare_production_autocomplete_choices(candidates: list[SearchHit]) -> list[app_commands.Choice]:
     candidates = sorted(candidates, key=lambda x: x.popularity, reverse=True)
-    for c in candidates:
-        if c.release_date:
-            c.title = f'{c.title} ({c.release_date.year})'
-    choices = [app_commands.Choice(name=f'{c.title}', value=c.id) for c in candidates]
+    choices = [app_commands.Choice(name=c.label(), value=str(c.id)) for c in candidates]
     return deduplicate_autocomplete_labels(choices)
 
 
+IMDB_ID_PATTERN = re.compile(r'\b(?:tt|nm)\d{7,}\b')
+
+
+def parse_imdb_id(text: str) -> str | None:
+    """Extracts an IMDb title or name id from text, e.g. a pasted IMDb link."""
+    if match := IMDB_ID_PATTERN.search(text):
+        return match.group(0)
+    return None
+
+
+def paginate_credits(
+        credits: list[Credit],
+        reverse: bool = False,
+        credits_per_page: int = 20
+) -> dict[str, list[str]]:
+    """Turns credits into strings for display and splits them into lists of pages for every department."""
+    pages = collections.defaultdict(list)
+    for credit in sorted(credits, reverse=reverse):
+        pages[credit.department].append(credit)
+    for department, dep_credits in pages.items():
+        pages[department] = ['\n'.join(str(credit) for credit in dep_credits[x:x + credits_per_page])
+                             for x in range(0, len(dep_credits), credits_per_page)]
+    return pages
+
+
 def verbose_date(date: dt.datetime.date) -> str:
     return date.strftime('%d %B, %Y')
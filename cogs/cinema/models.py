@@ -1,10 +1,22 @@
+import asyncio
 import datetime as dt
-from copy import deepcopy
+import functools
+import heapq
+import json
+import logging
+import operator
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, NamedTuple
 
 from async_lru import alru_cache
+from tortoise import fields
+from tortoise.models import Model
 
-from utils.misc import get_as_json
-from utils.misc import strptime, calculate_age
+from utils.misc import calculate_age, get_as_bytes, get_as_json, stream_json, strptime
+from .cache import TmdbCache, cached_entity
+
+_log = logging.getLogger(__name__)
 
 
 class TmdbApiException(Exception):
@@ -24,7 +36,35 @@ class ImageConfiguration:
         self.still_sizes: list[str] = kwargs.get('still_sizes')
 
 
-class Credit:
+class PlainRow:
+    """Conversion of objects to plain tuples of their attribute values and back.
+
+    Tuples of primitives are several times cheaper to unpickle than the objects themselves, so a process pool sends
+    parsed credits and images back as rows (see `hydrate_credits_payload`). Subclasses must set every attribute in
+    their constructor, which must work without arguments.
+    """
+
+    @classmethod
+    @functools.cache
+    def row_fields(cls) -> tuple[str, ...]:
+        return tuple(vars(cls()))
+
+    @classmethod
+    @functools.cache
+    def _row_getter(cls) -> Callable[[Any], tuple]:
+        return operator.attrgetter(*cls.row_fields())
+
+    def to_row(self) -> tuple:
+        return self._row_getter()(self)
+
+    @classmethod
+    def from_row(cls, row: tuple):
+        obj = cls.__new__(cls)
+        obj.__dict__.update(zip(cls.row_fields(), row))
+        return obj
+
+
+class Credit(PlainRow):
     def __init__(self, **kwargs):
         self.credit_type: str = kwargs.get('credit_type')
         self.media_type: str = kwargs.get('media_type')
@@ -102,8 +142,55 @@ class Credit:
         return s
 
 
-class Image:
+class CreditAccumulator:
+    """Builds `Credit` objects one raw credit at a time, merging repeated credits of the same subject and department."""
+    credit_types = ('cast', 'crew')
+
+    def __init__(self):
+        self.credits: list[Credit] = []
+        self._merged: dict[tuple, Credit] = {}
+
+    def add(self, credit_type: str, credit: dict) -> None:
+        if credit_type == 'cast':
+            credit['department'] = 'Acting'
+        episode_count = credit.pop('episode_count', None)
+        # Aggregate credits (TV) list every role or job of a person within a single entry
+        roles = credit.pop('roles', None)
+        jobs = credit.pop('jobs', None)
+        obj = Credit(**credit)
+        obj.credit_type = credit_type
+        if roles or jobs:
+            for role in roles or []:
+                obj.characters.append(role['character'])
+                obj.episode_counts[role['character']] = role['episode_count']
+            for job in jobs or []:
+                obj.jobs.append(job['job'])
+                obj.episode_counts[job['job']] = job['episode_count']
+            self.credits.append(obj)
+            return
+        if credit_type == 'crew':
+            attr = 'jobs'
+            credited_for = credit['job']
+        else:
+            attr = 'characters'
+            credited_for = credit['character']
+        key = (obj.media_type, obj.id, obj.department)
+        if merged := self._merged.get(key):
+            if credited_for:
+                getattr(merged, attr).append(credited_for)
+                merged.episode_counts[credited_for] = episode_count
+        else:
+            if credited_for:
+                getattr(obj, attr).append(credited_for)
+                obj.episode_counts[credited_for] = episode_count
+            self._merged[key] = obj
+            self.credits.append(obj)
+
+
+class Image(PlainRow):
     """Represents an image on TMDB."""
+    # Sections of the `images` part of a response, with sizes listed in `ImageConfiguration` under the singular name
+    categories = ('backdrops', 'logos', 'posters', 'profiles', 'stills')
 
     def __init__(self, **kwargs):
         self.image_category: str = kwargs.get('image_category')
@@ -130,6 +217,69 @@ class ExternalIds:
         self.twitter_id: str = kwargs.get('twitter_id')
 
 
+class Episode:
+    """Represents a single episode of a TV show."""
+
+    def __init__(self, **kwargs):
+        self.id: int = kwargs.get('id')
+        self.show_id: int = kwargs.get('show_id')
+        self.name: str = kwargs.get('name')
+        self.overview: str = kwargs.get('overview')
+        self.air_date: dt.date = strptime(kwargs.get('air_date'), '%Y-%m-%d', no_time=True)
+        self.season_number: int = kwargs.get('season_number')
+        self.episode_number: int = kwargs.get('episode_number')
+        self.runtime: int = kwargs.get('runtime')
+        self.still_path: str = kwargs.get('still_path')
+        self.vote_average: float = kwargs.get('vote_average')
+        self.vote_count: int = kwargs.get('vote_count')
+        self.web_url = (f'{TmdbClient.base_web_url}/tv/{self.show_id}'
+                        f'/season/{self.season_number}/episode/{self.episode_number}')
+
+    def __str__(self):
+        s = f'``{self.air_date}``' if self.air_date else '``----------``'
+        s += f' **E{self.episode_number:02}** [{self.name}]({self.web_url})'
+        if self.runtime:
+            s += f' ({self.runtime}m)'
+        return s
+
+    def code(self) -> str:
+        return f'S{self.season_number:02}E{self.episode_number:02}'
+
+
+class Season:
+    """Represents a season of a TV show. Episodes are only present if the season was fetched on its own."""
+
+    def __init__(self, **kwargs):
+        self.id: int = kwargs.get('id')
+        self.show_id: int = kwargs.get('show_id')
+        self.name: str = kwargs.get('name')
+        self.overview: str = kwargs.get('overview')
+        self.air_date: dt.date = strptime(kwargs.get('air_date'), '%Y-%m-%d', no_time=True)
+        self.season_number: int = kwargs.get('season_number')
+        self.episode_count: int = kwargs.get('episode_count')
+        self.poster_path: str = kwargs.get('poster_path')
+        self.vote_average: float = kwargs.get('vote_average')
+        self.episodes: list[Episode] = kwargs.get('episodes', [])
+        if self.episode_count is None:
+            self.episode_count = len(self.episodes)
+
+
+class SearchHit:
+    """Compact projection of a search result, keeping only what autocomplete needs."""
+    __slots__ = ('id', 'title', 'year', 'popularity')
+
+    def __init__(self, **kwargs):
+        self.id: int = kwargs.get('id')
+        self.title: str = kwargs.get('title', kwargs.get('name'))
+        # Only the year is ever displayed, so the date isn't parsed
+        date = kwargs.get('release_date', kwargs.get('first_air_date'))
+        self.year: int | None = int(date[:4]) if date else None
+        self.popularity: float = kwargs.get('popularity') or 0
+
+    def label(self) -> str:
+        return f'{self.title} ({self.year})' if self.year else self.title
+
+
 class Person:
     """Represents a person on TMDB"""
 
@@ -157,8 +307,8 @@ class Person:
         self.notable_credits = self._get_notable_credits() if self.credits else None
 
     def _get_notable_credits(self, count: int = 5) -> list[Credit]:
-        return [c for c in sorted(self.credits, key=lambda x: x.vote_count, reverse=True) if
-                c.department == self.known_for_department][:count]
+        return heapq.nlargest(count, (c for c in self.credits if c.department == self.known_for_department),
+                              key=lambda x: x.vote_count)
 
 
 class Production:
@@ -227,13 +377,13 @@ class Tv(Production):
         self.created_by: list[Person] = kwargs.get('created_by')
         self.in_production: bool = kwargs.get('in_production')
         self.languages: list[str] = kwargs.get('languages')
-        # self.last_episode_to_air: ??? = kwargs.get('last_episode_to_air')
-        # self.next_episode_to_air: ??? = kwargs.get('next_episode_to_air')
+        self.last_episode_to_air: Episode = kwargs.get('last_episode_to_air')
+        self.next_episode_to_air: Episode = kwargs.get('next_episode_to_air')
         self.networks: list[str] = kwargs.get('networks')
         self.number_of_episodes: int = kwargs.get('number_of_episodes')
         self.number_of_seasons: int = kwargs.get('number_of_seasons')
         self.origin_country: list[str] = kwargs.get('origin_country')
-        # self.seasons: ??? = kwargs.get('seasons')
+        self.seasons: list[Season] = kwargs.get('seasons', [])
         self.type: str = kwargs.get('type')
 
     def pretty_runtime(self) -> str:
@@ -245,28 +395,246 @@ class Tv(Production):
         return f"{(str(hours) + 'h ') if hours else ''}{str(minutes) + 'm'}"
 
 
+class ImdbMapping(Model):
+    imdb_id = fields.CharField(16, pk=True)
+    tmdb_id = fields.IntField()
+    media_type = fields.CharField(8)
+    label = fields.CharField(256)
+
+
+class ExternalMapping(NamedTuple):
+    media_type: str
+    tmdb_id: int
+    label: str
+
+
+class ImdbIndex:
+    """Local mapping of IMDb ids to TMDB entities, persisted in the database.
+
+    It's filled from every hydrated response and `/find` request, so that resolving an IMDb id costs an upstream request
+    only the first time the id is seen. Ids TMDB knows nothing about are remembered in memory for `miss_ttl` seconds, so
+    that autocomplete doesn't look them up again on every keystroke.
+    """
+
+    def __init__(self, persist: bool = True, miss_ttl: float = 600):
+        self.persist = persist
+        self.miss_ttl = miss_ttl
+        self._mappings: dict[str, ExternalMapping] = {}
+        # Expiry times in insertion order, which is also the order they expire in
+        self._misses: dict[str, float] = {}
+        self._unsaved: dict[str, ExternalMapping] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._mappings)
+
+    async def load(self) -> None:
+        for mapping in await ImdbMapping.all():
+            self._mappings[mapping.imdb_id] = ExternalMapping(mapping.media_type, mapping.tmdb_id, mapping.label)
+
+    def get(self, imdb_id: str) -> ExternalMapping | None:
+        return self._mappings.get(imdb_id)
+
+    def is_miss(self, imdb_id: str) -> bool:
+        """Whether the id was recently looked up upstream without a match."""
+        expires_at = self._misses.get(imdb_id)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def add_miss(self, imdb_id: str) -> None:
+        now = time.monotonic()
+        while self._misses and next(iter(self._misses.values())) <= now:
+            del self._misses[next(iter(self._misses))]
+        self._misses.pop(imdb_id, None)
+        self._misses[imdb_id] = now + self.miss_ttl
+
+    def add(self, imdb_id: str | None, media_type: str, tmdb_id: int, label: str) -> None:
+        if not imdb_id:
+            return
+        mapping = ExternalMapping(media_type, tmdb_id, label)
+        if self._mappings.get(imdb_id) == mapping:
+            return
+        self._mappings[imdb_id] = mapping
+        if self.persist:
+            self._unsaved[imdb_id] = mapping
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        """Writes new and changed mappings to the database."""
+        while self._unsaved:
+            unsaved, self._unsaved = self._unsaved, {}
+            try:
+                await ImdbMapping.bulk_create(
+                    [ImdbMapping(imdb_id=imdb_id, **mapping._asdict()) for imdb_id, mapping in unsaved.items()],
+                    on_conflict=['imdb_id'],
+                    update_fields=['tmdb_id', 'media_type', 'label'],
+                )
+            except Exception:
+                _log.exception(f'Failed to persist {len(unsaved)} IMDb mappings.')
+
+
+class TmdbPaginator:
+    """Lazily loaded sequence of results of a paginated TMDB endpoint.
+
+    A result page is fetched once the cursor reaches it, and the page after it is prefetched in the background. Pages
+    further than `keep_behind` pages behind the cursor are dropped to keep memory bounded, going back to them fetches
+    them again. Iterating over the paginator asynchronously goes through all results.
+
+    The number of results is taken from the first page and stays fixed, as views size themselves by it. Results may
+    shift between pages fetched at different times though, so a later page can come back shorter than expected, and
+    indexing past its end raises IndexError.
+    """
+    max_pages = 500  # TMDB refuses to serve pages past this one
+
+    def __init__(
+            self,
+            client: 'TmdbClient',
+            endpoint: str,
+            objectify: Callable[[dict], Any],
+            keep_behind: int = 2,
+            **params,
+    ):
+        self.client = client
+        self.endpoint = endpoint
+        self.objectify = objectify
+        self.keep_behind = keep_behind
+        self.params = params
+        self.page_size: int | None = None
+        self.total_results = 0
+        self._pages: dict[int, list] = {}
+        self._pending: dict[int, asyncio.Future] = {}
+
+    def __len__(self):
+        return self.total_results
+
+    def __getitem__(self, index: int) -> Any:
+        page, offset = divmod(index, self.page_size)
+        try:
+            return self._pages[page + 1][offset]
+        except KeyError:
+            raise IndexError(f'Result {index} is not loaded.') from None
+
+    async def __aiter__(self):
+        index = 0
+        await self.load(index)
+        while index < len(self):
+            await self.load(index)
+            try:
+                yield self[index]
+            except IndexError:
+                # The rest of a short page
+                pass
+            index += 1
+
+    @property
+    def page_count(self) -> int:
+        return -(-self.total_results // self.page_size) if self.page_size else 0
+
+    @property
+    def loaded_pages(self) -> list[int]:
+        return sorted(self._pages)
+
+    async def _fetch(self, page: int) -> None:
+        parsed = await self.client._get(self.endpoint, page=page, **self.params)
+        if self.page_size is None:
+            self.page_size = len(parsed['results']) or 1
+            self.total_results = min(parsed['total_results'], self.max_pages * self.page_size)
+        self._pages[page] = [self.objectify(result) for result in parsed['results']]
+
+    def _start(self, page: int) -> asyncio.Future:
+        if (future := self._pending.get(page)) is None:
+            future = asyncio.ensure_future(self._fetch(page))
+            self._pending[page] = future
+            future.add_done_callback(functools.partial(self._fetched, page))
+        return future
+
+    def _fetched(self, page: int, future: asyncio.Future) -> None:
+        del self._pending[page]
+        if not future.cancelled():
+            # Failed prefetches are simply retried once the page is actually needed
+            future.exception()
+
+    async def load(self, index: int) -> None:
+        """Makes sure the result at index is loaded. Prefetches the next page and drops pages far from the cursor."""
+        page = index // self.page_size + 1 if self.page_size else 1
+        if page not in self._pages:
+            await asyncio.shield(self._start(page))
+        for loaded in list(self._pages):
+            if not page - self.keep_behind <= loaded <= page + 1:
+                del self._pages[loaded]
+        if page < self.page_count and page + 1 not in self._pages:
+            self._start(page + 1)
+
+
+def hydrate_credits_payload(body: bytes, credits_key: str, as_rows: bool = False) -> dict:
+    """Parses a detail response and turns its credits and images sections into objects, or into rows of their
+    attributes with `as_rows` (see `PlainRow`).
+
+    Module level and fed with raw bytes, so that it's cheap to hand over to a process pool.
+    """
+    parsed = json.loads(body)
+    if parsed.get('status_code') == 34:
+        return parsed
+    parsed['credits'] = TmdbClient._process_credits(parsed.pop(credits_key))
+    parsed['images'] = TmdbClient._process_images(parsed['images'])
+    if as_rows:
+        parsed['credits'] = [credit.to_row() for credit in parsed['credits']]
+        parsed['images'] = [image.to_row() for image in parsed['images']]
+    return parsed
+
+
 class TmdbClient:
     """TMDB client class used for sending requests to the API."""
     base_api_url = 'https://api.themoviedb.org/3'
     base_web_url = 'https://www.themoviedb.org'
 
-    def __init__(self, api_key: str):
+    def __init__(
+            self,
+            api_key: str,
+            *,
+            streaming: bool = True,
+            executor: Executor | None = None,
+            offload_bytes: int = 512_000,
+            offload_items: int = 1000,
+            cache: TmdbCache | None = None,
+            imdb_index: ImdbIndex | None = None,
+    ):
         self.api_key = api_key
+        self.cache = cache if cache is not None else TmdbCache()
+        self.imdb_index = imdb_index if imdb_index is not None else ImdbIndex(persist=False)
+        self.streaming = streaming
+        # CPU heavy work on large inputs is moved off the event loop if an executor is given
+        self.executor = executor
+        # Only another process can parse a large body without holding the GIL for as long as it takes
+        self.uses_processes = isinstance(executor, ProcessPoolExecutor)
+        self.offload_bytes = offload_bytes
+        self.offload_items = offload_items
         self.img_config: ImageConfiguration | None = None
         self.language_config: dict[str, str] = {}
         self.movie_genres: dict[int, str] = {}
         self.tv_genres: dict[int, str] = {}
+        self._background_tasks: set[asyncio.Task] = set()
 
-    async def _get(self, endpoint: str, **kwargs) -> dict | list:
-        """Creates a request to a given endpoint. Accepts query parameters as keyword arguments."""
-        # As of December 16, 2019, TMDB has disabled the API rate limiting.
+    def _url(self, endpoint: str, **kwargs) -> str:
         url = f'{self.base_api_url}{endpoint}?api_key={self.api_key}'
         for k, v in kwargs.items():
             url += f'&{k}={v}'
-        response = await get_as_json(url)
+        return url
+
+    async def _get(self, endpoint: str, **kwargs) -> dict | list:
+        """Creates a request to a given endpoint. Accepts query parameters as keyword arguments."""
+        # As of December 16, 2019, TMDB has disabled the API rate limiting.
+        response = await get_as_json(self._url(endpoint, **kwargs))
         if type(response) == dict and response.get('status_code') == 34:
             raise TmdbApiException(response)
-        return await get_as_json(url)
+        return response
+
+    async def _get_streamed(self, endpoint: str, item_handlers: dict[str, Callable], **kwargs) -> dict:
+        """Same as `_get`, but array items under `item_handlers` prefixes are handed over while the response is read."""
+        response = await stream_json(self._url(endpoint, **kwargs), item_handlers)
+        if type(response) == dict and response.get('status_code') == 34:
+            raise TmdbApiException(response)
+        return response
 
     @alru_cache(maxsize=1)
     async def update_configuration(self):
@@ -284,133 +652,225 @@ class TmdbClient:
         for genre in parsed['genres']:
             self.tv_genres[genre['id']] = genre['name']
 
-    def _process_credits(self, combined_credits: dict[str, list[dict]]) -> list[Credit]:
-        # TODO: Rewrite this entire method
-        objectified_credits = []
-        for credit_type in ['cast', 'crew']:
+    @staticmethod
+    def _process_credits(combined_credits: dict[str, list[dict]]) -> list[Credit]:
+        accumulator = CreditAccumulator()
+        for credit_type in CreditAccumulator.credit_types:
             for credit in combined_credits[credit_type]:
-                if credit_type == 'cast':
-                    credit['department'] = 'Acting'
-                try:
-                    episode_count = credit.pop('episode_count')
-                except KeyError:
-                    episode_count = None
-                try:
-                    credit['jobs_'] = credit.pop('jobs')
-                except KeyError:
-                    pass
-                obj = Credit(**credit)
-                obj.credit_type = credit_type
-                if not (credit.get('roles') or credit.get('jobs_')):
-                    if credit_type == 'crew':
-                        attr = 'jobs'
-                        credited_for = credit['job']
-                    else:
-                        attr = 'characters'
-                        credited_for = credit['character']
-                    if obj in objectified_credits:
-                        if credited_for:
-                            idx = objectified_credits.index(obj)
-                            getattr(objectified_credits[idx], attr).append(credited_for)
-                            getattr(objectified_credits[idx], 'episode_counts')[credited_for] = episode_count
-                    else:
-                        if credited_for:
-                            getattr(obj, attr).append(credited_for)
-                            getattr(obj, 'episode_counts')[credited_for] = episode_count
-                        objectified_credits.append(obj)
-                else:
-                    if roles := credit.get('roles'):
-                        for role in roles:
-                            obj.characters.append(role['character'])
-                            obj.episode_counts[role['character']] = role['episode_count']
-                    if jobs := credit.get('jobs_'):
-                        for job in jobs:
-                            obj.jobs.append(job['job'])
-                            obj.episode_counts[job['job']] = job['episode_count']
-                    objectified_credits.append(obj)
-        return objectified_credits
-
-    def _process_images(self, images: dict[str, list[dict]]) -> list[Image]:
+                accumulator.add(credit_type, credit)
+        return accumulator.credits
+
+    @staticmethod
+    def _process_images(images: dict[str, list[dict]]) -> list[Image]:
         objectified_images = []
         for category, image_list in images.items():
+            if category not in Image.categories:
+                continue
             for img in image_list:
                 obj = Image(**img)
                 obj.image_category = category
                 objectified_images.append(obj)
         return objectified_images
 
+    @staticmethod
+    def _add_image(images: list[Image], category: str, img: dict) -> None:
+        obj = Image(**img)
+        obj.image_category = category
+        images.append(obj)
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run_cpu_bound(self, func: Callable, *args, size: int):
+        """Runs `func` in the executor if `size` (number of items to process) is large enough, directly otherwise.
+
+        With a process pool both `func` and its arguments have to be picklable, so `func` must be module level.
+        """
+        if self.executor is None or size < self.offload_items:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def _get_with_credits(self, endpoint: str, credits_key: str, **kwargs) -> dict:
+        """Requests a detail endpoint and turns its credits and images sections into objects.
+
+        In streaming mode both sections are built one item at a time while the response is being read, so their raw
+        dicts never exist all at once. Otherwise the whole body is parsed at once, in the executor if it's large.
+        With a process pool, bodies are always read whole, so that large ones can be parsed in another process: that's
+        the only way to keep the event loop completely free, at the cost of holding the raw body in memory.
+        Credits end up under the 'credits' key regardless of `credits_key`.
+        """
+        if not self.streaming or self.uses_processes:
+            body = await get_as_bytes(self._url(endpoint, **kwargs))
+            if self.executor and len(body) >= self.offload_bytes:
+                loop = asyncio.get_running_loop()
+                parsed = await loop.run_in_executor(
+                    self.executor, hydrate_credits_payload, body, credits_key, self.uses_processes)
+                if self.uses_processes and parsed.get('status_code') != 34:
+                    parsed['credits'] = [Credit.from_row(row) for row in parsed['credits']]
+                    parsed['images'] = [Image.from_row(row) for row in parsed['images']]
+            else:
+                parsed = hydrate_credits_payload(body, credits_key)
+            if parsed.get('status_code') == 34:
+                raise TmdbApiException(parsed)
+            return parsed
+        credits = CreditAccumulator()
+        images = []
+        item_handlers = {f'{credits_key}.{credit_type}': functools.partial(credits.add, credit_type)
+                         for credit_type in CreditAccumulator.credit_types}
+        for category in Image.categories:
+            item_handlers[f'images.{category}'] = functools.partial(self._add_image, images, category)
+        parsed = await self._get_streamed(endpoint, item_handlers, **kwargs)
+        parsed.pop(credits_key)
+        parsed['credits'] = credits.credits
+        parsed['images'] = images
+        return parsed
+
+    @cached_entity(lambda person_id: ('person', person_id))
     async def get_person(self, person_id: int) -> Person:
         """GET request for specified person."""
-        parsed = await self._get(f'/person/{person_id}', append_to_response='combined_credits,images,external_ids')
-        combined_credits = parsed.pop('combined_credits')
-        parsed['credits'] = self._process_credits(combined_credits)
-        parsed['images'] = self._process_images(parsed['images'])
+        parsed = await self._get_with_credits(f'/person/{person_id}', 'combined_credits',
+                                              append_to_response='combined_credits,images,external_ids')
         parsed['external_ids'] = ExternalIds(**parsed['external_ids'])
+        self.imdb_index.add(parsed['external_ids'].imdb_id, 'person', person_id, parsed['name'])
         return Person(**parsed)
 
-    def _prepare_production(self, parsed_production: dict) -> dict:
-        parsed = deepcopy(parsed_production)
+    def _prepare_production(self, parsed: dict) -> dict:
+        # The dict comes straight from the response and is not shared with anything, so it's modified in place
         parsed['genres'] = [genre['name'] for genre in parsed['genres']]
         parsed['spoken_languages'] = [self.language_config[lang['iso_639_1']] for lang in parsed['spoken_languages']]
-        parsed['images'] = self._process_images(parsed['images'])
         parsed['external_ids'] = ExternalIds(**parsed['external_ids'])
         return parsed
 
+    @cached_entity(lambda movie_id: ('movie', movie_id))
     async def get_movie(self, movie_id: int) -> Movie:
-        parsed = await self._get(f'/movie/{movie_id}', append_to_response='alternative_titles,credits,'
-                                                                          'external_ids,images,keywords,'
-                                                                          'recommendations,release_dates,'
-                                                                          'similar,videos')
+        parsed = await self._get_with_credits(f'/movie/{movie_id}', 'credits',
+                                              append_to_response='alternative_titles,credits,'
+                                                                 'external_ids,images,keywords,'
+                                                                 'recommendations,release_dates,'
+                                                                 'similar,videos')
         parsed = self._prepare_production(parsed)
         parsed['keywords'] = [keyword['name'] for keyword in parsed['keywords']['keywords']]
-        parsed['credits'] = self._process_credits(parsed['credits'])
         parsed['similar'] = [Movie(**kwargs) for kwargs in parsed['similar']['results']]
         parsed['recommendations'] = [Movie(**kwargs) for kwargs in parsed['recommendations']['results']]
+        self.imdb_index.add(parsed['external_ids'].imdb_id, 'movie', movie_id, SearchHit(**parsed).label())
         return Movie(**parsed)
 
+    @cached_entity(lambda tv_id: ('tv', tv_id))
     async def get_tv(self, tv_id: int) -> Tv:
-        parsed = await self._get(f'/tv/{tv_id}', append_to_response='aggregate_credits,alternative_titles,'
-                                                                    'content_ratings,external_ids,images,'
-                                                                    'keywords,recommendations,'
-                                                                    'screened_theatrically,similar,videos')
+        parsed = await self._get_with_credits(f'/tv/{tv_id}', 'aggregate_credits',
+                                              append_to_response='aggregate_credits,alternative_titles,'
+                                                                 'content_ratings,external_ids,images,'
+                                                                 'keywords,recommendations,'
+                                                                 'screened_theatrically,similar,videos')
         parsed = self._prepare_production(parsed)
         parsed['created_by'] = [Person(**person) for person in parsed['created_by']]
         parsed['networks'] = [network['name'] for network in parsed['networks']]
         parsed['keywords'] = [keyword['name'] for keyword in parsed['keywords']['results']]
-        parsed['credits'] = self._process_credits(parsed['aggregate_credits'])
         parsed['similar'] = [Tv(**kwargs) for kwargs in parsed['similar']['results']]
         parsed['recommendations'] = [Tv(**kwargs) for kwargs in parsed['recommendations']['results']]
+        # Only season summaries are included here, episodes are fetched on demand through `get_season`
+        parsed['seasons'] = [Season(**(season | {'show_id': tv_id})) for season in parsed['seasons']]
+        for key in ('last_episode_to_air', 'next_episode_to_air'):
+            if episode := parsed.get(key):
+                parsed[key] = Episode(**(episode | {'show_id': tv_id}))
+        self.imdb_index.add(parsed['external_ids'].imdb_id, 'tv', tv_id, SearchHit(**parsed).label())
         return Tv(**parsed)
 
-    async def get_popular_people(self) -> list[Person]:
-        parsed = await self._get(f'/person/popular')
-        parsed = parsed['results']
-        for person in parsed:
-            person['known_for'] = [Tv(**kwargs) if kwargs['media_type'] == 'tv' else Movie(**kwargs)
-                                   for kwargs in person['known_for']]
-        return [Person(**kwargs) for kwargs in parsed]
-
-    async def get_popular_movies(self) -> list[Movie]:
-        parsed = await self._get(f'/movie/popular')
-        parsed = parsed['results']
-        return [Movie(**kwargs) for kwargs in parsed]
-
-    async def get_popular_tv(self) -> list[Tv]:
-        parsed = await self._get(f'/tv/popular')
-        parsed = parsed['results']
-        return [Tv(**kwargs) for kwargs in parsed]
-
-    async def query_person(self, query: str) -> list[Person]:
+    @cached_entity(lambda tv_id, season_number: ('tv', tv_id, season_number))
+    async def get_season(self, tv_id: int, season_number: int) -> Season:
+        """GET request for a single season of a show, including its episodes."""
+        parsed = await self._get(f'/tv/{tv_id}/season/{season_number}')
+        parsed['episodes'] = [Episode(**(episode | {'show_id': tv_id})) for episode in parsed['episodes']]
+        parsed['show_id'] = tv_id
+        return Season(**parsed)
+
+    async def find_imdb_id(self, imdb_id: str) -> ExternalMapping | None:
+        """Resolves an IMDb id into the matching TMDB entity. Only ids not seen before are looked up upstream."""
+        if mapping := self.imdb_index.get(imdb_id):
+            return mapping
+        if self.imdb_index.is_miss(imdb_id):
+            return None
+        parsed = await self._get(f'/find/{imdb_id}', external_source='imdb_id')
+        for media_type in ['movie', 'tv', 'person']:
+            if results := parsed[f'{media_type}_results']:
+                hit = SearchHit(**results[0])
+                self.imdb_index.add(imdb_id, media_type, hit.id, hit.label())
+                return self.imdb_index.get(imdb_id)
+        self.imdb_index.add_miss(imdb_id)
+        return None
+
+    def prefetch_season(self, tv_id: int, season_number: int) -> None:
+        """Warms the season cache in the background so that the season is ready once the user selects it."""
+        task = asyncio.create_task(self.get_season(tv_id, season_number))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._discard_background_task)
+
+    def _discard_background_task(self, task: asyncio.Task) -> None:
+        self._background_tasks.discard(task)
+        if not task.cancelled():
+            # Failures are not interesting here, the season will simply be fetched again when selected
+            task.exception()
+
+    async def get_changes(self, media_type: str, start: dt.datetime, end: dt.datetime) -> set[int]:
+        """GET request for ids of entities of a given media type that changed within the time window."""
+        changed = set()
+        page = total_pages = 1
+        while page <= total_pages:
+            parsed = await self._get(f'/{media_type}/changes', start_date=start.strftime('%Y-%m-%d'),
+                                     end_date=end.strftime('%Y-%m-%d'), page=page)
+            changed.update(change['id'] for change in parsed['results'])
+            total_pages = parsed['total_pages']
+            page += 1
+        return changed
+
+    async def sync_changes(self) -> dict[str, int]:
+        """Polls the change feeds and evicts cached entities that changed since the previous poll.
+
+        Returns the amount of evicted entries for every media type.
+        """
+        now = dt.datetime.now(dt.timezone.utc)
+        # The feeds cover at most 14 days, if the previous poll is older than that some changes are lost
+        oldest = now - dt.timedelta(days=14)
+        start = max(self.cache.feed_synced_at or now - dt.timedelta(days=1), oldest)
+        evicted = {}
+        for media_type in ['movie', 'tv', 'person']:
+            changed = await self.get_changes(media_type, start, now)
+            evicted[media_type] = self.cache.evict(media_type, changed)
+        self.cache.mark_synced(start, now)
+        return evicted
+
+    async def _paginate(self, endpoint: str, objectify: Callable[[dict], Any]) -> TmdbPaginator:
+        paginator = TmdbPaginator(self, endpoint, objectify)
+        await paginator.load(0)
+        return paginator
+
+    @staticmethod
+    def _popular_person(person: dict) -> Person:
+        person['known_for'] = [Tv(**kwargs) if kwargs['media_type'] == 'tv' else Movie(**kwargs)
+                               for kwargs in person['known_for']]
+        return Person(**person)
+
+    async def get_popular_people(self) -> TmdbPaginator:
+        return await self._paginate('/person/popular', self._popular_person)
+
+    async def get_popular_movies(self) -> TmdbPaginator:
+        return await self._paginate('/movie/popular', lambda kwargs: Movie(**kwargs))
+
+    async def get_popular_tv(self) -> TmdbPaginator:
+        return await self._paginate('/tv/popular', lambda kwargs: Tv(**kwargs))
+
+    async def query_person(self, query: str) -> list[SearchHit]:
         """GET request used to search for people based on user query."""
         parsed = await self._get(f'/search/person', query=query)
-        return [Person(**kwargs) for kwargs in parsed['results']]
+        return [SearchHit(**kwargs) for kwargs in parsed['results']]
 
-    async def query_movie(self, query: str) -> list[Movie]:
+    async def query_movie(self, query: str) -> list[SearchHit]:
         """GET request used to search for movies based on user query."""
         parsed = await self._get(f'/search/movie', query=query)
-        return [Movie(**kwargs) for kwargs in parsed['results']]
+        return [SearchHit(**kwargs) for kwargs in parsed['results']]
 
-    async def query_tv(self, query: str) -> list[Tv]:
+    async def query_tv(self, query: str) -> list[SearchHit]:
         """GET request used to search for shows based on user query."""
         parsed = await self._get(f'/search/tv', query=query)
-        return [Tv(**kwargs) for kwargs in parsed['results']]
+        return [SearchHit(**kwargs) for kwargs in parsed['results']]
@@ -1,11 +1,11 @@
-import collections
-
 import discord
 
+from utils.admission import admission_controlled
+from utils.interactions import AutoDefer
 from utils.constants import EMBED_DESC_MAX_LENGTH, COLOR_EMBED_DARK
 from utils.misc import trim_by_paragraph
-from .helpers import verbose_date
-from .models import Person, TmdbClient, Movie, Production, Tv
+from .helpers import verbose_date, paginate_credits, cinema_admission
+from .models import Person, TmdbClient, Movie, Production, Tv, Season, TmdbPaginator
 from ..shared_views import SphynxView, PaginatingView
 
 
@@ -49,16 +49,6 @@ class PersonView(SphynxView):
         pages.append(page)
         return pages
 
-    def _paginate_credits(self, credits_per_page: int = 20) -> dict[str, list[str]]:
-        """Turns credits into strings for display and splits them into lists of pages for every category."""
-        pages = collections.defaultdict(list)
-        for credit in sorted(self.person.credits, reverse=True):
-            pages[credit.department].append(credit)
-        for department, dep_credits in pages.items():
-            pages[department] = ['\n'.join(str(credit) for credit in dep_credits[x:x + credits_per_page])
-                                 for x in range(0, len(dep_credits), credits_per_page)]
-        return pages
-
     def embed(self) -> discord.Embed:
         """Returns the embed used for displaying the person's primary information."""
         embed = discord.Embed(title=self.person.name,
@@ -114,12 +104,15 @@ class PersonView(SphynxView):
         await interaction.response.edit_message(view=view, embed=embed)
 
     @discord.ui.button(label='CREDITS', style=discord.ButtonStyle.gray, disabled=True)
+    @admission_controlled(cinema_admission)
     async def credits(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Button that displays complete credits when pressed."""
-        pages = self._paginate_credits()
-        view = PersonCreditsView(interaction, pages, self)
-        embed = view.embed()
-        await interaction.response.edit_message(view=view, embed=embed)
+        async with AutoDefer(interaction, edit=True) as responder:
+            credits = self.person.credits
+            pages = await self.client.run_cpu_bound(paginate_credits, credits, True, size=len(credits))
+            view = PersonCreditsView(interaction, pages, self)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
 
 class ProductionView(SphynxView):
@@ -140,16 +133,6 @@ class ProductionView(SphynxView):
         if self.production.recommendations:
             self.recommendations.disabled = False
 
-    def _paginate_credits(self, credits_per_page: int = 20) -> dict[str, list[str]]:
-        """Turns credits into strings for display and splits them into lists of pages for every category."""
-        pages = collections.defaultdict(list)
-        for credit in sorted(self.production.credits):
-            pages[credit.department].append(credit)
-        for department, dep_credits in pages.items():
-            pages[department] = ['\n'.join(str(credit) for credit in dep_credits[x:x + credits_per_page])
-                                 for x in range(0, len(dep_credits), credits_per_page)]
-        return pages
-
     def _embed_description(self) -> str:
         if self.production.tagline:
             return f'**{self.production.tagline}**\n\n{self.production.overview}'
@@ -189,12 +172,15 @@ class ProductionView(SphynxView):
         return embed
 
     @discord.ui.button(label='CREDITS', style=discord.ButtonStyle.gray, disabled=True)
+    @admission_controlled(cinema_admission)
     async def credits(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Button that displays complete credits when pressed."""
-        pages = self._paginate_credits()
-        view = ProductionCreditsView(interaction, pages, self)
-        embed = view.embed()
-        await interaction.response.edit_message(view=view, embed=embed)
+        async with AutoDefer(interaction, edit=True) as responder:
+            credits = self.production.credits
+            pages = await self.client.run_cpu_bound(paginate_credits, credits, size=len(credits))
+            view = ProductionCreditsView(interaction, pages, self)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
     @discord.ui.button(label='SIMILAR', style=discord.ButtonStyle.gray, disabled=True)
     async def similar(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -249,6 +235,8 @@ class TvView(ProductionView):
     ):
         super().__init__(interaction, tv, client, **kwargs)
         self.production = tv
+        if self.production.seasons:
+            self.seasons.disabled = False
 
     def embed(self) -> discord.Embed:
         """Returns the embed used for displaying the show's primary information."""
@@ -263,10 +251,27 @@ class TvView(ProductionView):
             name='Last aired',
             value=verbose_date(self.production.last_air_date) if self.production.last_air_date else '-'
         )
+        if episode := self.production.next_episode_to_air:
+            embed.add_field(
+                name='Next episode',
+                value=f'{episode.code()} - {verbose_date(episode.air_date) if episode.air_date else "TBA"}'
+            )
         if self.production.created_by:
             embed.set_author(name='Created by ' + ', '.join([person.name for person in self.production.created_by]))
         return embed
 
+    @discord.ui.button(label='SEASONS', style=discord.ButtonStyle.gray, disabled=True)
+    @admission_controlled(cinema_admission)
+    async def seasons(self, interaction: discord.Interaction, button: discord.ui.Button):
+        """Button that displays episodes of the show, one season at a time."""
+        async with AutoDefer(interaction, edit=True) as responder:
+            # Specials are usually listed as season 0, start with the first regular season if there is one
+            first = next((s for s in self.production.seasons if s.season_number > 0), self.production.seasons[0])
+            season = await self.client.get_season(self.production.id, first.season_number)
+            view = TvSeasonView(interaction, season, self)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
+
 
 class PersonBiographyView(PaginatingView):
     """Subview that displays the person's full biography."""
@@ -424,11 +429,96 @@ class ProductionCreditsView(CreditsView):
         return embed
 
 
+class TvSeasonView(PaginatingView):
+    """Subview that displays episodes of a show. Seasons are fetched only once the user selects them."""
+
+    def __init__(
+            self,
+            interaction: discord.Interaction,
+            season: Season,
+            parent_view: TvView,
+            **kwargs,
+    ):
+        super().__init__(interaction, self._paginate_episodes(season), parent_view=parent_view, **kwargs)
+        self.tv = parent_view.production
+        self.client = parent_view.client
+        self.season = season
+        self._populate_select_menu()
+        self._prefetch_next_season()
+
+    @staticmethod
+    def _paginate_episodes(season: Season, episodes_per_page: int = 15) -> list[str]:
+        """Turns episodes into strings for display and splits them into pages."""
+        if not season.episodes:
+            return ['No episodes.']
+        return ['\n'.join(str(episode) for episode in season.episodes[x:x + episodes_per_page])
+                for x in range(0, len(season.episodes), episodes_per_page)]
+
+    def _populate_select_menu(self):
+        # Select menus are limited to 25 options, long-running shows get a window centered on the selected season
+        seasons = self.tv.seasons
+        idx = next(i for i, s in enumerate(seasons) if s.season_number == self.season.season_number)
+        start = max(0, min(idx - 12, len(seasons) - 25))
+        self.season_select.options = []
+        for season in seasons[start:start + 25]:
+            self.season_select.append_option(discord.SelectOption(
+                label=season.name,
+                value=str(season.season_number),
+                description=f'{season.episode_count} episode{"s" if season.episode_count != 1 else ""}',
+                default=season.season_number == self.season.season_number,
+            ))
+
+    def _prefetch_next_season(self):
+        numbers = [s.season_number for s in self.tv.seasons]
+        idx = numbers.index(self.season.season_number)
+        if idx + 1 < len(numbers):
+            self.client.prefetch_season(self.tv.id, numbers[idx + 1])
+
+    def embed(self) -> discord.Embed:
+        """Creates the episode list embed."""
+        embed = discord.Embed(
+            title=f'{self.tv.title} - {self.season.name}',
+            description=self.pages[self.page_index],
+            url=f'{self.tv.web_url}/season/{self.season.season_number}',
+            color=COLOR_EMBED_DARK)
+        if self.season.poster_path:
+            img_config = self.client.img_config
+            embed.set_thumbnail(url=img_config.secure_base_url + img_config.poster_sizes[-1] + self.season.poster_path)
+        embed.set_author(name='SEASONS')
+        embed.set_footer(text=f'Page {self.page_index + 1}/{self.page_count}')
+        return embed
+
+    @discord.ui.select(row=0)
+    @admission_controlled(cinema_admission)
+    async def season_select(self, interaction: discord.Interaction, select: discord.ui.Select):
+        """Menu that allows the user to choose the season."""
+        async with AutoDefer(interaction, edit=True) as responder:
+            self.season = await self.client.get_season(self.tv.id, int(select.values[0]))
+            self.pages = self._paginate_episodes(self.season)
+            self.page_index = 0
+            self.page_count = len(self.pages)
+            self.previous_page.disabled = True
+            self.next_page.disabled = self.page_count == 1
+            self._populate_select_menu()
+            self._prefetch_next_season()
+            await responder.send(
+                embed=self.embed(),
+                view=self,
+            )
+
+
+def unavailable_result_embed(page_index: int, page_count: int) -> discord.Embed:
+    """Stands in for a result of a lazily loaded list that shifted away since the list was first fetched."""
+    embed = discord.Embed(description='This result is no longer on the list.', color=COLOR_EMBED_DARK)
+    embed.set_footer(text=f'Page {page_index + 1}/{page_count}')
+    return embed
+
+
 class ProductionPaginatingView(PaginatingView):
     def __init__(
             self,
             interaction: discord.Interaction,
-            pages: list[Production],
+            pages: list[Production] | TmdbPaginator,
             client: TmdbClient,
             **kwargs,
     ):
@@ -436,8 +526,15 @@ class ProductionPaginatingView(PaginatingView):
         self.client = client
         self.headline = None
 
+    async def load_page(self, page_index: int):
+        if isinstance(self.pages, TmdbPaginator):
+            await self.pages.load(page_index)
+
     def embed(self) -> discord.Embed:
-        selected = self.pages[self.page_index]
+        try:
+            selected = self.pages[self.page_index]
+        except IndexError:
+            return unavailable_result_embed(self.page_index, self.page_count)
         if isinstance(selected, Movie):
             selected.genres = [self.client.movie_genres[genre_id] for genre_id in selected.genre_ids]
             embed = MovieView(self.latest_interaction, selected, self.client).embed()
@@ -454,33 +551,46 @@ class ProductionPaginatingView(PaginatingView):
         return embed
 
     @discord.ui.button(label='MORE', style=discord.ButtonStyle.blurple, row=1)
+    @admission_controlled(cinema_admission)
     async def more(self, interaction: discord.Interaction, button: discord.ui.Button):
-        selected = self.pages[self.page_index]
-        if isinstance(selected, Movie):
-            production = await self.client.get_movie(selected.id)
-            view = MovieView(interaction, production, self.client)
-        elif isinstance(selected, Tv):
-            production = await self.client.get_tv(selected.id)
-            view = TvView(interaction, production, self.client)
-        else:
-            raise RuntimeError('Object has to be an instance of Production.')
-        embed = view.embed()
-        await interaction.response.edit_message(view=view, embed=embed)
+        async with AutoDefer(interaction, edit=True) as responder:
+            try:
+                selected = self.pages[self.page_index]
+            except IndexError:
+                await responder.send(view=self, embed=self.embed())
+                return
+            if isinstance(selected, Movie):
+                production = await self.client.get_movie(selected.id)
+                view = MovieView(interaction, production, self.client)
+            elif isinstance(selected, Tv):
+                production = await self.client.get_tv(selected.id)
+                view = TvView(interaction, production, self.client)
+            else:
+                raise RuntimeError('Object has to be an instance of Production.')
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
 
 class PersonPaginatingView(PaginatingView):
     def __init__(
             self,
             interaction: discord.Interaction,
-            pages: list[Person],
+            pages: list[Person] | TmdbPaginator,
             client: TmdbClient,
             **kwargs,
     ):
         super().__init__(interaction, pages, **kwargs)
         self.client = client
 
+    async def load_page(self, page_index: int):
+        if isinstance(self.pages, TmdbPaginator):
+            await self.pages.load(page_index)
+
     def embed(self) -> discord.Embed:
-        selected = self.pages[self.page_index]
+        try:
+            selected = self.pages[self.page_index]
+        except IndexError:
+            return unavailable_result_embed(self.page_index, self.page_count)
         desc = f"**Known for: {selected.known_for_department if selected.known_for_department else '-'}**"
         known_for = '\n'.join(
             [f'[{p.title} ({p.release_date.year})]({p.web_url})' for p in selected.known_for])
@@ -499,12 +609,18 @@ class PersonPaginatingView(PaginatingView):
         return embed
 
     @discord.ui.button(label='MORE', style=discord.ButtonStyle.blurple, row=1)
+    @admission_controlled(cinema_admission)
     async def more(self, interaction: discord.Interaction, button: discord.ui.Button):
-        selected = self.pages[self.page_index]
-        person = await self.client.get_person(selected.id)
-        view = PersonView(interaction, person, self.client)
-        embed = view.embed()
-        await interaction.response.edit_message(view=view, embed=embed)
+        async with AutoDefer(interaction, edit=True) as responder:
+            try:
+                selected = self.pages[self.page_index]
+            except IndexError:
+                await responder.send(view=self, embed=self.embed())
+                return
+            person = await self.client.get_person(selected.id)
+            view = PersonView(interaction, person, self.client)
+            embed = view.embed()
+            await responder.send(view=view, embed=embed)
 
 
 class ProductionRecommendationView(ProductionPaginatingView):
@@ -1,5 +1,9 @@
 from discord.ext import commands
 
+from cogs.reminder.helpers import TransferFormat
+from cogs.reminder.transfer import TransferError, export_file, import_reminders, read_attachment
+from utils.metrics import metrics
+
 
 class OwnerCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -11,3 +15,38 @@ class OwnerCog(commands.Cog):
         """Syncs slash commands globally"""
         synced = await ctx.bot.tree.sync()
         await ctx.send(f"Synced {len(synced)} commands globally.")
+
+    @commands.command(name='metrics')
+    @commands.is_owner()
+    async def show_metrics(self, ctx: commands.Context, prefix: str = ''):
+        """Displays current values of internal metrics, optionally only those whose names start with the prefix"""
+        text = metrics.render(prefix) or 'No metrics recorded yet.'
+        # Leave room for the code block markers within the 2000 characters limit
+        await ctx.send(f'```\n{text[:1990]}\n```')
+
+    @commands.command(name='export_reminders')
+    @commands.is_owner()
+    async def export_all_reminders(self, ctx: commands.Context, file_format: str = 'csv'):
+        """Exports everyone's reminders to a file, in csv or ics format"""
+        try:
+            file_format = TransferFormat(file_format)
+        except ValueError:
+            await ctx.send('Format should be csv or ics.')
+            return
+        await ctx.send(file=await export_file(file_format))
+
+    @commands.command(name='import_reminders')
+    @commands.is_owner()
+    async def import_all_reminders(self, ctx: commands.Context):
+        """Imports reminders of any users from an attached file, in the format of `export_reminders`"""
+        if not ctx.message.attachments:
+            await ctx.send('Attach a csv or ics file to import.')
+            return
+        try:
+            imported, skipped = await import_reminders(await read_attachment(ctx.message.attachments[0]))
+        except TransferError as e:
+            await ctx.send(f'Error: {e}')
+            return
+        if reminder_cog := self.bot.get_cog('ReminderCog'):
+            reminder_cog.scheduler.reload()
+        await ctx.send(f'Imported {imported} reminders, skipped {skipped} that are past due.')
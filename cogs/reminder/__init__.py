@@ -1,6 +1,19 @@
+import logging
+import os
+
 from run import Sphynx
 from .cog import ReminderCog
+from .helpers import MissedReminderPolicy
+
+_log = logging.getLogger(__name__)
 
 
 async def setup(bot: Sphynx):
-    await bot.add_cog(ReminderCog(bot))
+    env_var = 'SPHYNX_MISSED_REMINDERS'
+    try:
+        missed_policy = MissedReminderPolicy(os.environ.get(env_var, MissedReminderPolicy.fire.value))
+    except ValueError:
+        _log.warning(f'"{env_var}" should be one of: {", ".join(p.value for p in MissedReminderPolicy)}. '
+                     f'Missed reminders will be fired.')
+        missed_policy = MissedReminderPolicy.fire
+    await bot.add_cog(ReminderCog(bot, missed_policy))
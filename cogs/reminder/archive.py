@@ -0,0 +1,104 @@
+import datetime as dt
+import re
+
+from tortoise import connections
+
+# Fired reminders are copied to `reminder_archive` (Postgres only, created by `utils.migrations`), which is partitioned
+# by month of firing. Partitions are created as they're needed, and dropped whole once they get older than the
+# retention period, which is a lot cheaper than deleting their rows. `reminder` itself only holds pending reminders.
+# Reminders dropped by the skip missed reminder policy (see `queries.skip_missed_reminders`) never fired, so they aren't
+# archived.
+# Fired reminders still leased to $2 are copied right before they're deleted or moved, in the same transaction
+# (see `store.PostgresReminderStore.complete`), $3 being the ones that couldn't be delivered and $4 the time of firing.
+ARCHIVE_FIRED = """
+INSERT INTO reminder_archive (
+    reminder_id, user_id, guild_id, channel_id, reminder_type, target_time, description, fired_at, delivered
+)
+SELECT id, user_id, guild_id, channel_id, reminder_type, target_time, description, $4, NOT (id = ANY($3::int[]))
+FROM reminder
+WHERE id = ANY($1::int[]) AND lease_owner = $2
+"""
+
+# Reminders fired during a month that has no partition yet (e.g. because creating it failed) end up in the default
+# partition, they're moved to the month's partition once it gets created. Instances creating the same partition at once
+# take turns. Bounds are given in UTC, as they'd be read in the session's time zone otherwise.
+_CREATE_PARTITION = """
+DO $$
+BEGIN
+    PERFORM pg_advisory_xact_lock({lock_key});
+    IF to_regclass('{name}') IS NULL THEN
+        CREATE TABLE {name} (LIKE reminder_archive);
+        WITH moved AS (
+            DELETE FROM reminder_archive_default
+            WHERE fired_at >= '{start} 00:00+00' AND fired_at < '{end} 00:00+00'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved;
+        ALTER TABLE reminder_archive ATTACH PARTITION {name} FOR VALUES FROM ('{start} 00:00+00') TO ('{end} 00:00+00');
+    END IF;
+END
+$$
+"""
+
+# Arbitrary key of the advisory lock held while creating a partition
+_PARTITION_LOCK_KEY = 0x5048594E59
+
+_PRUNE_DEFAULT = 'DELETE FROM reminder_archive_default WHERE fired_at < $1'
+
+_PARTITIONS = """
+SELECT child.relname AS name
+FROM pg_inherits
+JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+WHERE parent.relname = 'reminder_archive'
+"""
+
+_PARTITION_NAME = re.compile(r'^reminder_archive_(\d{4})_(\d{2})$')
+
+# Months that are known to have a partition, so that archiving doesn't have to check every time. Forgotten by
+# `forget_partitions`, in case they were dropped behind the bot's back.
+_partitions: set[dt.date] = set()
+
+
+def month_start(value: dt.datetime | dt.date) -> dt.date:
+    return dt.date(value.year, value.month, 1)
+
+
+def next_month(month: dt.date) -> dt.date:
+    return dt.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month: dt.date) -> str:
+    return f'reminder_archive_{month.year:04}_{month.month:02}'
+
+
+async def ensure_partition(month: dt.date) -> None:
+    """Creates the archive partition holding reminders fired during the month, unless it already exists."""
+    month = month_start(month)
+    if month in _partitions:
+        return
+    await connections.get('default').execute_script(_CREATE_PARTITION.format(
+        lock_key=_PARTITION_LOCK_KEY, name=partition_name(month), start=month, end=next_month(month)))
+    _partitions.add(month)
+
+
+def forget_partitions() -> None:
+    """Makes `ensure_partition` check again whether partitions exist."""
+    _partitions.clear()
+
+
+async def drop_partitions(older_than: dt.datetime) -> list[str]:
+    """Drops archive partitions whose every reminder was fired before `older_than`, and deletes reminders fired before
+    then from the default partition. Returns the names of the dropped partitions."""
+    conn = connections.get('default')
+    await conn.execute_query(_PRUNE_DEFAULT, [older_than])
+    dropped = []
+    for row in await conn.execute_query_dict(_PARTITIONS):
+        if (match := _PARTITION_NAME.match(row['name'])) is None:
+            continue
+        month = dt.date(int(match[1]), int(match[2]), 1)
+        if next_month(month) <= older_than.date():
+            await conn.execute_script(f'DROP TABLE IF EXISTS {row["name"]}')
+            _partitions.discard(month)
+            dropped.append(row['name'])
+    return sorted(dropped)
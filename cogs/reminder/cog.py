@@ -1,32 +1,91 @@
+import asyncio
+import collections
 import datetime as dt
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import logging
+import os
+import socket
+import uuid
+from zoneinfo import ZoneInfoNotFoundError
 
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
-from cogs.shared_models import User
+from cogs.shared_reachability import dm_reachability
+from cogs.shared_registry import user_registry
 from run import Sphynx
-from utils.misc import dm_open, get_timezones, next_datetime
-from .helpers import ReminderChannel, ReminderType
+from utils.interactions import AutoDefer
+from utils.metrics import metrics
+from utils.misc import next_datetime, pack_messages
+from utils.timezones import get_timezone_index, get_zone
+from .archive import drop_partitions, ensure_partition, forget_partitions, month_start, next_month
+from .helpers import ReminderChannel, ReminderType, MissedReminderPolicy, TransferFormat, REMINDER_STAGES, \
+    next_daily_occurrence, stage_timer
 from .models import Reminder
+from .notifications import ReminderChangeListener
+from .queries import ReminderPaginator, is_postgres, skip_missed_reminders
+from .scheduler import ReminderScheduler
+from .store import DueReminder, PostgresReminderStore, ReminderStore
+from .transfer import TransferError, export_file, import_reminders, read_attachment
 from .views import ReminderView
 
+_log = logging.getLogger(__name__)
+
 
 async def timezone_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-    return [app_commands.Choice(name=tz, value=tz) for tz in get_timezones() if current.lower() in tz.lower()][:25]
+    index = get_timezone_index()
+    return [app_commands.Choice(name=index.label(tz), value=tz) for tz in index.search(current)]
 
 
 class ReminderCog(commands.GroupCog, group_name='reminder'):
-    def __init__(self, bot: Sphynx):
+    # Reminders due at the same time are fired together, sending to at most this many destinations at once
+    batch_size = 500
+    max_concurrent_sends = 16
+    # Reminders due this soon after the first one are fired with it, to be combined with others going to the same place
+    coalesce_window = dt.timedelta(seconds=2)
+    # How long claimed reminders are reserved for this instance, see `queries.claim_due_reminders`
+    lease = dt.timedelta(minutes=5)
+    # Firing is retried after failures (e.g. the database being unreachable), waiting twice as long after each one
+    error_backoff = dt.timedelta(seconds=1)
+    max_error_backoff = dt.timedelta(minutes=1)
+    # Limits of `/reminder import`, the bot owner can import any amount with the `import_reminders` text command
+    max_import_size = 1024 * 1024
+    max_imported = 1000
+    # How long fired reminders are kept in the archive (Postgres only), see `archive`
+    archive_retention = dt.timedelta(days=365)
+    # How often latency percentiles are written to the log, see `helpers.REMINDER_STAGES`
+    latency_summary_interval = dt.timedelta(minutes=15)
+
+    def __init__(self, bot: Sphynx, missed_policy: MissedReminderPolicy = MissedReminderPolicy.fire):
         self.bot = bot
+        self.missed_policy = missed_policy
+        self._caught_up = asyncio.Event()
+        self._consecutive_failures = 0
+        self.store = ReminderStore()
+        self.scheduler = ReminderScheduler(self.store)
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
         self.check_reminders.start()
+        self.reclaim_reminders.change_interval(seconds=self.lease.total_seconds())
+        self.reclaim_reminders.start()
+        self.maintain_archive.start()
+        self._summarized_outcomes = (0, 0, 0)
+        self.log_latency.change_interval(seconds=self.latency_summary_interval.total_seconds())
+        self.log_latency.start()
+        self.listener = ReminderChangeListener(self.scheduler)
 
-    def _update_reminder_check(self) -> None:
-        if self.check_reminders.is_running():
-            self.check_reminders.restart()
-        else:
-            self.check_reminders.start()
+    async def cog_load(self):
+        # Built now rather than on the first keystroke of someone typing a timezone
+        get_timezone_index()
+        if is_postgres():
+            self.store = self.scheduler.store = PostgresReminderStore()
+            self.listener.start()
+
+    async def cog_unload(self):
+        self.check_reminders.cancel()
+        self.reclaim_reminders.cancel()
+        self.maintain_archive.cancel()
+        self.log_latency.cancel()
+        await self.listener.close()
 
     async def _reminder_add(
             self,
@@ -37,37 +96,38 @@ class ReminderCog(commands.GroupCog, group_name='reminder'):
             target_time: dt.datetime
     ):
         """Adds a new reminder."""
-        time_now = discord.utils.utcnow()
-        if len(description) > 2048:
-            await interaction.response.send_message('Error: Description too long. Max length is 2048.', ephemeral=True)
-            return
-        if (target_time - time_now).total_seconds() < 60:
-            await interaction.response.send_message(
-                'Error: Reminder should be set no less than a minute from now.', ephemeral=True)
-            return
-        if location == ReminderChannel.dm and not await dm_open(interaction.user):
-            await interaction.response.send_message('Error: You do not accept direct messages.', ephemeral=True)
-            return
-        guild_id = interaction.guild_id if location == ReminderChannel.here else None
-        channel_id = interaction.channel_id if location == ReminderChannel.here else None
-        user, _ = await User.get_or_create(id=interaction.user.id)
-        await Reminder.create(
-            user=user,
-            guild_id=guild_id,
-            channel_id=channel_id,
-            reminder_type=reminder_type,
-            target_time=target_time,
-            description=description
-        )
-        epoch = int(target_time.timestamp())
-        await interaction.response.send_message(
-            f"Reminder set!\n"
-            f"Date: <t:{epoch}:F> (<t:{epoch}:R>)\n"
-            f"Type: {reminder_type.name}\n"
-            f"Location: **{location.name}**\n",
-            ephemeral=True
-        )
-        self._update_reminder_check()
+        async with AutoDefer(interaction, ephemeral=True) as responder:
+            time_now = discord.utils.utcnow()
+            if len(description) > 2048:
+                await responder.send('Error: Description too long. Max length is 2048.', ephemeral=True)
+                return
+            if (target_time - time_now).total_seconds() < 60:
+                await responder.send(
+                    'Error: Reminder should be set no less than a minute from now.', ephemeral=True)
+                return
+            if location == ReminderChannel.dm and not await dm_reachability.is_open(interaction.user):
+                await responder.send('Error: You do not accept direct messages.', ephemeral=True)
+                return
+            guild_id = interaction.guild_id if location == ReminderChannel.here else None
+            channel_id = interaction.channel_id if location == ReminderChannel.here else None
+            await user_registry.ensure(interaction.user.id)
+            reminder = await Reminder.create(
+                user_id=interaction.user.id,
+                guild_id=guild_id,
+                channel_id=channel_id,
+                reminder_type=reminder_type,
+                target_time=target_time,
+                description=description
+            )
+            self.scheduler.add(reminder.id, reminder.target_time)
+            epoch = int(target_time.timestamp())
+            await responder.send(
+                f"Reminder set!\n"
+                f"Date: <t:{epoch}:F> (<t:{epoch}:R>)\n"
+                f"Type: {reminder_type.name}\n"
+                f"Location: **{location.name}**\n",
+                ephemeral=True
+            )
 
     @app_commands.command()
     @app_commands.describe(
@@ -108,7 +168,7 @@ class ReminderCog(commands.GroupCog, group_name='reminder'):
     ):
         """Sets a reminder scheduled for a chosen date."""
         try:
-            target_time = dt.datetime.strptime(when, '%Y/%m/%d %H:%M').replace(tzinfo=ZoneInfo(timezone))
+            target_time = dt.datetime.strptime(when, '%Y/%m/%d %H:%M').replace(tzinfo=get_zone(timezone))
         except ValueError:
             await interaction.response.send_message('Error: Malformed date.', ephemeral=True)
         except ZoneInfoNotFoundError:
@@ -134,8 +194,8 @@ class ReminderCog(commands.GroupCog, group_name='reminder'):
     ):
         """Sets a reminder scheduled to repeat each day."""
         try:
-            target_time = dt.datetime.strptime(when, '%H:%M').replace(tzinfo=ZoneInfo(timezone))
-            target_time = next_datetime(dt.datetime.now(tz=ZoneInfo(timezone)), target_time.hour, target_time.minute)
+            target_time = dt.datetime.strptime(when, '%H:%M').replace(tzinfo=get_zone(timezone))
+            target_time = next_datetime(dt.datetime.now(tz=get_zone(timezone)), target_time.hour, target_time.minute)
         except ValueError:
             await interaction.response.send_message('Error: Malformed time.', ephemeral=True)
         except ZoneInfoNotFoundError:
@@ -144,44 +204,263 @@ class ReminderCog(commands.GroupCog, group_name='reminder'):
             await self._reminder_add(interaction, ReminderType.daily, description, location, target_time)
 
     @app_commands.command()
-    async def display(self, interaction: discord.Interaction):
+    @app_commands.describe(
+        reminder_type='Only display reminders of this type',
+        location='Only display reminders sent to this location'
+    )
+    async def display(
+            self,
+            interaction: discord.Interaction,
+            reminder_type: ReminderType | None = None,
+            location: ReminderChannel | None = None
+    ):
         """Displays currently set reminders."""
-        reminders = await Reminder.filter(user_id=interaction.user.id).order_by('target_time')
-        if not reminders:
-            await interaction.response.send_message("No reminders set right now.", ephemeral=True)
-        else:
-            view = ReminderView(interaction, reminders)
-            embed = view.embed()
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+        async with AutoDefer(interaction, ephemeral=True) as responder:
+            reminders = ReminderPaginator(interaction.user.id, reminder_type=reminder_type, location=location)
+            await reminders.start()
+            if not reminders:
+                await responder.send("No reminders set right now.", ephemeral=True)
+            else:
+                view = ReminderView(interaction, reminders)
+                embed = view.embed()
+                await responder.send(embed=embed, view=view, ephemeral=True)
 
     @app_commands.command()
     @app_commands.describe(reminder_id='ID of the reminder you wish to delete')
     async def delete(self, interaction: discord.Interaction, reminder_id: int):
         """Deletes a reminder."""
-        deleted = await Reminder.filter(id=reminder_id, user_id=interaction.user.id).delete()
-        if deleted:
-            await interaction.response.send_message(f"Reminder deleted!", ephemeral=True)
-            self._update_reminder_check()
+        async with AutoDefer(interaction, ephemeral=True) as responder:
+            deleted = await Reminder.filter(id=reminder_id, user_id=interaction.user.id).delete()
+            if deleted:
+                self.scheduler.cancel(reminder_id)
+                await responder.send(f"Reminder deleted!", ephemeral=True)
+            else:
+                await responder.send(f"Cannot delete: Reminder does not exist!", ephemeral=True)
+
+    @app_commands.command(name='export')
+    @app_commands.describe(file_format='Format of the file [default: csv]')
+    async def export_reminders(
+            self,
+            interaction: discord.Interaction,
+            file_format: TransferFormat = TransferFormat.csv
+    ):
+        """Exports your reminders to a file."""
+        async with AutoDefer(interaction, ephemeral=True) as responder:
+            await responder.send(file=await export_file(file_format, interaction.user.id), ephemeral=True)
+
+    @app_commands.command(name='import')
+    @app_commands.describe(
+        file='CSV file in the format used by exports, or an iCalendar (.ics) file',
+        location='Where to send the imported reminders [default: here]'
+    )
+    async def import_reminders(
+            self,
+            interaction: discord.Interaction,
+            file: discord.Attachment,
+            location: ReminderChannel = ReminderChannel.here
+    ):
+        """Imports reminders from a file."""
+        async with AutoDefer(interaction, ephemeral=True) as responder:
+            if file.size > self.max_import_size:
+                await responder.send(
+                    f'Error: File too big. Max size is {self.max_import_size // 1024} KB.', ephemeral=True)
+                return
+            if location == ReminderChannel.dm and not await dm_reachability.is_open(interaction.user):
+                await responder.send('Error: You do not accept direct messages.', ephemeral=True)
+                return
+            try:
+                imported, skipped = await import_reminders(
+                    await read_attachment(file),
+                    user_id=interaction.user.id,
+                    guild_id=interaction.guild_id if location == ReminderChannel.here else None,
+                    channel_id=interaction.channel_id if location == ReminderChannel.here else None,
+                    limit=self.max_imported,
+                )
+            except TransferError as e:
+                await responder.send(f'Error: {e}', ephemeral=True)
+                return
+            self.scheduler.reload()
+            await responder.send(f'Imported {imported} reminders, skipped {skipped} that are past due.', ephemeral=True)
+
+    async def _send_reminders(self, reminders: list[DueReminder]) -> bool:
+        """Sends reminders going to the same place, combined into as few messages as possible. Returns False if they
+        couldn't be delivered because the user doesn't accept DMs."""
+        first = reminders[0]
+        messages = pack_messages([f"<@{reminder.user_id}>\n{reminder.description}" for reminder in reminders])
+        if first.channel_id:
+            with stage_timer('resolve'):
+                channel = await self.bot.maybe_fetch_channel(first.channel_id)
+            with stage_timer('send'):
+                for message in messages:
+                    await channel.send(message)
         else:
-            await interaction.response.send_message(f"Cannot delete: Reminder does not exist!", ephemeral=True)
+            with stage_timer('resolve'):
+                user = await self.bot.maybe_fetch_user(first.user_id)
+            with stage_timer('send'):
+                for message in messages:
+                    if not await dm_reachability.send(user, message):
+                        metrics.counter('reminder_undeliverable_total').inc(len(reminders))
+                        return False
+        time_now = discord.utils.utcnow()
+        drift = metrics.histogram('reminder_drift_seconds')
+        for reminder in reminders:
+            drift.observe((time_now - reminder.target_time).total_seconds())
+        return True
+
+    async def _dispatch(self, reminders: list[DueReminder]) -> None:
+        """Sends reminders concurrently, then deletes the fired single reminders and moves daily ones to the next day.
+        On Postgres fired reminders are archived first.
+
+        Reminders going to the same channel (or the same user's DMs) are combined, to go easy on Discord's rate limits.
+        A reminder that fails to send is logged and completed all the same, so that it doesn't keep coming back.
+        """
+        destinations = collections.defaultdict(list)
+        for reminder in reminders:
+            destination = ('channel', reminder.channel_id) if reminder.channel_id else ('user', reminder.user_id)
+            destinations[destination].append(reminder)
+        semaphore = asyncio.Semaphore(self.max_concurrent_sends)
+
+        async def send(grouped: list[DueReminder]) -> bool:
+            async with semaphore:
+                return await self._send_reminders(grouped)
+
+        groups = list(destinations.values())
+        results = await asyncio.gather(*(send(grouped) for grouped in groups), return_exceptions=True)
+        undelivered = []
+        sent = 0
+        for grouped, result in zip(groups, results):
+            if isinstance(result, Exception):
+                metrics.counter('reminder_failures_total').inc(len(grouped))
+                _log.warning(f'Failed to send reminders {[reminder.id for reminder in grouped]}: {result!r}')
+            if isinstance(result, Exception) or result is False:
+                undelivered.extend(reminder.id for reminder in grouped)
+            else:
+                sent += len(grouped)
+        # Daily reminders are grouped by their next target time, which is what the ORM store updates them by
+        time_now = discord.utils.utcnow()
+        daily = collections.defaultdict(list)
+        for reminder in reminders:
+            if reminder.reminder_type == ReminderType.daily:
+                daily[next_daily_occurrence(reminder.target_time, time_now)].append(reminder.id)
+        single = [reminder.id for reminder in reminders if reminder.reminder_type == ReminderType.single]
+        with stage_timer('complete'):
+            await self.store.complete(self.worker_id, single, daily, undelivered)
+        for target_time, ids in daily.items():
+            for reminder_id in ids:
+                self.scheduler.add(reminder_id, target_time)
+        metrics.counter('reminder_sent_total').inc(sent)
+
+    async def _dispatch_claimed(self, reminder_ids: list[int]) -> None:
+        for reminder_id in reminder_ids:
+            self.scheduler.cancel(reminder_id)
+        for i in range(0, len(reminder_ids), self.batch_size):
+            with stage_timer('load'):
+                reminders = await self.store.load(reminder_ids[i:i + self.batch_size])
+            await self._dispatch(reminders)
+
+    async def _claim_and_dispatch(self, grace: dt.timedelta) -> int:
+        """Fires every reminder due within `grace` that no other instance of the bot is firing, in batches. Each batch
+        is claimed only once the previous one is done, so that its lease doesn't run out while waiting. Returns the
+        amount of reminders fired."""
+        fired = 0
+        while True:
+            with stage_timer('claim'):
+                reminder_ids = await self.store.claim(self.worker_id, self.batch_size, self.lease, grace)
+            if reminder_ids:
+                await self._dispatch_claimed(reminder_ids)
+            fired += len(reminder_ids)
+            if len(reminder_ids) < self.batch_size:
+                return fired
+
+    async def _catch_up(self) -> None:
+        """Handles reminders that should have fired while the bot was offline, according to the missed reminder
+        policy: either fires each of them once, or skips them."""
+        try:
+            if self.missed_policy == MissedReminderPolicy.skip:
+                skipped, moved = await skip_missed_reminders()
+                _log.info(f'Skipped {skipped} missed reminders, '
+                          f'moved {moved} daily reminders to their next occurrence.')
+            else:
+                fired = await self._claim_and_dispatch(dt.timedelta(0))
+                _log.info(f'Fired {fired} missed reminders.')
+        finally:
+            # Reclaiming may start even if catching up failed, whatever is left is due and gets fired regularly
+            self._caught_up.set()
 
     @tasks.loop()
     async def check_reminders(self):
-        next_reminder = await Reminder.all().order_by('target_time').first()
-        if next_reminder is None:
-            self.check_reminders.cancel()
-            return
-        await discord.utils.sleep_until(next_reminder.target_time)
-        reminder = f"<@{next_reminder.user_id}>\n{next_reminder.description}"
-        if next_reminder.channel_id:
-            channel = await self.bot.maybe_fetch_channel(next_reminder.channel_id)
-            await channel.send(reminder)
-        else:
-            user = await self.bot.maybe_fetch_user(next_reminder.user_id)
-            if await dm_open(user):
-                await user.send(reminder)
-        if next_reminder.reminder_type.value == next_reminder.reminder_type.daily:
-            new_target_time = next_reminder.target_time + dt.timedelta(days=1)
-            await Reminder.filter(id=next_reminder.id).update(target_time=new_target_time)
+        """Fires reminders as the scheduler finds them due. Reminders it doesn't know about, if any, are left to
+        `reclaim_reminders`."""
+        try:
+            reminder_ids = await self.scheduler.next_due(limit=self.batch_size, grace=self.coalesce_window)
+            # Claimed by id, so that the database's clock running behind the bot's doesn't hold them back
+            due_before = discord.utils.utcnow() + self.coalesce_window
+            with stage_timer('claim'):
+                reminder_ids = await self.store.claim_ids(self.worker_id, reminder_ids, self.lease, due_before)
+            if reminder_ids:
+                await self._dispatch_claimed(reminder_ids)
+        except Exception:
+            # The loop would stop for good otherwise, as it's only restarted after network errors
+            self._consecutive_failures += 1
+            backoff = min(self.error_backoff * 2 ** (self._consecutive_failures - 1), self.max_error_backoff)
+            _log.exception(f'Failed to fire due reminders, retrying in {backoff.total_seconds():g} s.')
+            await asyncio.sleep(backoff.total_seconds())
         else:
-            await next_reminder.delete()
+            self._consecutive_failures = 0
+
+    @check_reminders.before_loop
+    async def before_check_reminders(self):
+        await self.bot.wait_until_ready()
+        try:
+            await self._catch_up()
+        except Exception:
+            _log.exception('Failed to handle reminders missed during downtime.')
+
+    @tasks.loop(minutes=5)
+    async def reclaim_reminders(self):
+        """Fires reminders left behind by instances that stopped before completing them, once their lease expires, and
+        any other due reminder the scheduler missed."""
+        try:
+            await self._claim_and_dispatch(self.coalesce_window)
+        except Exception:
+            # Like `check_reminders`, the loop would stop for good otherwise. Its next run comes soon enough to retry.
+            _log.exception('Failed to reclaim due reminders.')
+
+    @reclaim_reminders.before_loop
+    async def before_reclaim_reminders(self):
+        await self._caught_up.wait()
+
+    @tasks.loop(minutes=15)
+    async def log_latency(self):
+        """Logs how late reminders were sent and how long each stage of firing them took, if any were fired lately."""
+        try:
+            outcomes = tuple(metrics.counter(f'reminder_{outcome}_total').value
+                             for outcome in ('sent', 'failures', 'undeliverable'))
+            if outcomes == self._summarized_outcomes:
+                return
+            self._summarized_outcomes = outcomes
+            sent, failed, undeliverable = outcomes
+            lines = [f'Reminders sent: {sent}, failed: {failed}, undeliverable: {undeliverable}',
+                     f'  lag (s): {metrics.histogram("reminder_drift_seconds").summary()}']
+            lines += [f'  {stage} (s): {metrics.histogram("reminder_stage_seconds", stage=stage).summary()}'
+                      for stage in REMINDER_STAGES]
+            _log.info('\n'.join(lines))
+        except Exception:
+            # The loop would stop for good otherwise, as it's only restarted after network errors
+            _log.exception('Failed to summarize reminder latencies.')
+
+    @tasks.loop(hours=24)
+    async def maintain_archive(self):
+        """Creates archive partitions ahead of time and drops the ones past the retention period."""
+        if not is_postgres():
+            return
+        forget_partitions()
+        try:
+            this_month = month_start(discord.utils.utcnow())
+            await ensure_partition(this_month)
+            await ensure_partition(next_month(this_month))
+            if dropped := await drop_partitions(discord.utils.utcnow() - self.archive_retention):
+                _log.info(f'Dropped archive partitions: {", ".join(dropped)}.')
+        except Exception:
+            # The loop would stop for good otherwise, as it's only restarted after network errors
+            _log.exception('Failed to maintain the reminder archive, retrying tomorrow.')
@@ -1,5 +1,9 @@
+import datetime as dt
+import math
 from enum import Enum, IntEnum
 
+from utils.metrics import metrics
+
 
 class ReminderChannel(Enum):
     here = 1
@@ -9,3 +13,31 @@ class ReminderChannel(Enum):
 class ReminderType(IntEnum):
     single = 1
     daily = 2
+
+
+class TransferFormat(Enum):
+    csv = 'csv'
+    ical = 'ics'
+
+
+class MissedReminderPolicy(Enum):
+    """What to do with reminders that should have fired while the bot was offline."""
+    fire = 'fire'
+    skip = 'skip'
+
+
+def next_daily_occurrence(target_time: dt.datetime, now: dt.datetime) -> dt.datetime:
+    """Returns the first time after `now` that a daily reminder set for `target_time` is due again."""
+    days = math.floor((now - target_time) / dt.timedelta(days=1)) + 1
+    return target_time + dt.timedelta(days=max(days, 1))
+
+
+# Stages of firing a reminder, each timed under ``reminder_stage_seconds{stage=...}`` in `utils.metrics.metrics`:
+# leasing due reminders, loading them, fetching the channel or user to send to, sending, and deleting or moving them.
+# How late reminders were sent compared to their target time is recorded under ``reminder_drift_seconds``.
+REMINDER_STAGES = ('claim', 'load', 'resolve', 'send', 'complete')
+
+
+def stage_timer(stage: str):
+    """Times the enclosed block as a stage of firing reminders."""
+    return metrics.histogram('reminder_stage_seconds', stage=stage).time()
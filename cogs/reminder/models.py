@@ -12,3 +12,6 @@ class Reminder(Model):
     reminder_type = fields.IntEnumField(ReminderType)
     target_time = fields.DatetimeField()
     description = fields.CharField(2048)
+    # Set while an instance of the bot is firing the reminder, see `queries.claim_due_reminders`
+    lease_owner = fields.CharField(64, null=True)
+    lease_expires_at = fields.DatetimeField(null=True)
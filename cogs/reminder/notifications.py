@@ -0,0 +1,85 @@
+import asyncio
+import datetime as dt
+import json
+import logging
+
+import asyncpg
+from tortoise import connections
+
+from .queries import REMINDER_CHANNEL
+from .scheduler import ReminderScheduler
+
+_log = logging.getLogger(__name__)
+
+
+class ReminderChangeListener:
+    """Keeps the scheduler up to date with changes to reminders made by other instances of the bot, scripts, imports
+    and so on, as reported by Postgres notifications.
+
+    Listening requires a connection of its own, opened with the parameters of the default Tortoise connection. If it
+    gets lost, the scheduler reloads reminders from the database once reconnected, as changes made in the meantime went
+    unreported.
+    """
+
+    def __init__(self, scheduler: ReminderScheduler, retry_delay: float = 5.0):
+        self.scheduler = scheduler
+        self.retry_delay = retry_delay
+        self._task: asyncio.Task | None = None
+        self._listened = False
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._stopped)
+
+    @staticmethod
+    def _stopped(task: asyncio.Task) -> None:
+        if not task.cancelled() and (e := task.exception()) is not None:
+            _log.error('Stopped listening for reminder changes, changes made elsewhere are only picked up when the '
+                       'scheduler reloads.', exc_info=e)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def handle(self, payload: str) -> None:
+        change = json.loads(payload)
+        if change.get('target_time') is None:
+            self.scheduler.cancel(change['id'])
+        else:
+            target_time = dt.datetime.fromtimestamp(change['target_time'], tz=dt.timezone.utc)
+            self.scheduler.add(change['id'], target_time)
+
+    def _on_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            self.handle(payload)
+        except (ValueError, KeyError, TypeError):
+            _log.warning(f'Malformed reminder notification: {payload!r}')
+
+    async def _listen(self, client, reload: bool) -> None:
+        """Listens for notifications until the connection is lost."""
+        lost = asyncio.Event()
+        connection = await asyncpg.connect(
+            host=client.host, port=client.port, user=client.user, password=client.password, database=client.database)
+        try:
+            connection.add_termination_listener(lambda _: lost.set())
+            await connection.add_listener(REMINDER_CHANNEL, self._on_notification)
+            self._listened = True
+            if reload:
+                self.scheduler.reload()
+            _log.info('Listening for reminder changes.')
+            await lost.wait()
+            _log.warning('Lost connection listening for reminder changes.')
+        finally:
+            await connection.close(timeout=self.retry_delay)
+
+    async def _run(self) -> None:
+        client = connections.get('default')
+        while True:
+            try:
+                # Changes made while not listening went unreported, unless it's the first time
+                await self._listen(client, reload=self._listened)
+            except Exception as e:
+                # Anything going wrong here is worth another try, the scheduler would be left outdated otherwise
+                _log.warning(f'Failed to listen for reminder changes: {e!r}')
+            await asyncio.sleep(self.retry_delay)
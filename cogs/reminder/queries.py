@@ -0,0 +1,247 @@
+import asyncio
+import datetime as dt
+import functools
+
+import discord
+from tortoise import connections
+from tortoise.expressions import Q
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
+
+from .helpers import ReminderChannel, ReminderType, next_daily_occurrence
+from .models import Reminder
+
+# Several instances of the bot can share the same database. To make sure that each reminder is fired by only one of
+# them, due reminders are leased: the instance that claims them marks them as its own for a while. Rows being claimed
+# by another instance at the same time are skipped instead of waited for. If an instance dies before completing its
+# reminders, they can be claimed again once the lease expires.
+CLAIM_POSTGRES = """
+UPDATE reminder
+SET lease_owner = $1, lease_expires_at = now() + $2 * interval '1 second'
+WHERE id IN (
+    SELECT id FROM reminder
+    WHERE target_time <= now() + $3 * interval '1 second'
+      AND (lease_expires_at IS NULL OR lease_expires_at < now())
+    ORDER BY target_time
+    LIMIT $4
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id
+"""
+
+# Same, for reminders the scheduler found due. Whether they're due was decided by the clock of the bot, the database's
+# clock isn't consulted for that so that skew between the two doesn't matter. Reminders fired and moved to a later time
+# by another instance in the meantime are left alone.
+CLAIM_IDS_POSTGRES = """
+UPDATE reminder
+SET lease_owner = $1, lease_expires_at = now() + $2 * interval '1 second'
+WHERE id IN (
+    SELECT id FROM reminder
+    WHERE id = ANY($3::int[])
+      AND target_time <= $4
+      AND (lease_expires_at IS NULL OR lease_expires_at < now())
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id
+"""
+
+# Other databases (SQLite in tests) are only ever used by a single instance, so no row locking is needed
+_CLAIM_GENERIC = """
+UPDATE reminder
+SET lease_owner = ?, lease_expires_at = ?
+WHERE id IN (
+    SELECT id FROM reminder
+    WHERE target_time <= ?
+      AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+    ORDER BY target_time
+    LIMIT ?
+)
+RETURNING id
+"""
+
+# Daily reminders jump straight to their next occurrence in the future, rather than a day at a time. Days are 24 hours
+# like in `helpers.next_daily_occurrence`, whereas interval '1 day' would follow DST changes of the session's TimeZone.
+_SKIP_MISSED_POSTGRES = """
+WITH skipped AS (
+    DELETE FROM reminder
+    WHERE reminder_type = $1
+      AND target_time <= now()
+      AND (lease_expires_at IS NULL OR lease_expires_at < now())
+    RETURNING id
+), moved AS (
+    UPDATE reminder
+    SET target_time = target_time + (floor(extract(epoch FROM now() - target_time) / 86400) + 1) * interval '24 hours'
+    WHERE reminder_type = $2
+      AND target_time <= now()
+      AND (lease_expires_at IS NULL OR lease_expires_at < now())
+    RETURNING id
+)
+SELECT (SELECT count(*) FROM skipped) AS skipped, (SELECT count(*) FROM moved) AS moved
+"""
+
+# Notifications about added, moved and removed reminders, sent by a trigger (see `utils.migrations`)
+REMINDER_CHANNEL = 'reminder_changes'
+
+
+def is_postgres() -> bool:
+    return connections.get('default').capabilities.dialect == 'postgres'
+
+
+async def claim_due_reminders(owner: str, limit: int, lease: dt.timedelta, grace: dt.timedelta) -> list[int]:
+    """Leases up to `limit` reminders due within `grace` to `owner`, for the duration of `lease`, and returns their ids.
+    Reminders leased to someone else are skipped, unless their lease has expired."""
+    conn = connections.get('default')
+    if is_postgres():
+        rows = await conn.execute_query_dict(
+            CLAIM_POSTGRES, [owner, lease.total_seconds(), grace.total_seconds(), limit])
+    else:
+        now = discord.utils.utcnow()
+        rows = await conn.execute_query_dict(_CLAIM_GENERIC, [owner, now + lease, now + grace, now, limit])
+    return [row['id'] for row in rows]
+
+
+async def claim_reminders(
+        owner: str,
+        reminder_ids: list[int],
+        lease: dt.timedelta,
+        due_before: dt.datetime,
+) -> list[int]:
+    """Leases the given reminders to `owner` like `claim_due_reminders`, if they're still due before `due_before`, and
+    returns the ids of those that were leased."""
+    if is_postgres():
+        rows = await connections.get('default').execute_query_dict(
+            CLAIM_IDS_POSTGRES, [owner, lease.total_seconds(), reminder_ids, due_before])
+        return [row['id'] for row in rows]
+    now = discord.utils.utcnow()
+    unleased = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+    async with in_transaction():
+        claimed = await Reminder.filter(unleased, id__in=reminder_ids, target_time__lte=due_before).values_list(
+            'id', flat=True)
+        await Reminder.filter(id__in=claimed).update(lease_owner=owner, lease_expires_at=now + lease)
+    return claimed
+
+
+async def skip_missed_reminders() -> tuple[int, int]:
+    """Deletes overdue single reminders and moves overdue daily ones to their next occurrence, without firing them.
+    They aren't archived, as they never fired. Returns the amounts of deleted and moved reminders."""
+    if is_postgres():
+        rows = await connections.get('default').execute_query_dict(
+            _SKIP_MISSED_POSTGRES, [ReminderType.single.value, ReminderType.daily.value])
+        return rows[0]['skipped'], rows[0]['moved']
+    now = discord.utils.utcnow()
+    unleased = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+    async with in_transaction():
+        skipped = await Reminder.filter(unleased, reminder_type=ReminderType.single, target_time__lte=now).delete()
+        overdue = await Reminder.filter(unleased, reminder_type=ReminderType.daily, target_time__lte=now).values_list(
+            'id', 'target_time')
+        for reminder_id, target_time in overdue:
+            await Reminder.filter(id=reminder_id).update(target_time=next_daily_occurrence(target_time, now))
+    return skipped, len(overdue)
+
+
+class ReminderPaginator:
+    """Lazily loaded sequence of a user's reminders, ordered by target time, optionally filtered by type and location.
+
+    Reminders are fetched in chunks of `chunk_size` once the cursor reaches them, and the chunk after the cursor is
+    prefetched in the background. Chunks are fetched by keyset pagination on (target_time, id), starting right after
+    the last reminder of the previous chunk, so that each of them costs the same however far into the list it is.
+    Chunks further than `keep_behind` chunks behind the cursor are dropped, going back to them fetches them again.
+
+    The total is counted once, by `start`. Reminders fired or deleted in the meantime are simply missing from later
+    chunks, which then come up short: indexes past their end raise `IndexError` just like unloaded ones.
+    """
+
+    def __init__(
+            self,
+            user_id: int,
+            *,
+            reminder_type: ReminderType | None = None,
+            location: ReminderChannel | None = None,
+            chunk_size: int = 10,
+            keep_behind: int = 1,
+    ):
+        self.user_id = user_id
+        self.reminder_type = reminder_type
+        self.location = location
+        self.chunk_size = chunk_size
+        self.keep_behind = keep_behind
+        self.total = 0
+        self._chunks: dict[int, list[Reminder]] = {}
+        # Chunk -> (target_time, id) of the reminder right before it, the first chunk starts from the beginning
+        self._cursors: dict[int, tuple[dt.datetime, int] | None] = {0: None}
+        self._pending: dict[int, asyncio.Future] = {}
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index: int) -> Reminder:
+        chunk, offset = divmod(index, self.chunk_size)
+        try:
+            return self._chunks[chunk][offset]
+        except (KeyError, IndexError):
+            raise IndexError(f'Reminder {index} is not loaded.') from None
+
+    @property
+    def chunk_count(self) -> int:
+        return -(-self.total // self.chunk_size)
+
+    @property
+    def loaded_chunks(self) -> list[int]:
+        return sorted(self._chunks)
+
+    def _filtered(self) -> QuerySet[Reminder]:
+        queryset = Reminder.filter(user_id=self.user_id)
+        if self.reminder_type is not None:
+            queryset = queryset.filter(reminder_type=self.reminder_type)
+        if self.location == ReminderChannel.here:
+            queryset = queryset.filter(channel_id__isnull=False)
+        elif self.location == ReminderChannel.dm:
+            queryset = queryset.filter(channel_id__isnull=True)
+        return queryset
+
+    async def start(self) -> None:
+        """Counts the reminders and loads the first chunk."""
+        self.total = await self._filtered().count()
+        if self.total:
+            await self.load(0)
+
+    async def _fetch(self, chunk: int) -> None:
+        queryset = self._filtered()
+        if (cursor := self._cursors[chunk]) is not None:
+            target_time, reminder_id = cursor
+            queryset = queryset.filter(Q(target_time__gt=target_time) | Q(target_time=target_time, id__gt=reminder_id))
+        reminders = await queryset.order_by('target_time', 'id').limit(self.chunk_size)
+        self._chunks[chunk] = reminders
+        if len(reminders) == self.chunk_size:
+            self._cursors[chunk + 1] = (reminders[-1].target_time, reminders[-1].id)
+
+    def _start(self, chunk: int) -> asyncio.Future:
+        if (future := self._pending.get(chunk)) is None:
+            future = asyncio.ensure_future(self._fetch(chunk))
+            self._pending[chunk] = future
+            future.add_done_callback(functools.partial(self._fetched, chunk))
+        return future
+
+    def _fetched(self, chunk: int, future: asyncio.Future) -> None:
+        del self._pending[chunk]
+        if not future.cancelled():
+            # Failed prefetches are simply retried once the chunk is actually needed
+            future.exception()
+
+    async def load(self, index: int) -> None:
+        """Loads the reminder at index if needed, prefetching the next chunk and dropping chunks far from the cursor."""
+        chunk = index // self.chunk_size
+        # Where a chunk starts is only known once the one before it was fetched
+        while chunk not in self._cursors:
+            known = max(c for c in self._cursors if c < chunk)
+            await asyncio.shield(self._start(known))
+            if known + 1 not in self._cursors:
+                # The reminders ran out early
+                return
+        if chunk not in self._chunks:
+            await asyncio.shield(self._start(chunk))
+        for loaded in list(self._chunks):
+            if not chunk - self.keep_behind <= loaded <= chunk + 1:
+                del self._chunks[loaded]
+        if chunk + 1 < self.chunk_count and chunk + 1 in self._cursors and chunk + 1 not in self._chunks:
+            self._start(chunk + 1)
@@ -0,0 +1,146 @@
+import asyncio
+import datetime as dt
+import heapq
+
+import discord
+
+from .store import ReminderStore
+
+
+class ReminderScheduler:
+    """Keeps track of when reminders are due, without going back to the database for every reminder.
+
+    Reminders due before `window_end` are kept in a min-heap ordered by target time, everything after it stays in the
+    database until the window runs dry and gets moved forward by `lookahead` (at most `max_loaded` reminders at a time).
+
+    Adding a reminder pushes it onto the heap if it falls within the window, and wakes up `next_due` if it's now the
+    earliest one. Cancelled and rescheduled reminders are not searched for in the heap: `_scheduled` holds the current
+    target time of every reminder in the window, and heap entries that don't match it are skipped when they come up.
+    """
+
+    def __init__(
+            self,
+            store: ReminderStore | None = None,
+            lookahead: dt.timedelta = dt.timedelta(hours=6),
+            max_loaded: int = 10_000,
+    ):
+        self.store = store or ReminderStore()
+        self.lookahead = lookahead
+        self.max_loaded = max_loaded
+        self.window_end: dt.datetime | None = None
+        self._loaded = False
+        self._heap: list[tuple[dt.datetime, int]] = []
+        self._scheduled: dict[int, dt.datetime] = {}
+        self._wakeup = asyncio.Event()
+        # Changes made while a refill waits for the database, applied on top of what it loaded
+        self._changes: dict[int, dt.datetime | None] | None = None
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def __contains__(self, reminder_id: int) -> bool:
+        return reminder_id in self._scheduled
+
+    def _in_window(self, target_time: dt.datetime) -> bool:
+        # Without a window end, every reminder in the database has been loaded
+        return self._loaded and (self.window_end is None or target_time < self.window_end)
+
+    def add(self, reminder_id: int, target_time: dt.datetime) -> None:
+        """Schedules a reminder, or reschedules it if it was already scheduled."""
+        if self._changes is not None:
+            self._changes[reminder_id] = target_time
+        if self._scheduled.get(reminder_id) == target_time:
+            return
+        if not self._in_window(target_time):
+            # Loaded from the database once the window gets there
+            self._scheduled.pop(reminder_id, None)
+            return
+        self._scheduled[reminder_id] = target_time
+        heapq.heappush(self._heap, (target_time, reminder_id))
+        if self._heap[0] == (target_time, reminder_id):
+            self._wakeup.set()
+
+    def cancel(self, reminder_id: int) -> None:
+        if self._changes is not None:
+            self._changes[reminder_id] = None
+        if self._scheduled.pop(reminder_id, None) is None:
+            return
+        # Cancelled entries are left in the heap, rebuild it once they make up most of it
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._scheduled):
+            self._heap = [(target_time, reminder_id) for reminder_id, target_time in self._scheduled.items()]
+            heapq.heapify(self._heap)
+
+    def reload(self) -> None:
+        """Makes `next_due` load reminders from the database again, e.g. after changes to them may have been missed."""
+        self._loaded = False
+        self._wakeup.set()
+
+    def _peek(self) -> tuple[dt.datetime, int] | None:
+        """Returns the earliest scheduled reminder, discarding stale heap entries on the way."""
+        heap = self._heap
+        while heap:
+            target_time, reminder_id = heap[0]
+            if self._scheduled.get(reminder_id) == target_time:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    async def _load_window(self, horizon: dt.datetime) -> list[tuple[int, dt.datetime]]:
+        """Returns ids and target times of the earliest reminders due before the horizon, at most `max_loaded` of them
+        (more if several share the last target time)."""
+        return await self.store.load_window(horizon, self.max_loaded)
+
+    async def _earliest_target_time(self) -> dt.datetime | None:
+        return await self.store.earliest_target_time()
+
+    async def refill(self) -> None:
+        """Replaces the scheduled reminders with the ones from the database, starting a new window from now."""
+        horizon = discord.utils.utcnow() + self.lookahead
+        self._changes = {}
+        try:
+            rows = await self._load_window(horizon)
+            if len(rows) >= self.max_loaded:
+                window_end = max(target_time for _, target_time in rows) + dt.timedelta(microseconds=1)
+            elif rows:
+                window_end = horizon
+            else:
+                # Nothing due soon: the window extends until the next reminder, whenever that is
+                window_end = await self._earliest_target_time()
+        finally:
+            changes, self._changes = self._changes, None
+        scheduled = dict(rows)
+        for reminder_id, target_time in changes.items():
+            if target_time is not None and (window_end is None or target_time < window_end):
+                scheduled[reminder_id] = target_time
+            else:
+                scheduled.pop(reminder_id, None)
+        self.window_end = window_end
+        self._scheduled = scheduled
+        self._heap = [(target_time, reminder_id) for reminder_id, target_time in scheduled.items()]
+        heapq.heapify(self._heap)
+        self._loaded = True
+
+    async def next_due(self, limit: int = 1, grace: dt.timedelta = dt.timedelta(0)) -> list[int]:
+        """Waits until the earliest reminder is due, then removes up to `limit` reminders due within `grace` from the
+        schedule and returns their ids, earliest first."""
+        while True:
+            self._wakeup.clear()
+            now = discord.utils.utcnow()
+            entry = self._peek()
+            if not self._loaded or (entry is None and self.window_end is not None and now >= self.window_end):
+                await self.refill()
+                continue
+            if entry is not None and entry[0] <= now:
+                break
+            wake_at = entry[0] if entry is not None else self.window_end
+            timeout = (wake_at - now).total_seconds() if wake_at is not None else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        due = []
+        while len(due) < limit and (entry := self._peek()) is not None and entry[0] <= now + grace:
+            heapq.heappop(self._heap)
+            del self._scheduled[entry[1]]
+            due.append(entry[1])
+        return due
@@ -0,0 +1,171 @@
+import datetime as dt
+import logging
+from typing import NamedTuple
+
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from .archive import ARCHIVE_FIRED, ensure_partition
+from .helpers import ReminderType
+from .models import Reminder
+from .queries import CLAIM_IDS_POSTGRES, CLAIM_POSTGRES, claim_due_reminders, claim_reminders
+
+_log = logging.getLogger(__name__)
+
+
+class DueReminder(NamedTuple):
+    """Reminder being fired. Lighter than a `models.Reminder`, which the scheduler has no use for."""
+    id: int
+    user_id: int
+    guild_id: int | None
+    channel_id: int | None
+    reminder_type: ReminderType
+    target_time: dt.datetime
+    description: str
+
+
+_COLUMNS = ['id', 'user_id', 'guild_id', 'channel_id', 'reminder_type', 'target_time', 'description']
+
+
+class ReminderStore:
+    """Queries run by the scheduler for every batch of reminders it fires, made through the ORM.
+
+    Everything else about reminders goes through the ORM directly. `PostgresReminderStore` runs the same queries without
+    it, which is what the bot uses with Postgres.
+    """
+
+    async def load_window(self, horizon: dt.datetime, limit: int) -> list[tuple[int, dt.datetime]]:
+        """Returns ids and target times of the earliest reminders due before the horizon, at most `limit` of them
+        (more if several share the last target time)."""
+        rows = await Reminder.filter(target_time__lt=horizon).order_by('target_time').limit(limit).values_list(
+            'id', 'target_time')
+        if len(rows) == limit:
+            last = rows[-1][1]
+            rows = [row for row in rows if row[1] < last]
+            rows += await Reminder.filter(target_time=last).values_list('id', 'target_time')
+        return rows
+
+    async def earliest_target_time(self) -> dt.datetime | None:
+        earliest = await Reminder.all().order_by('target_time').first()
+        return earliest.target_time if earliest else None
+
+    async def claim(self, owner: str, limit: int, lease: dt.timedelta, grace: dt.timedelta) -> list[int]:
+        """See `queries.claim_due_reminders`."""
+        return await claim_due_reminders(owner, limit, lease, grace)
+
+    async def claim_ids(
+            self,
+            owner: str,
+            reminder_ids: list[int],
+            lease: dt.timedelta,
+            due_before: dt.datetime,
+    ) -> list[int]:
+        """See `queries.claim_reminders`."""
+        return await claim_reminders(owner, reminder_ids, lease, due_before)
+
+    async def load(self, reminder_ids: list[int]) -> list[DueReminder]:
+        """Returns the reminders, earliest first."""
+        rows = await Reminder.filter(id__in=reminder_ids).order_by('target_time').values_list(*_COLUMNS)
+        return [DueReminder(*row[:4], ReminderType(row[4]), *row[5:]) for row in rows]
+
+    async def complete(
+            self,
+            owner: str,
+            single: list[int],
+            daily: dict[dt.datetime, list[int]],
+            undelivered: list[int],
+    ) -> None:
+        """Deletes fired single reminders and moves daily ones to their next target time (keys of `daily`), all at
+        once. Only reminders still leased to `owner` are completed: if the lease ran out in the meantime, whoever
+        claimed them next is responsible for them now."""
+        async with in_transaction():
+            if single:
+                await Reminder.filter(id__in=single, lease_owner=owner).delete()
+            for target_time, ids in daily.items():
+                await Reminder.filter(id__in=ids, lease_owner=owner).update(
+                    target_time=target_time, lease_owner=None, lease_expires_at=None)
+
+
+class PostgresReminderStore(ReminderStore):
+    """Runs the scheduler's queries on connections of the asyncpg pool directly, skipping the ORM's query building
+    and model instantiation, and returns rows as plain tuples.
+
+    asyncpg prepares every query the first time a connection runs it and keeps the prepared statement in a
+    per-connection cache, so these queries are only planned once per pooled connection. The query texts are constant
+    for that reason: anything that varies goes through parameters, lists included (``= ANY($1::int[])``).
+
+    Fired reminders are archived as part of completing them, see `archive`.
+    """
+
+    _WINDOW = 'SELECT id, target_time FROM reminder WHERE target_time < $1 ORDER BY target_time LIMIT $2'
+    _WINDOW_TIES = 'SELECT id, target_time FROM reminder WHERE target_time = $1'
+    _EARLIEST = 'SELECT min(target_time) FROM reminder'
+    _LOAD = f'SELECT {", ".join(_COLUMNS)} FROM reminder WHERE id = ANY($1::int[]) ORDER BY target_time'
+    _DELETE = 'DELETE FROM reminder WHERE id = ANY($1::int[]) AND lease_owner = $2'
+    # All daily reminders move in a single statement, each to its own target time
+    _MOVE = """
+    UPDATE reminder SET target_time = moved.target_time, lease_owner = NULL, lease_expires_at = NULL
+    FROM unnest($1::int[], $2::timestamptz[]) AS moved (id, target_time)
+    WHERE reminder.id = moved.id AND reminder.lease_owner = $3
+    """
+
+    @staticmethod
+    def _acquire():
+        return connections.get('default').acquire_connection()
+
+    async def load_window(self, horizon: dt.datetime, limit: int) -> list[tuple[int, dt.datetime]]:
+        async with self._acquire() as conn:
+            rows = [tuple(row) for row in await conn.fetch(self._WINDOW, horizon, limit)]
+            if len(rows) == limit:
+                last = rows[-1][1]
+                rows = [row for row in rows if row[1] < last]
+                rows += [tuple(row) for row in await conn.fetch(self._WINDOW_TIES, last)]
+        return rows
+
+    async def earliest_target_time(self) -> dt.datetime | None:
+        async with self._acquire() as conn:
+            return await conn.fetchval(self._EARLIEST)
+
+    async def claim(self, owner: str, limit: int, lease: dt.timedelta, grace: dt.timedelta) -> list[int]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(CLAIM_POSTGRES, owner, lease.total_seconds(), grace.total_seconds(), limit)
+        return [row[0] for row in rows]
+
+    async def claim_ids(
+            self,
+            owner: str,
+            reminder_ids: list[int],
+            lease: dt.timedelta,
+            due_before: dt.datetime,
+    ) -> list[int]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(CLAIM_IDS_POSTGRES, owner, lease.total_seconds(), reminder_ids, due_before)
+        return [row[0] for row in rows]
+
+    async def load(self, reminder_ids: list[int]) -> list[DueReminder]:
+        async with self._acquire() as conn:
+            rows = await conn.fetch(self._LOAD, reminder_ids)
+        return [DueReminder(*row[:4], ReminderType(row[4]), *row[5:]) for row in rows]
+
+    async def complete(
+            self,
+            owner: str,
+            single: list[int],
+            daily: dict[dt.datetime, list[int]],
+            undelivered: list[int],
+    ) -> None:
+        moved_ids = [reminder_id for ids in daily.values() for reminder_id in ids]
+        moved_times = [target_time for target_time, ids in daily.items() for _ in ids]
+        fired_at = dt.datetime.now(dt.timezone.utc)
+        try:
+            await ensure_partition(fired_at)
+        except Exception:
+            # They're archived to the default partition meanwhile
+            _log.exception('Failed to create the archive partition of the current month.')
+        async with self._acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(ARCHIVE_FIRED, single + moved_ids, owner, undelivered, fired_at)
+                if single:
+                    await conn.execute(self._DELETE, single, owner)
+                if moved_ids:
+                    await conn.execute(self._MOVE, moved_ids, moved_times, owner)
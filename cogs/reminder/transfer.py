@@ -0,0 +1,319 @@
+import csv
+import datetime as dt
+import io
+import itertools
+import tempfile
+from typing import AsyncIterator, Iterable, Iterator, NamedTuple
+from zoneinfo import ZoneInfoNotFoundError
+
+import discord
+from tortoise.transactions import in_transaction
+
+from cogs.shared_models import User
+from cogs.shared_registry import user_registry
+from utils.timezones import get_zone
+from .helpers import ReminderType, TransferFormat, next_daily_occurrence
+from .models import Reminder
+
+CSV_COLUMNS = ['id', 'user_id', 'guild_id', 'channel_id', 'reminder_type', 'target_time', 'description']
+MAX_DESCRIPTION_LENGTH = 2048
+# Exports bigger than this are written to disk rather than kept in memory until they're uploaded
+SPOOL_SIZE = 1024 * 1024
+
+
+class TransferError(Exception):
+    """Raised when a file can't be imported. The message is meant to be shown to the user."""
+
+
+class ReminderRecord(NamedTuple):
+    """Reminder read from a file, not saved yet."""
+    user_id: int | None
+    guild_id: int | None
+    channel_id: int | None
+    reminder_type: ReminderType
+    target_time: dt.datetime
+    description: str
+
+
+async def iter_reminders(user_id: int | None = None, chunk_size: int = 1000) -> AsyncIterator[Reminder]:
+    """Yields reminders (of one user, or everyone's), fetching them in chunks by keyset pagination on id."""
+    last_id = 0
+    while True:
+        queryset = Reminder.filter(id__gt=last_id)
+        if user_id is not None:
+            queryset = queryset.filter(user_id=user_id)
+        chunk = await queryset.order_by('id').limit(chunk_size)
+        for reminder in chunk:
+            yield reminder
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].id
+
+
+def _optional_int(value: str | None) -> int | None:
+    return int(value) if value not in (None, '') else None
+
+
+# CSV
+
+async def export_csv(reminders: AsyncIterator[Reminder]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    async for reminder in reminders:
+        writer.writerow([reminder.id, reminder.user_id, reminder.guild_id or '', reminder.channel_id or '',
+                         reminder.reminder_type.name, reminder.target_time.isoformat(), reminder.description])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parse_csv(text: str) -> Iterator[ReminderRecord]:
+    """Reads reminders from CSV in the format written by `export_csv`. The id column is optional and ignored."""
+    reader = csv.DictReader(io.StringIO(text))
+    missing = {'reminder_type', 'target_time', 'description'} - set(reader.fieldnames or [])
+    if missing:
+        raise TransferError(f'Missing columns: {", ".join(sorted(missing))}.')
+    for row in reader:
+        try:
+            target_time = dt.datetime.fromisoformat(row['target_time'])
+            if target_time.tzinfo is None:
+                raise ValueError('no UTC offset')
+            yield ReminderRecord(
+                user_id=_optional_int(row.get('user_id')),
+                guild_id=_optional_int(row.get('guild_id')),
+                channel_id=_optional_int(row.get('channel_id')),
+                reminder_type=ReminderType[row['reminder_type']],
+                target_time=target_time,
+                description=row['description'] or '',
+            )
+        except (KeyError, ValueError, TypeError) as e:
+            raise TransferError(f'Malformed reminder on line {reader.line_num}: {e}.') from None
+
+
+# iCalendar (RFC 5545)
+
+def _ical_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _ical_unescape(text: str) -> str:
+    chars = iter(text)
+    unescaped = []
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            char = '\n' if char in 'nN' else char
+        unescaped.append(char)
+    return ''.join(unescaped)
+
+
+def _ical_fold(line: str) -> str:
+    """Splits a content line into lines of at most 75 octets, as the standard requires."""
+    parts = []
+    current, length = [], 0
+    for char in line:
+        size = len(char.encode())
+        if length + size > 75:
+            parts.append(''.join(current))
+            # Continuation lines start with a space, which counts towards their length
+            current, length = [' '], 1
+        current.append(char)
+        length += size
+    parts.append(''.join(current))
+    return '\r\n'.join(parts) + '\r\n'
+
+
+def _ical_time(value: dt.datetime) -> str:
+    return value.astimezone(dt.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+async def export_ical(reminders: AsyncIterator[Reminder]) -> AsyncIterator[str]:
+    stamp = _ical_time(discord.utils.utcnow())
+    yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//SphynxBOT//Reminders//EN\r\n'
+    async for reminder in reminders:
+        lines = [
+            'BEGIN:VEVENT',
+            f'UID:reminder-{reminder.id}@sphynx',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{_ical_time(reminder.target_time)}',
+            f'SUMMARY:{_ical_escape(reminder.description.partition(chr(10))[0])}',
+            f'DESCRIPTION:{_ical_escape(reminder.description)}',
+        ]
+        if reminder.reminder_type == ReminderType.daily:
+            lines.append('RRULE:FREQ=DAILY')
+        if reminder.channel_id:
+            lines.append(f'X-SPHYNX-CHANNEL:{reminder.channel_id}')
+        if reminder.guild_id:
+            lines.append(f'X-SPHYNX-GUILD:{reminder.guild_id}')
+        lines.append('END:VEVENT')
+        yield ''.join(_ical_fold(line) for line in lines)
+    yield 'END:VCALENDAR\r\n'
+
+
+def _ical_lines(text: str) -> Iterator[tuple[str, dict[str, str], str]]:
+    """Yields content lines as (name, parameters, value), after joining folded lines back together."""
+    unfolded = []
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and unfolded:
+            unfolded[-1] += line[1:]
+        elif line:
+            unfolded.append(line)
+    for line in unfolded:
+        # The value starts at the first colon outside of quoted parameter values
+        quoted = False
+        for i, char in enumerate(line):
+            if char == '"':
+                quoted = not quoted
+            elif char == ':' and not quoted:
+                break
+        else:
+            raise TransferError(f'Malformed iCalendar line: {line[:50]}')
+        name, *params = line[:i].split(';')
+        parameters = dict(param.partition('=')[::2] for param in params)
+        yield name.upper(), {k.upper(): v.strip('"') for k, v in parameters.items()}, line[i + 1:]
+
+
+def _parse_ical_time(value: str, parameters: dict[str, str]) -> dt.datetime:
+    if parameters.get('VALUE') == 'DATE' or len(value) == 8:
+        parsed = dt.datetime.strptime(value, '%Y%m%d')
+    else:
+        parsed = dt.datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        return parsed.replace(tzinfo=dt.timezone.utc)
+    if 'TZID' in parameters:
+        try:
+            return parsed.replace(tzinfo=get_zone(parameters['TZID']))
+        except (ZoneInfoNotFoundError, ValueError):
+            raise TransferError(f'Unknown timezone: {parameters["TZID"]}.') from None
+    # Floating times don't belong to any timezone, UTC is as good a guess as any
+    return parsed.replace(tzinfo=dt.timezone.utc)
+
+
+def _is_daily_rule(rule: str) -> bool:
+    """Whether a recurrence rule repeats every day, forever. Anything else (every other day, a limited number of times,
+    only on some days...) can't be represented by a daily reminder."""
+    parts = dict(part.partition('=')[::2] for part in rule.upper().split(';') if part)
+    if not parts.keys() <= {'FREQ', 'INTERVAL', 'WKST'}:
+        return False
+    return parts.get('FREQ') == 'DAILY' and parts.get('INTERVAL', '1') == '1'
+
+
+def parse_ical(text: str) -> Iterator[ReminderRecord]:
+    """Reads reminders from the events of an iCalendar file.
+
+    Events repeating every day become daily reminders, other repeating events are skipped (they can't be represented).
+    """
+    event = None
+    # Components nested in events, like alarms, have properties of their own that must not be mistaken for the event's
+    nested = 0
+    for name, parameters, value in _ical_lines(text):
+        if event is not None and name in ('BEGIN', 'END') and value.upper() != 'VEVENT':
+            nested += 1 if name == 'BEGIN' else -1
+        elif nested:
+            continue
+        elif name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {}
+        elif name == 'END' and value.upper() == 'VEVENT' and event is not None:
+            if 'DTSTART' not in event:
+                raise TransferError('Event without a start time.')
+            rule = event.get('RRULE', (None, None))[1]
+            if rule is not None and not _is_daily_rule(rule):
+                event = None
+                continue
+            try:
+                yield ReminderRecord(
+                    user_id=None,
+                    guild_id=_optional_int(event.get('X-SPHYNX-GUILD', (None, None))[1]),
+                    channel_id=_optional_int(event.get('X-SPHYNX-CHANNEL', (None, None))[1]),
+                    reminder_type=ReminderType.daily if rule else ReminderType.single,
+                    target_time=_parse_ical_time(event['DTSTART'][1], event['DTSTART'][0]),
+                    description=_ical_unescape(event.get('DESCRIPTION', event.get('SUMMARY', (None, '')))[1]),
+                )
+            except ValueError as e:
+                raise TransferError(f'Malformed event: {e}.') from None
+            event = None
+        elif event is not None:
+            event[name] = (parameters, value)
+
+
+# Files
+
+async def export_file(file_format: TransferFormat, user_id: int | None = None) -> discord.File:
+    """Writes reminders (of one user, or everyone's) to a file ready to be uploaded."""
+    exporter = export_ical if file_format == TransferFormat.ical else export_csv
+    fp = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    async for chunk in exporter(iter_reminders(user_id)):
+        fp.write(chunk.encode())
+    fp.seek(0)
+    return discord.File(fp, filename=f'reminders.{file_format.value}')
+
+
+async def read_attachment(attachment: discord.Attachment) -> Iterator[ReminderRecord]:
+    """Reads reminders from an uploaded CSV or iCalendar (.ics) file. Records are parsed as they are consumed."""
+    try:
+        text = (await attachment.read()).decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise TransferError('The file should be encoded in UTF-8.') from None
+    if attachment.filename.lower().endswith('.ics'):
+        return parse_ical(text)
+    return parse_csv(text)
+
+
+# Importing
+
+async def import_reminders(
+        records: Iterable[ReminderRecord],
+        *,
+        user_id: int | None = None,
+        guild_id: int | None = None,
+        channel_id: int | None = None,
+        limit: int | None = None,
+        batch_size: int = 1000,
+) -> tuple[int, int]:
+    """Saves reminders read from a file, all or none of them. Returns the amounts of imported and skipped reminders.
+
+    Reminders are inserted `batch_size` at a time with multi-row inserts, within a single transaction. When `user_id`
+    is given every reminder is imported for that user and sent to `channel_id` (DMs if None), whatever the file says.
+    Otherwise users and channels are taken from the file, and users missing from the database are created.
+
+    Single reminders whose time has passed are skipped, daily ones are moved to their next occurrence.
+    """
+    now = discord.utils.utcnow()
+    imported = skipped = 0
+    records = iter(records)
+    created_users = set()
+    async with in_transaction():
+        while batch := list(itertools.islice(records, batch_size)):
+            reminders = []
+            for record in batch:
+                if user_id is not None:
+                    record = record._replace(user_id=user_id, guild_id=guild_id, channel_id=channel_id)
+                elif record.user_id is None:
+                    raise TransferError('Reminder without a user id.')
+                if len(record.description) > MAX_DESCRIPTION_LENGTH:
+                    raise TransferError(f'Description too long. Max length is {MAX_DESCRIPTION_LENGTH}.')
+                target_time = record.target_time
+                if target_time <= now:
+                    if record.reminder_type == ReminderType.single:
+                        skipped += 1
+                        continue
+                    target_time = next_daily_occurrence(target_time, now)
+                reminders.append(Reminder(
+                    user_id=record.user_id,
+                    guild_id=record.guild_id,
+                    channel_id=record.channel_id,
+                    reminder_type=record.reminder_type,
+                    target_time=target_time,
+                    description=record.description,
+                ))
+            imported += len(reminders)
+            if limit is not None and imported > limit:
+                raise TransferError(f'Too many reminders. At most {limit} can be imported at once.')
+            if missing := user_registry.missing(reminder.user_id for reminder in reminders) - created_users:
+                await User.bulk_create([User(id=user_id) for user_id in missing], ignore_conflicts=True)
+                created_users |= missing
+            await Reminder.bulk_create(reminders)
+    user_registry.add(created_users)
+    return imported, skipped
@@ -2,25 +2,33 @@ import discord
 
 from cogs.shared_views import PaginatingView
 from utils.constants import COLOR_EMBED_DARK
-from .models import Reminder
+from .queries import ReminderPaginator
 
 
 class ReminderView(PaginatingView):
     def __init__(
             self,
             interaction: discord.Interaction,
-            reminders: list[Reminder],
+            reminders: ReminderPaginator,
             **kwargs,
     ):
         super().__init__(interaction, reminders, **kwargs)
 
+    async def load_page(self, page_index: int):
+        await self.pages.load(page_index)
+
     def embed(self) -> discord.Embed:
-        reminder = self.pages[self.page_index]
-        epoch = int(reminder.target_time.timestamp())
-        embed = discord.Embed(
-            title=f"<t:{epoch}>",
-            description=reminder.description,
-            color=COLOR_EMBED_DARK)
-        embed.set_author(name=f'Reminder id: {reminder.id}\nReminder type: {reminder.reminder_type.name}')
-        embed.set_footer(text=f'Reminder {self.page_index + 1}/{len(self.pages)}')
+        try:
+            reminder = self.pages[self.page_index]
+        except IndexError:
+            embed = discord.Embed(description='This reminder was fired or deleted in the meantime.',
+                                  color=COLOR_EMBED_DARK)
+        else:
+            epoch = int(reminder.target_time.timestamp())
+            embed = discord.Embed(
+                title=f"<t:{epoch}>",
+                description=reminder.description,
+                color=COLOR_EMBED_DARK)
+            embed.set_author(name=f'Reminder id: {reminder.id}\nReminder type: {reminder.reminder_type.name}')
+        embed.set_footer(text=f'Reminder {self.page_index + 1}/{self.page_count}')
         return embed
@@ -4,3 +4,6 @@ from tortoise.models import Model
 
 class User(Model):
     id = fields.BigIntField(pk=True, generated=False)
+    # Whether the user accepted DMs when last checked, see `cogs.shared_reachability`
+    dm_open = fields.BooleanField(null=True)
+    dm_checked_at = fields.DatetimeField(null=True)
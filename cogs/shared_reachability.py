@@ -0,0 +1,105 @@
+import datetime as dt
+import time
+
+import discord
+
+from cogs.shared_models import User
+from utils.metrics import metrics
+from utils.misc import dm_open
+
+# Error returned by Discord when a message can't be delivered to a user's DMs
+CANNOT_SEND_TO_USER = 50007
+
+
+class DmReachability:
+    """Remembers which users accept direct messages, so that it doesn't have to be probed for every DM.
+
+    States come from real sends whenever possible (see `send`), probing with `utils.misc.dm_open` is left for users the
+    bot knows nothing recent about. A user who closed their DMs is more likely to reopen them soon than the other way
+    around, so closed states expire sooner.
+
+    With ``persist=True`` states are also saved on `User`, surviving restarts and shared between instances of the bot.
+    Only changes of state and expired states get written, not every send.
+    """
+
+    def __init__(
+            self,
+            *,
+            open_ttl: dt.timedelta = dt.timedelta(days=1),
+            closed_ttl: dt.timedelta = dt.timedelta(minutes=10),
+            persist: bool = True,
+            max_entries: int = 100_000,
+    ):
+        self.open_ttl = open_ttl
+        self.closed_ttl = closed_ttl
+        self.persist = persist
+        self.max_entries = max_entries
+        # User id -> (accepts DMs, monotonic time the state was learned at)
+        self._states: dict[int, tuple[bool, float]] = {}
+
+    @staticmethod
+    def _now() -> float:
+        return time.monotonic()
+
+    def _ttl(self, is_open: bool) -> float:
+        return (self.open_ttl if is_open else self.closed_ttl).total_seconds()
+
+    def get(self, user_id: int) -> bool | None:
+        """Returns whether the user accepts DMs, or None if that isn't known (anymore)."""
+        if (state := self._states.get(user_id)) is None:
+            return None
+        is_open, learned_at = state
+        if self._now() - learned_at > self._ttl(is_open):
+            del self._states[user_id]
+            return None
+        return is_open
+
+    async def record(self, user_id: int, is_open: bool) -> None:
+        """Stores the outcome of a DM sent to the user."""
+        known = self.get(user_id)
+        if len(self._states) >= self.max_entries and user_id not in self._states:
+            # Dicts keep insertion order, the oldest entries go first
+            for stale in list(self._states)[:self.max_entries // 10]:
+                del self._states[stale]
+        self._states[user_id] = (is_open, self._now())
+        if self.persist and known != is_open:
+            await User.filter(id=user_id).update(dm_open=is_open, dm_checked_at=discord.utils.utcnow())
+
+    async def _load(self, user_id: int) -> bool | None:
+        user = await User.get_or_none(id=user_id).only('id', 'dm_open', 'dm_checked_at')
+        if user is None or user.dm_open is None or user.dm_checked_at is None:
+            return None
+        age = (discord.utils.utcnow() - user.dm_checked_at).total_seconds()
+        if age > self._ttl(user.dm_open):
+            return None
+        # Counted as learned when it was saved, so that it expires at the same time everywhere
+        self._states[user_id] = (user.dm_open, self._now() - age)
+        return user.dm_open
+
+    async def is_open(self, user: discord.User | discord.Member) -> bool:
+        """Returns whether the user accepts DMs, only probing them when nothing recent is known."""
+        if (is_open := self.get(user.id)) is not None:
+            metrics.counter('dm_reachability_lookups_total', source='memory').inc()
+            return is_open
+        if self.persist and (is_open := await self._load(user.id)) is not None:
+            metrics.counter('dm_reachability_lookups_total', source='database').inc()
+            return is_open
+        metrics.counter('dm_reachability_lookups_total', source='probe').inc()
+        is_open = await dm_open(user)
+        await self.record(user.id, is_open)
+        return is_open
+
+    async def send(self, user: discord.User | discord.Member, content: str) -> bool:
+        """Sends a DM to the user, returning False if they don't accept DMs. Other errors are raised as usual."""
+        try:
+            await user.send(content)
+        except discord.HTTPException as e:
+            if e.code != CANNOT_SEND_TO_USER:
+                raise
+            await self.record(user.id, False)
+            return False
+        await self.record(user.id, True)
+        return True
+
+
+dm_reachability = DmReachability()
@@ -0,0 +1,61 @@
+from typing import Iterable
+
+from cogs.shared_models import User
+
+
+class UserRegistry:
+    """Keeps track of which users exist in the database, so that they don't have to be looked up before saving something
+    that belongs to them.
+
+    Users are never deleted, so once a user is known to exist it stays that way. The registry is warmed with every
+    existing user at startup; users it doesn't know yet are inserted with ``INSERT ... ON CONFLICT DO NOTHING``, which
+    takes a single round-trip whether another instance of the bot created them in the meantime or not.
+    """
+
+    def __init__(self):
+        self._known: set[int] = set()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._known
+
+    def __len__(self):
+        return len(self._known)
+
+    async def warm(self, chunk_size: int = 10_000) -> None:
+        """Loads ids of all existing users, in chunks ordered by id."""
+        last_id = None
+        while True:
+            queryset = User.all() if last_id is None else User.filter(id__gt=last_id)
+            ids = await queryset.order_by('id').limit(chunk_size).values_list('id', flat=True)
+            self._known.update(ids)
+            if len(ids) < chunk_size:
+                return
+            last_id = ids[-1]
+
+    def add(self, user_ids: Iterable[int]) -> None:
+        """Records users known to exist, e.g. created in a transaction that has since been committed."""
+        self._known.update(user_ids)
+
+    def clear(self) -> None:
+        self._known.clear()
+
+    async def ensure(self, user_id: int) -> None:
+        """Makes sure the user exists in the database, creating them if needed."""
+        await self.ensure_many([user_id])
+
+    async def ensure_many(self, user_ids: Iterable[int]) -> None:
+        """Makes sure the users exist in the database, creating the missing ones with a single query.
+
+        Within a transaction, use `missing` and `add` instead: users created by a transaction that gets rolled back
+        must not be recorded as existing.
+        """
+        if missing := self.missing(user_ids):
+            await User.bulk_create([User(id=user_id) for user_id in missing], ignore_conflicts=True)
+            self._known.update(missing)
+
+    def missing(self, user_ids: Iterable[int]) -> set[int]:
+        """Returns the users that aren't known to exist."""
+        return {user_id for user_id in user_ids if user_id not in self._known}
+
+
+user_registry = UserRegistry()
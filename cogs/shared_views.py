@@ -1,5 +1,7 @@
 import discord
 
+from utils.interactions import AutoDefer
+
 
 class SphynxView(discord.ui.View):
     """Base view that all other views used by the bot should inherit from."""
@@ -59,20 +61,25 @@ class PaginatingView(SphynxView):
         """Button that displays the parent view again."""
         await interaction.response.edit_message(view=self.parent_view, embed=self.parent_view.embed())
 
+    async def load_page(self, page_index: int):
+        """Called before the page at `page_index` is displayed. Views with lazily loaded pages fetch them here."""
+        pass
+
+    async def _turn_page(self, interaction: discord.Interaction, page_index: int):
+        async with AutoDefer(interaction, edit=True) as responder:
+            # The view moves to the page only once it's loaded, so that a failed fetch leaves it on the page shown
+            await self.load_page(page_index)
+            self.page_index = page_index
+            self.previous_page.disabled = page_index == 0
+            self.next_page.disabled = page_index == self.page_count - 1
+            await responder.send(view=self, embed=self.embed())
+
     @discord.ui.button(label='PREV', style=discord.ButtonStyle.gray, row=1, disabled=True)
     async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Button that displays the previous page."""
-        self.page_index -= 1
-        self.next_page.disabled = False
-        if self.page_index == 0:
-            button.disabled = True
-        await interaction.response.edit_message(view=self, embed=self.embed())
+        await self._turn_page(interaction, self.page_index - 1)
 
     @discord.ui.button(label='NEXT', style=discord.ButtonStyle.gray, row=1, disabled=True)
     async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
         """Button that displays the next page."""
-        self.page_index += 1
-        self.previous_page.disabled = False
-        if self.page_index == self.page_count - 1:
-            button.disabled = True
-        await interaction.response.edit_message(view=self, embed=self.embed())
+        await self._turn_page(interaction, self.page_index + 1)
@@ -5,6 +5,9 @@ import discord
 from discord.ext import commands
 from tortoise import Tortoise
 
+from cogs.shared_registry import user_registry
+from utils.migrations import migrate
+
 
 class Sphynx(commands.Bot):
     def __init__(self):
@@ -36,7 +39,8 @@ class Sphynx(commands.Bot):
         await Tortoise.init(
             db_url=self._build_db_url(),
             modules={'models': models})
-        await Tortoise.generate_schemas()
+        await migrate()
+        await user_registry.warm()
         # cogs
         for ext in self.initial_extensions:
             await self.load_extension(ext)
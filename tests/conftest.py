@@ -1,7 +1,13 @@
+import os
 from unittest.mock import MagicMock
 
 import discord
 import pytest
+import pytest_asyncio
+from tortoise import Tortoise, connections
+from tortoise.backends.base.executor import EXECUTOR_CACHE
+
+from cogs.shared_registry import user_registry
 
 
 @pytest.fixture
@@ -12,3 +18,37 @@ def mock_discord_user():
 class MockException(Exception):
     def __init__(self, **kwargs):
         self.code = kwargs.get('code')
+
+
+@pytest_asyncio.fixture
+async def db():
+    """In-memory database with all models, for tests that don't depend on Postgres specifics."""
+    EXECUTOR_CACHE.clear()
+    await Tortoise.init(
+        db_url='sqlite://:memory:',
+        modules={'models': ['cogs.shared_models', 'cogs.cinema.models', 'cogs.reminder.models']})
+    await Tortoise.generate_schemas()
+    # Users known to exist are gone with the database
+    user_registry.clear()
+    yield
+    await Tortoise.close_connections()
+
+
+@pytest_asyncio.fixture
+async def pg_db():
+    """Postgres database with all models, for tests of Postgres specific queries. The database pointed to by
+    ``SPHYNX_TEST_DB_URL`` gets its tables dropped and recreated."""
+    db_url = os.environ.get('SPHYNX_TEST_DB_URL')
+    if not db_url:
+        pytest.skip('SPHYNX_TEST_DB_URL not set')
+    # Queries prepared for SQLite by earlier tests are cached under the same connection name
+    EXECUTOR_CACHE.clear()
+    await Tortoise.init(
+        db_url=db_url,
+        modules={'models': ['cogs.shared_models', 'cogs.cinema.models', 'cogs.reminder.models']})
+    await connections.get('default').execute_script('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+    await Tortoise.generate_schemas()
+    # Users known to exist are gone with the database
+    user_registry.clear()
+    yield
+    await Tortoise.close_connections()
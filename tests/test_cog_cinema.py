@@ -1,9 +1,19 @@
+import asyncio
 import datetime as dt
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest.mock import MagicMock
 
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from discord.app_commands import Choice
 
-from cogs.cinema.helpers import deduplicate_autocomplete_labels, prepare_production_autocomplete_choices, verbose_date
-from cogs.cinema.models import Production
+from cogs.cinema.cache import TmdbCache, FrequencySketch
+from cogs.cinema.cog import CinemaCog
+from cogs.cinema.helpers import deduplicate_autocomplete_labels, prepare_production_autocomplete_choices, \
+    verbose_date, paginate_credits, parse_imdb_id
+from cogs.cinema.models import TmdbClient, CreditAccumulator, Credit, SearchHit, ExternalMapping, TmdbPaginator
 
 
 class TestHelpers:
@@ -45,24 +55,395 @@ class TestHelpers:
 
     def test_prepare_production_autocomplete_choices(self):
         candidates = [
-            Production(title='The Thing', id=2, popularity=4, release_date='2011-01-01'),
-            Production(title='The Thing', id=4, popularity=2),
-            Production(title='The Thing', id=1, popularity=5, release_date='1982-01-01'),
-            Production(title='The Thing', id=5, popularity=1),
-            Production(title='The Things', id=3, popularity=3, release_date='2021-01-01'),
-            Production(title='The Thingy', id=6, popularity=0),
+            SearchHit(title='The Thing', id=2, popularity=4, release_date='2011-01-01'),
+            SearchHit(title='The Thing', id=4, popularity=2),
+            SearchHit(title='The Thing', id=1, popularity=5, release_date='1982-01-01'),
+            SearchHit(title='The Thing', id=5, popularity=1),
+            SearchHit(title='The Things', id=3, popularity=3, release_date='2021-01-01'),
+            SearchHit(title='The Thingy', id=6, popularity=0),
         ]
         expected = [
-            Choice(name='The Thing (1982)', value=1),
-            Choice(name='The Thing (2011)', value=2),
-            Choice(name='The Things (2021)', value=3),
-            Choice(name='The Thing (1)', value=4),
-            Choice(name='The Thing (2)', value=5),
-            Choice(name='The Thingy', value=6),
+            Choice(name='The Thing (1982)', value='1'),
+            Choice(name='The Thing (2011)', value='2'),
+            Choice(name='The Things (2021)', value='3'),
+            Choice(name='The Thing (1)', value='4'),
+            Choice(name='The Thing (2)', value='5'),
+            Choice(name='The Thingy', value='6'),
         ]
 
         assert prepare_production_autocomplete_choices(candidates) == expected
 
+    def test_search_hit(self):
+        hit = SearchHit(id=1396, name='Breaking Bad', first_air_date='2008-01-20', popularity=None, overview='...')
+        assert (hit.id, hit.title, hit.year, hit.popularity) == (1396, 'Breaking Bad', 2008, 0)
+        assert SearchHit(id=1, title='Untitled', release_date='').year is None
+
+    def test_paginate_credits(self):
+        credits = [Credit(id=i, media_type='movie', title=f'M{i}', department='Acting' if i % 3 else 'Writing',
+                          release_date=f'{2000 + i}-01-01') for i in range(7)]
+        pages = paginate_credits(credits, reverse=True, credits_per_page=2)
+        assert list(pages) == ['Writing', 'Acting']
+        assert len(pages['Acting']) == 2 and len(pages['Writing']) == 2
+        assert pages['Writing'][0].startswith('``2006``')
+
+    def test_parse_imdb_id(self):
+        assert parse_imdb_id('https://www.imdb.com/title/tt0111161/?ref_=nv_sr_srsg_0') == 'tt0111161'
+        assert parse_imdb_id('https://m.imdb.com/name/nm0000151/') == 'nm0000151'
+        assert parse_imdb_id('tt12345678') == 'tt12345678'
+        assert parse_imdb_id('The Shawshank Redemption') is None
+        assert parse_imdb_id('att0111161') is None
+
     def test_verbose_date(self):
         date = dt.date(year=2000, month=1, day=1)
         assert verbose_date(date) == '01 January, 2000'
+
+
+class TestCreditAccumulator:
+    def test_merge_repeated(self):
+        accumulator = CreditAccumulator()
+        accumulator.add('cast', {'id': 1, 'media_type': 'tv', 'character': 'Walter', 'episode_count': 62})
+        accumulator.add('cast', {'id': 1, 'media_type': 'tv', 'character': 'Heisenberg', 'episode_count': 40})
+        accumulator.add('crew', {'id': 1, 'media_type': 'tv', 'job': 'Producer', 'department': 'Production'})
+        accumulator.add('cast', {'id': 2, 'media_type': 'movie', 'character': ''})
+        assert [(c.id, c.department, c.characters, c.jobs) for c in accumulator.credits] == [
+            (1, 'Acting', ['Walter', 'Heisenberg'], []),
+            (1, 'Production', [], ['Producer']),
+            (2, 'Acting', [], []),
+        ]
+        assert accumulator.credits[0].episode_counts == {'Walter': 62, 'Heisenberg': 40}
+
+    def test_aggregate(self):
+        accumulator = CreditAccumulator()
+        accumulator.add('cast', {'id': 17419, 'name': 'Bryan Cranston',
+                                 'roles': [{'character': 'Walter White', 'episode_count': 62}]})
+        accumulator.add('crew', {'id': 66633, 'name': 'Vince Gilligan', 'department': 'Writing',
+                                 'jobs': [{'job': 'Writer', 'episode_count': 13}]})
+        assert [(c.credit_subject, c.characters, c.jobs) for c in accumulator.credits] == [
+            ('Bryan Cranston', ['Walter White'], []),
+            ('Vince Gilligan', [], ['Writer']),
+        ]
+        assert accumulator.credits[1].episode_counts == {'Writer': 13}
+
+
+class TestTmdbClientSeasons:
+    @pytest.mark.asyncio
+    async def test_get_season(self, mocker):
+        client = TmdbClient('mock_key')
+        mocker.patch.object(client, '_get').return_value = {
+            'id': 3572,
+            'name': 'Season 1',
+            'season_number': 1,
+            'air_date': '2008-01-20',
+            'episodes': [
+                {'id': 62085, 'name': 'Pilot', 'season_number': 1, 'episode_number': 1, 'air_date': '2008-01-20',
+                 'runtime': 58, 'show_id': 1396},
+                {'id': 62086, 'name': "Cat's in the Bag...", 'season_number': 1, 'episode_number': 2},
+            ],
+        }
+        season = await client.get_season(1396, 1)
+        assert season.episode_count == 2
+        assert [e.show_id for e in season.episodes] == [1396, 1396]
+        assert str(season.episodes[0]) == (
+            '``2008-01-20`` **E01** [Pilot](https://www.themoviedb.org/tv/1396/season/1/episode/1) (58m)')
+        assert season.episodes[1].code() == 'S01E02'
+
+    @pytest.mark.asyncio
+    async def test_get_season_cached(self, mocker):
+        client = TmdbClient('mock_key')
+        mock_get = mocker.patch.object(client, '_get')
+        mock_get.return_value = {'season_number': 2, 'episodes': []}
+        client.prefetch_season(1396, 2)
+        await client.get_season(1396, 2)
+        await client.get_season(1396, 2)
+        assert mock_get.call_count == 1
+
+
+class TestTmdbClientOffloading:
+    @pytest.mark.asyncio
+    async def test_run_cpu_bound(self, mocker):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            client = TmdbClient('mock_key', executor=executor, offload_items=10)
+            spy = mocker.spy(executor, 'submit')
+            assert await client.run_cpu_bound(sum, [1, 2], size=2) == 3
+            assert spy.call_count == 0
+            assert await client.run_cpu_bound(sum, [1, 2], size=10) == 3
+            assert spy.call_count == 1
+
+
+class TestPlainRow:
+    def test_round_trip(self):
+        credit = Credit(credit_type='crew', media_type='tv', name='Breaking Bad', id=1396, jobs=['Producer'],
+                        first_air_date='2008-01-20', episode_counts={'Producer': 62})
+        restored = Credit.from_row(credit.to_row())
+        assert vars(restored) == vars(credit)
+        assert str(restored) == str(credit)
+
+
+class TestTmdbClientHydration:
+    @pytest.mark.asyncio
+    async def test_streaming_matches_buffered(self):
+        payload = {
+            'id': 17419,
+            'combined_credits': {
+                'cast': [{'id': 1396, 'media_type': 'tv', 'name': 'Breaking Bad', 'character': 'Walter White'}],
+                'crew': [{'id': 1396, 'media_type': 'tv', 'name': 'Breaking Bad', 'job': 'Producer',
+                          'department': 'Production'}],
+            },
+            'images': {'profiles': [{'file_path': '/a.jpg'}], 'posters': [{'file_path': '/b.jpg'}], 'id': 17419},
+        }
+
+        async def person_endpoint(request: web.Request):
+            return web.json_response(payload)
+
+        app = web.Application()
+        app.router.add_get('/person/17419', person_endpoint)
+        results = []
+        async with TestServer(app) as server:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                # The last client parses even this small response in the pool, ignoring its streaming setting
+                clients = [TmdbClient('mock_key', streaming=True), TmdbClient('mock_key', streaming=False),
+                           TmdbClient('mock_key', streaming=True, executor=executor, offload_bytes=0)]
+                for client in clients:
+                    client.base_api_url = str(server.make_url('')).rstrip('/')
+                    parsed = await client._get_with_credits('/person/17419', 'combined_credits')
+                    results.append((
+                        [(c.credit_type, c.id, c.department, c.characters, c.jobs) for c in parsed['credits']],
+                        [(i.image_category, i.file_path) for i in parsed['images']],
+                    ))
+        assert results[0] == results[1] == results[2]
+        assert results[0][1] == [('profiles', '/a.jpg'), ('posters', '/b.jpg')]
+
+
+class TestFrequencySketch:
+    def test_estimate(self):
+        sketch = FrequencySketch(width=64, sample_size=1000)
+        for i in range(10):
+            for _ in range(i):
+                sketch.increment(('movie', i))
+        assert [sketch.estimate(('movie', i)) for i in range(10)] == list(range(10))
+
+    def test_aging(self):
+        sketch = FrequencySketch(width=64, sample_size=10)
+        for _ in range(9):
+            sketch.increment('key')
+        assert sketch.increment('key') == 10
+        assert sketch.estimate('key') == 5
+        assert sketch.additions == 5
+
+
+class TestTmdbCache:
+    def test_ttl(self, mocker):
+        cache = TmdbCache(ttl=dt.timedelta(hours=1), feed_ttl=dt.timedelta(days=7))
+        now = dt.datetime(2000, 1, 10, tzinfo=dt.timezone.utc)
+        mocker.patch.object(TmdbCache, '_now').return_value = now
+        cache.put(('movie', 1), 'fresh', stored_at=now - dt.timedelta(minutes=30))
+        cache.put(('movie', 2), 'expired', stored_at=now - dt.timedelta(hours=2))
+        assert cache.get(('movie', 1)) == 'fresh'
+        assert cache.get(('movie', 2)) is None
+
+    def test_feed_ttl(self, mocker):
+        cache = TmdbCache(ttl=dt.timedelta(hours=1), feed_ttl=dt.timedelta(days=7))
+        now = dt.datetime(2000, 1, 10, tzinfo=dt.timezone.utc)
+        mocker.patch.object(TmdbCache, '_now').return_value = now
+        cache.put(('movie', 1), 'covered', stored_at=now - dt.timedelta(days=2))
+        cache.put(('movie', 2), 'not covered', stored_at=now - dt.timedelta(days=4))
+        cache.mark_synced(now - dt.timedelta(days=3), now - dt.timedelta(minutes=10))
+        assert cache.get(('movie', 1)) == 'covered'
+        assert cache.get(('movie', 2)) is None
+
+    def test_feed_ttl_late_poll(self, mocker):
+        cache = TmdbCache(ttl=dt.timedelta(hours=1), feed_ttl=dt.timedelta(days=7), feed_grace=dt.timedelta(hours=2))
+        now = dt.datetime(2000, 1, 10, tzinfo=dt.timezone.utc)
+        mock_now = mocker.patch.object(TmdbCache, '_now')
+        cache.put(('movie', 1), 'covered', stored_at=now - dt.timedelta(days=2))
+        cache.mark_synced(now - dt.timedelta(days=3), now - dt.timedelta(minutes=70))
+        # The hourly poll is running late, which doesn't expire entries covered by the feeds yet
+        mock_now.return_value = now
+        assert cache.get(('movie', 1)) == 'covered'
+        # Polls have stopped altogether
+        mock_now.return_value = now + dt.timedelta(hours=1)
+        assert cache.get(('movie', 1)) is None
+
+    def test_evict(self):
+        cache = TmdbCache()
+        cache.put(('tv', 1), 'show')
+        cache.put(('tv', 1, 1), 'season')
+        cache.put(('tv', 2), 'other show')
+        cache.put(('movie', 1), 'movie')
+        assert cache.evict('tv', {1, 3}) == 2
+        assert len(cache) == 2 and ('tv', 2) in cache and ('movie', 1) in cache
+
+    def test_admission(self):
+        cache = TmdbCache(maxsize=4, window_ratio=0.25)
+        for i in range(3):
+            cache.put(('movie', i), i)
+        cache.put(('movie', 3), 3)
+        for _ in range(3):
+            cache.get(('movie', 0))
+            cache.get(('movie', 4))
+        # One-off lookups pushed out of the window don't replace popular entries
+        for i in range(100, 110):
+            cache.put(('person', i), i)
+        assert ('movie', 0) in cache
+        assert len(cache) == 4
+        # A frequently requested entry gets in once it's pushed out of the window, replacing a colder one
+        cache.put(('movie', 4), 4)
+        cache.put(('person', 200), 200)
+        assert ('movie', 4) in cache and ('movie', 0) in cache
+
+    def test_heavy_hitters(self):
+        cache = TmdbCache(heavy_hitter_count=2)
+        for key, count in [(('movie', 1), 5), (('tv', 2), 3), (('person', 3), 1), (('movie', 4), 4)]:
+            for _ in range(count):
+                cache.get(key)
+        assert cache.heavy_hitters() == [(('movie', 1), 5), (('movie', 4), 4)]
+
+    @pytest.mark.asyncio
+    async def test_get_or_fetch_merges(self, mocker):
+        cache = TmdbCache()
+        fetch = mocker.AsyncMock(return_value='value')
+        results = [await cache.get_or_fetch(('person', 1), fetch) for _ in range(3)]
+        assert results == ['value'] * 3
+        assert fetch.await_count == 1
+
+
+class TestTmdbClientChanges:
+    @pytest.mark.asyncio
+    async def test_sync_changes(self):
+        changes = {'movie': [[1, 2], [3]], 'tv': [[10]], 'person': [[]]}
+        requests = []
+
+        async def changes_endpoint(request: web.Request):
+            media_type = request.match_info['media_type']
+            requests.append((media_type, dict(request.query)))
+            pages = changes[media_type]
+            page = int(request.query['page'])
+            results = [{'id': i, 'adult': False} for i in pages[page - 1]]
+            return web.json_response({'results': results, 'page': page, 'total_pages': len(pages)})
+
+        app = web.Application()
+        app.router.add_get('/{media_type}/changes', changes_endpoint)
+        async with TestServer(app) as server:
+            client = TmdbClient('mock_key')
+            client.base_api_url = str(server.make_url('')).rstrip('/')
+            for key in [('movie', 1), ('movie', 3), ('movie', 4), ('tv', 10), ('tv', 10, 1), ('tv', 11), ('person', 1)]:
+                client.cache.put(key, 'cached')
+            assert await client.sync_changes() == {'movie': 2, 'tv': 2, 'person': 0}
+            assert len(client.cache) == 3
+            assert all(key in client.cache for key in [('movie', 4), ('tv', 11), ('person', 1)])
+            assert client.cache.feed_synced_at is not None
+            assert len(requests) == 4
+            assert requests[0][1]['api_key'] == 'mock_key'
+
+    @pytest.mark.asyncio
+    async def test_poll_survives_errors(self, mocker, caplog):
+        mocker.patch('discord.ext.tasks.Loop.start')
+        client = TmdbClient('mock_key')
+        mocker.patch.object(client, 'sync_changes', side_effect=KeyError('results'))
+        cog = CinemaCog(MagicMock(), client)
+        with caplog.at_level(logging.ERROR, logger='cogs.cinema.cog'):
+            await cog.poll_changes.coro(cog)
+        assert 'Failed to poll TMDB change feeds' in caplog.text
+
+
+class TestTmdbClientImdb:
+    @pytest.mark.asyncio
+    async def test_find_imdb_id(self, mocker):
+        client = TmdbClient('mock_key')
+        mock_get = mocker.patch.object(client, '_get')
+        mock_get.return_value = {
+            'movie_results': [],
+            'tv_results': [{'id': 1396, 'name': 'Breaking Bad', 'first_air_date': '2008-01-20'}],
+            'person_results': [],
+        }
+        expected = ExternalMapping('tv', 1396, 'Breaking Bad (2008)')
+        assert await client.find_imdb_id('tt0903747') == expected
+        assert await client.find_imdb_id('tt0903747') == expected
+        assert mock_get.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_find_imdb_id_unknown(self, mocker):
+        client = TmdbClient('mock_key')
+        mock_monotonic = mocker.patch('cogs.cinema.models.time.monotonic', return_value=1000)
+        mock_get = mocker.patch.object(client, '_get')
+        mock_get.return_value = {'movie_results': [], 'tv_results': [], 'person_results': []}
+        assert await client.find_imdb_id('tt0000000') is None
+        assert await client.find_imdb_id('tt0000000') is None
+        assert len(client.imdb_index) == 0
+        assert mock_get.call_count == 1
+        # Misses are only remembered for a while, the entity may have been added to TMDB since
+        mock_monotonic.return_value += client.imdb_index.miss_ttl
+        assert await client.find_imdb_id('tt0000000') is None
+        assert mock_get.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_index_from_hydrated(self, mocker):
+        client = TmdbClient('mock_key', streaming=False)
+        mocker.patch.object(client, '_get_with_credits').return_value = {
+            'id': 17419, 'name': 'Bryan Cranston', 'credits': [], 'images': [],
+            'external_ids': {'imdb_id': 'nm0186505'}}
+        mock_get = mocker.patch.object(client, '_get')
+        await client.get_person(17419)
+        assert await client.find_imdb_id('nm0186505') == ExternalMapping('person', 17419, 'Bryan Cranston')
+        assert mock_get.call_count == 0
+
+
+class TestTmdbPaginator:
+    @staticmethod
+    def mock_pages(mocker, client, total_results, page_size=20):
+        async def get(endpoint, page, **kwargs):
+            start = (page - 1) * page_size
+            results = [{'id': i} for i in range(start, min(start + page_size, total_results))]
+            return {'page': page, 'results': results, 'total_results': total_results}
+
+        return mocker.patch.object(client, '_get', side_effect=get)
+
+    @pytest.mark.asyncio
+    async def test_load(self, mocker):
+        client = TmdbClient('mock_key')
+        mock_get = self.mock_pages(mocker, client, total_results=130)
+        paginator = TmdbPaginator(client, '/movie/popular', lambda kwargs: kwargs['id'], keep_behind=1)
+        await paginator.load(0)
+        await asyncio.sleep(0)
+        assert len(paginator) == 130 and paginator.page_count == 7
+        assert paginator[0] == 0
+        assert paginator.loaded_pages == [1, 2]
+        await paginator.load(65)
+        await asyncio.sleep(0)
+        assert paginator[65] == 65
+        assert paginator.loaded_pages == [4, 5]
+        with pytest.raises(IndexError):
+            paginator[0]
+        await paginator.load(129)
+        assert paginator.loaded_pages == [7]
+        assert [call.kwargs['page'] for call in mock_get.call_args_list] == [1, 2, 4, 5, 7]
+
+    @pytest.mark.asyncio
+    async def test_iterate(self, mocker):
+        client = TmdbClient('mock_key')
+        self.mock_pages(mocker, client, total_results=45)
+        paginator = TmdbPaginator(client, '/tv/popular', lambda kwargs: kwargs['id'], keep_behind=0)
+        assert [item async for item in paginator] == list(range(45))
+        assert len(paginator.loaded_pages) <= 2
+
+    @pytest.mark.asyncio
+    async def test_results_shrink(self, mocker):
+        client = TmdbClient('mock_key')
+        paginator = TmdbPaginator(client, '/movie/popular', lambda kwargs: kwargs['id'], keep_behind=0)
+        self.mock_pages(mocker, client, total_results=50)
+        await paginator.load(0)
+        # The list got shorter by the time the following pages are fetched
+        self.mock_pages(mocker, client, total_results=30)
+        await paginator.load(45)
+        assert len(paginator) == 50 and paginator.page_count == 3
+        with pytest.raises(IndexError):
+            paginator[45]
+        assert [item async for item in paginator] == list(range(30))
+
+    @pytest.mark.asyncio
+    async def test_max_pages(self, mocker):
+        client = TmdbClient('mock_key')
+        self.mock_pages(mocker, client, total_results=100_000)
+        paginator = await client.get_popular_movies()
+        assert len(paginator) == TmdbPaginator.max_pages * 20
+        assert paginator[3].id == 3
@@ -0,0 +1,920 @@
+import asyncio
+import contextlib
+import datetime as dt
+import json
+import logging
+
+from unittest.mock import AsyncMock, MagicMock
+
+import discord
+import pytest
+import pytest_asyncio
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from cogs.reminder import archive
+from cogs.reminder.cog import ReminderCog
+from cogs.reminder.helpers import MissedReminderPolicy, ReminderChannel, ReminderType, REMINDER_STAGES, \
+    next_daily_occurrence
+from cogs.reminder.models import Reminder
+from cogs.reminder.notifications import ReminderChangeListener
+from cogs.reminder.queries import ReminderPaginator, claim_due_reminders, skip_missed_reminders
+from cogs.reminder.scheduler import ReminderScheduler
+from cogs.reminder.store import DueReminder, PostgresReminderStore, ReminderStore
+from cogs.reminder.transfer import TransferError, export_csv, export_ical, import_reminders, iter_reminders, \
+    parse_csv, parse_ical
+from cogs.reminder.views import ReminderView
+from cogs.shared_models import User
+from cogs.shared_reachability import DmReachability
+from cogs.shared_registry import UserRegistry, user_registry
+from utils.metrics import metrics
+from utils.migrations import migrate
+
+
+@pytest.fixture
+def now():
+    return discord.utils.utcnow()
+
+
+@pytest.fixture
+def scheduler(mocker):
+    scheduler = ReminderScheduler(lookahead=dt.timedelta(hours=1), max_loaded=100)
+    mocker.patch.object(scheduler, '_load_window').return_value = []
+    mocker.patch.object(scheduler, '_earliest_target_time').return_value = None
+    return scheduler
+
+
+class TestReminderScheduler:
+    @pytest.mark.asyncio
+    async def test_order(self, scheduler, now):
+        scheduler._load_window.return_value = [(1, now - dt.timedelta(seconds=1)), (2, now - dt.timedelta(seconds=3))]
+        await scheduler.refill()
+        scheduler.add(3, now - dt.timedelta(seconds=2))
+        assert await scheduler.next_due(limit=2) == [2, 3]
+        assert await scheduler.next_due(limit=2) == [1]
+        assert len(scheduler) == 0
+
+    @pytest.mark.asyncio
+    async def test_grace(self, scheduler, now):
+        await scheduler.refill()
+        scheduler.add(1, now)
+        scheduler.add(2, now + dt.timedelta(seconds=1))
+        scheduler.add(3, now + dt.timedelta(seconds=10))
+        assert await scheduler.next_due(limit=10, grace=dt.timedelta(seconds=2)) == [1, 2]
+
+    @pytest.mark.asyncio
+    async def test_cancel_and_reschedule(self, scheduler, now):
+        await scheduler.refill()
+        scheduler.add(1, now - dt.timedelta(seconds=2))
+        scheduler.add(2, now - dt.timedelta(seconds=1))
+        scheduler.add(3, now)
+        scheduler.cancel(1)
+        scheduler.add(2, now + dt.timedelta(milliseconds=20))
+        assert await scheduler.next_due() == [3]
+        assert await scheduler.next_due() == [2]
+        assert 1 not in scheduler
+
+    @pytest.mark.asyncio
+    async def test_wakeup(self, scheduler, now):
+        await scheduler.refill()
+        scheduler.add(1, now + dt.timedelta(hours=1))
+        waiter = asyncio.create_task(scheduler.next_due())
+        await asyncio.sleep(0.01)
+        scheduler.add(2, discord.utils.utcnow() + dt.timedelta(milliseconds=10))
+        assert await asyncio.wait_for(waiter, 1) == [2]
+
+    @pytest.mark.asyncio
+    async def test_window(self, scheduler, now):
+        later = now + dt.timedelta(days=1)
+        scheduler._load_window.return_value = [(1, now + dt.timedelta(minutes=1))]
+        await scheduler.refill()
+        assert scheduler.window_end == pytest.approx(now + scheduler.lookahead, abs=dt.timedelta(seconds=1))
+        scheduler.add(2, later)
+        assert 2 not in scheduler
+        # Nothing due within the lookahead: the window extends up to the next reminder
+        scheduler._load_window.return_value = []
+        scheduler._earliest_target_time.return_value = later
+        await scheduler.refill()
+        assert scheduler.window_end == later
+        scheduler.add(3, later - dt.timedelta(seconds=1))
+        assert 3 in scheduler
+
+    @pytest.mark.asyncio
+    async def test_window_truncated(self, scheduler, now):
+        scheduler.max_loaded = 2
+        scheduler._load_window.return_value = [(1, now), (2, now)]
+        await scheduler.refill()
+        assert scheduler.window_end == now + dt.timedelta(microseconds=1)
+
+    @pytest.mark.asyncio
+    async def test_changes_during_refill(self, scheduler, now):
+        await scheduler.refill()
+        scheduler.add(1, now)
+
+        async def load_window(horizon):
+            # Reminder 2 is created and 1 deleted while the query runs
+            scheduler.add(2, now)
+            scheduler.cancel(1)
+            return [(1, now)]
+
+        scheduler._load_window.side_effect = load_window
+        await scheduler.refill()
+        assert 1 not in scheduler
+        assert 2 in scheduler
+
+    @pytest.mark.asyncio
+    async def test_refill_when_dry(self, scheduler, now):
+        await scheduler.refill()
+        scheduler.window_end = now
+        scheduler._load_window.return_value = [(5, now)]
+        assert await scheduler.next_due() == [5]
+        assert scheduler._load_window.call_count == 2
+
+    def test_compaction(self, scheduler, now):
+        scheduler._loaded = True
+        for i in range(100):
+            scheduler.add(i, now + dt.timedelta(seconds=i))
+        for i in range(80):
+            scheduler.cancel(i)
+        assert len(scheduler._heap) < 100
+        assert [entry[1] for entry in sorted(scheduler._heap)][-20:] == list(range(80, 100))
+
+
+@pytest.fixture
+def cog(mocker):
+    mocker.patch('discord.ext.tasks.Loop.start')
+    bot = MagicMock()
+    channels = {}
+
+    async def fetch_channel(channel_id):
+        return channels.setdefault(channel_id, MagicMock(send=AsyncMock()))
+
+    bot.maybe_fetch_channel = fetch_channel
+    bot.channels = channels
+    cog = ReminderCog(bot)
+    cog.scheduler._loaded = True
+    return cog
+
+
+class TestReminderDispatch:
+    @pytest.mark.asyncio
+    async def test_dispatch(self, db, cog, now):
+        user = await User.create(id=1)
+        target_time = now - dt.timedelta(seconds=1)
+        reminders = [
+            await Reminder.create(user=user, channel_id=10, reminder_type=ReminderType.single,
+                                  target_time=target_time, description='single'),
+            await Reminder.create(user=user, channel_id=11, reminder_type=ReminderType.daily,
+                                  target_time=target_time, description='daily'),
+            await Reminder.create(user=user, channel_id=11, reminder_type=ReminderType.daily,
+                                  target_time=target_time, description='daily'),
+        ]
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        assert [c.send.await_count for c in cog.bot.channels.values()] == [1, 1]
+        cog.bot.channels[11].send.assert_awaited_once_with('<@1>\ndaily\n\n<@1>\ndaily')
+        remaining = await Reminder.all().order_by('id')
+        assert [r.id for r in remaining] == [reminders[1].id, reminders[2].id]
+        assert all(r.target_time == target_time + dt.timedelta(days=1) for r in remaining)
+        assert reminders[1].id in cog.scheduler
+
+    @pytest.mark.asyncio
+    async def test_latency_metrics(self, db, cog, now, caplog):
+        stages = {stage: metrics.histogram('reminder_stage_seconds', stage=stage).count for stage in REMINDER_STAGES}
+        lag = metrics.histogram('reminder_drift_seconds').count
+        await create_reminders(3, now - dt.timedelta(seconds=5))
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        assert metrics.histogram('reminder_drift_seconds').count == lag + 3
+        assert metrics.histogram('reminder_drift_seconds').quantile(1) >= 5
+        for stage, count in stages.items():
+            assert metrics.histogram('reminder_stage_seconds', stage=stage).count > count
+        with caplog.at_level(logging.INFO, logger='cogs.reminder.cog'):
+            await cog.log_latency()
+            await cog.log_latency()
+        assert len(caplog.records) == 1
+        assert 'send (s): p50=' in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_latency_summary_survives_errors(self, cog, mocker, caplog):
+        cog._summarized_outcomes = None
+        mocker.patch.object(metrics, 'histogram', side_effect=ValueError('odd histogram'))
+        with caplog.at_level(logging.ERROR, logger='cogs.reminder.cog'):
+            await cog.log_latency.coro(cog)
+        assert 'Failed to summarize reminder latencies' in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_message_length(self, db, cog, now):
+        user = await User.create(id=1)
+        for _ in range(5):
+            await Reminder.create(user=user, channel_id=10, reminder_type=ReminderType.single, target_time=now,
+                                  description='x' * 900)
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        messages = [call.args[0] for call in cog.bot.channels[10].send.await_args_list]
+        assert [len(m) for m in messages] == [2 * 905 + 2, 2 * 905 + 2, 905]
+
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency(self, db, cog, now):
+        cog.max_concurrent_sends = 3
+        running = peak = 0
+
+        async def send_reminders(reminders):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if reminders[0].id == 1:
+                raise discord.HTTPException(MagicMock(status=500), 'error')
+
+        cog._send_reminders = send_reminders
+        user = await User.create(id=1)
+        for i in range(1, 11):
+            await Reminder.create(user=user, channel_id=i, reminder_type=ReminderType.single, target_time=now,
+                                  description='')
+        sent = metrics.counter('reminder_sent_total').value
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        assert peak == 3
+        # Failed deliveries are completed too, but not counted as sent
+        assert await Reminder.all().count() == 0
+        assert metrics.counter('reminder_sent_total').value == sent + 9
+
+    @pytest.mark.asyncio
+    async def test_loop_survives_errors(self, db, cog, now, mocker, caplog):
+        cog.error_backoff = dt.timedelta(0)
+        reminders = await create_reminders(2, now - dt.timedelta(seconds=1))
+        mocker.patch.object(cog.scheduler, 'next_due', AsyncMock(return_value=[r.id for r in reminders]))
+        claim_ids = cog.store.claim_ids
+        failures = [ConnectionError('database unreachable')]
+
+        async def flaky_claim_ids(*args):
+            if failures:
+                raise failures.pop()
+            return await claim_ids(*args)
+
+        cog.store.claim_ids = flaky_claim_ids
+        with caplog.at_level(logging.ERROR, logger='cogs.reminder.cog'):
+            await cog.check_reminders.coro(cog)
+        assert 'Failed to fire due reminders' in caplog.text
+        assert cog.bot.channels == {}
+        await cog.check_reminders.coro(cog)
+        cog.bot.channels[1].send.assert_awaited_once()
+        assert await Reminder.all().count() == 0
+        assert cog._consecutive_failures == 0
+
+    @pytest.mark.asyncio
+    async def test_reclaim_survives_errors(self, db, cog, now, mocker, caplog):
+        await create_reminders(1, now - dt.timedelta(seconds=1))
+        claim = mocker.patch.object(cog.store, 'claim', AsyncMock(side_effect=ConnectionError('database unreachable')))
+        with caplog.at_level(logging.ERROR, logger='cogs.reminder.cog'):
+            await cog.reclaim_reminders.coro(cog)
+        assert 'Failed to reclaim due reminders' in caplog.text
+        mocker.stop(claim)
+        await cog.reclaim_reminders.coro(cog)
+        cog.bot.channels[1].send.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_fires_what_scheduler_found_due(self, db, cog, now, mocker):
+        reminders = await create_reminders(3, now - dt.timedelta(seconds=1))
+        mocker.patch.object(cog.scheduler, 'next_due', AsyncMock(return_value=[reminders[0].id, reminders[1].id]))
+        await cog.check_reminders.coro(cog)
+        # Due reminders the scheduler didn't come up with are left to `reclaim_reminders`
+        assert [r.id for r in await Reminder.all()] == [reminders[2].id]
+
+
+async def create_reminders(count: int, target_time: dt.datetime) -> list[Reminder]:
+    user, _ = await User.get_or_create(id=1)
+    await Reminder.bulk_create([Reminder(user=user, channel_id=1, reminder_type=ReminderType.single,
+                                         target_time=target_time, description='') for _ in range(count)])
+    return await Reminder.all()
+
+
+@contextlib.asynccontextmanager
+async def database_timezone(name: str):
+    """Sets the TimeZone of sessions on the test database for the duration of the block."""
+    conn = connections.get('default')
+    await conn.execute_script(f"ALTER DATABASE {conn.database} SET TimeZone = '{name}'")
+    try:
+        # Only new connections pick it up
+        await conn.close()
+        assert (await conn.execute_query_dict('SHOW TimeZone'))[0]['TimeZone'] == name
+        yield
+    finally:
+        await conn.execute_script(f'ALTER DATABASE {conn.database} RESET TimeZone')
+
+
+class TestClaimDueReminders:
+    lease = dt.timedelta(minutes=5)
+    grace = dt.timedelta(0)
+
+    @pytest.mark.asyncio
+    async def test_claim(self, db, now):
+        await create_reminders(3, now - dt.timedelta(minutes=1))
+        await create_reminders(1, now + dt.timedelta(minutes=1))
+        assert len(await claim_due_reminders('a', 2, self.lease, self.grace)) == 2
+        assert len(await claim_due_reminders('b', 10, self.lease, self.grace)) == 1
+        assert await claim_due_reminders('c', 10, self.lease, self.grace) == []
+        assert await Reminder.filter(lease_owner='a').count() == 2
+
+    @pytest.mark.asyncio
+    async def test_expired_lease(self, db, now):
+        await create_reminders(2, now - dt.timedelta(minutes=1))
+        assert len(await claim_due_reminders('crashed', 10, -self.lease, self.grace)) == 2
+        assert len(await claim_due_reminders('b', 10, self.lease, self.grace)) == 2
+        assert await Reminder.filter(lease_owner='b').count() == 2
+
+    @pytest.mark.asyncio
+    async def test_completion_requires_lease(self, db, cog, now):
+        reminders = await create_reminders(1, now - dt.timedelta(minutes=1))
+        await claim_due_reminders('other', 10, self.lease, self.grace)
+        await cog._dispatch(reminders)
+        assert await Reminder.all().count() == 1
+
+    @pytest.mark.asyncio
+    async def test_concurrent_claims(self, pg_db, now):
+        await create_reminders(100, now - dt.timedelta(minutes=1))
+        claims = await asyncio.gather(*(claim_due_reminders(f'worker{i}', 10, self.lease, self.grace)
+                                        for i in range(20)))
+        claimed = [reminder_id for claim in claims for reminder_id in claim]
+        assert len(claimed) == len(set(claimed)) == 100
+
+
+def test_next_daily_occurrence(now):
+    day = dt.timedelta(days=1)
+    assert next_daily_occurrence(now - dt.timedelta(seconds=1), now) == now - dt.timedelta(seconds=1) + day
+    assert next_daily_occurrence(now - 3 * day - dt.timedelta(hours=1), now) == now + dt.timedelta(hours=23)
+    assert next_daily_occurrence(now - 2 * day, now) == now + day
+    # Not due yet: the next occurrence is the day after
+    assert next_daily_occurrence(now + dt.timedelta(hours=1), now) == now + day + dt.timedelta(hours=1)
+
+
+class TestMissedReminders:
+    @pytest_asyncio.fixture
+    async def missed(self, db, now):
+        user = await User.create(id=1)
+        for reminder_type in (ReminderType.single, ReminderType.daily):
+            for days in (0.5, 3.5):
+                await Reminder.create(user=user, channel_id=10, reminder_type=reminder_type,
+                                      target_time=now - dt.timedelta(days=days), description='')
+        await Reminder.create(user=user, channel_id=10, reminder_type=ReminderType.single,
+                              target_time=now + dt.timedelta(hours=1), description='')
+
+    @pytest.mark.asyncio
+    async def test_skip(self, missed, cog, now):
+        cog.missed_policy = MissedReminderPolicy.skip
+        await cog._catch_up()
+        assert cog.bot.channels == {}
+        remaining = await Reminder.all()
+        assert len(remaining) == 3
+        assert all(now < r.target_time <= now + dt.timedelta(days=1) for r in remaining)
+        assert cog._caught_up.is_set()
+
+    @pytest.mark.asyncio
+    async def test_skip_across_dst(self, pg_db, now):
+        user = await User.create(id=1)
+        # Missed for long enough that some of them span a DST change in Warsaw
+        target_times = [now - dt.timedelta(days=30 * i, minutes=i) for i in range(1, 13)]
+        for target_time in target_times:
+            await Reminder.create(user=user, channel_id=10, reminder_type=ReminderType.daily, target_time=target_time,
+                                  description='')
+        async with database_timezone('Europe/Warsaw'):
+            await skip_missed_reminders()
+        moved = await Reminder.all().order_by('id').values_list('target_time', flat=True)
+        for target_time, moved_to in zip(target_times, moved):
+            assert abs(moved_to - next_daily_occurrence(target_time, now)) < dt.timedelta(seconds=5)
+
+    @pytest.mark.asyncio
+    async def test_skip_keeps_leased(self, missed, now):
+        await claim_due_reminders('other', 1, dt.timedelta(minutes=5), dt.timedelta(0))
+        assert await skip_missed_reminders() == (1, 2)
+
+    @pytest.mark.asyncio
+    async def test_fire(self, missed, cog, now, mocker):
+        cog.batch_size = 2
+        claim = mocker.spy(cog.store, 'claim')
+        await cog._catch_up()
+        # Claimed a batch at a time, each under the regular lease
+        assert [call.args[1:3] for call in claim.await_args_list] == [(2, cog.lease)] * 3
+        # Each missed reminder fires once, however many days it was missed for
+        messages = [call.args[0] for call in cog.bot.channels[10].send.await_args_list]
+        assert sum(m.count('<@1>') for m in messages) == 4
+        remaining = await Reminder.all()
+        assert len(remaining) == 3
+        assert all(now < r.target_time <= now + dt.timedelta(days=1) for r in remaining)
+        assert all(r.lease_owner is None for r in remaining)
+
+
+class TestReminderPaginator:
+    @pytest_asyncio.fixture
+    async def reminders(self, db, now):
+        user = await User.create(id=1)
+        await User.create(id=2)
+        # Several reminders share each target time, the id has to break ties
+        await Reminder.bulk_create([
+            Reminder(user=user, channel_id=None if i % 3 == 0 else 10,
+                     reminder_type=ReminderType.daily if i % 2 else ReminderType.single,
+                     target_time=now + dt.timedelta(minutes=i // 4), description=str(i))
+            for i in range(25)
+        ])
+        await Reminder.create(user_id=2, channel_id=10, reminder_type=ReminderType.single, target_time=now,
+                              description='')
+        return await Reminder.filter(user_id=1).order_by('target_time', 'id')
+
+    @pytest.mark.asyncio
+    async def test_pages(self, reminders):
+        paginator = ReminderPaginator(1, chunk_size=4)
+        await paginator.start()
+        assert len(paginator) == 25
+        assert paginator.chunk_count == 7
+        for index in range(25):
+            await paginator.load(index)
+            assert paginator[index].id == reminders[index].id
+        assert len(paginator.loaded_chunks) <= 3
+        for index in reversed(range(25)):
+            await paginator.load(index)
+            assert paginator[index].id == reminders[index].id
+
+    @pytest.mark.asyncio
+    async def test_prefetch(self, reminders):
+        paginator = ReminderPaginator(1, chunk_size=4)
+        await paginator.start()
+        await asyncio.sleep(0.01)
+        assert paginator.loaded_chunks == [0, 1]
+        await paginator.load(4)
+        await asyncio.sleep(0.01)
+        assert paginator.loaded_chunks == [0, 1, 2]
+
+    @pytest.mark.asyncio
+    async def test_jump(self, reminders):
+        paginator = ReminderPaginator(1, chunk_size=4)
+        await paginator.start()
+        await paginator.load(21)
+        assert paginator[21].id == reminders[21].id
+
+    @pytest.mark.asyncio
+    async def test_failed_page_turn(self, reminders, mocker):
+        paginator = ReminderPaginator(1, chunk_size=4)
+        await paginator.start()
+        interaction = MagicMock(created_at=discord.utils.utcnow())
+        interaction.response.edit_message = AsyncMock()
+        view = ReminderView(interaction, paginator)
+        load = mocker.patch.object(paginator, 'load', side_effect=ConnectionError)
+        with pytest.raises(ConnectionError):
+            await view.next_page.callback(interaction)
+        # Still on the page shown
+        assert view.page_index == 0
+        assert view.previous_page.disabled and not view.next_page.disabled
+        mocker.stop(load)
+        await view.next_page.callback(interaction)
+        assert view.page_index == 1
+        assert not view.previous_page.disabled
+        interaction.response.edit_message.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_filters(self, reminders):
+        paginator = ReminderPaginator(1, reminder_type=ReminderType.daily, location=ReminderChannel.dm, chunk_size=2)
+        await paginator.start()
+        expected = [r.id for r in reminders if r.reminder_type == ReminderType.daily and r.channel_id is None]
+        assert len(paginator) == len(expected)
+        for index in range(len(paginator)):
+            await paginator.load(index)
+            assert paginator[index].id == expected[index]
+
+    @pytest.mark.asyncio
+    async def test_deleted_meanwhile(self, reminders):
+        paginator = ReminderPaginator(1, chunk_size=4)
+        await paginator.start()
+        await Reminder.filter(id__in=[r.id for r in reminders[20:]]).delete()
+        await paginator.load(22)
+        with pytest.raises(IndexError):
+            paginator[22]
+
+
+class TestTransfer:
+    @pytest_asyncio.fixture
+    async def reminders(self, db, now):
+        await User.create(id=1)
+        await Reminder.create(user_id=1, channel_id=10, guild_id=5, reminder_type=ReminderType.single,
+                              target_time=now.replace(microsecond=0) + dt.timedelta(days=1),
+                              description='Multi-line, with; special\\characters\n' + 'é' * 100)
+        await Reminder.create(user_id=1, reminder_type=ReminderType.daily,
+                              target_time=now.replace(microsecond=0) + dt.timedelta(hours=1), description='daily')
+        return await Reminder.all().order_by('id')
+
+    @staticmethod
+    async def export(exporter, user_id=None) -> str:
+        return ''.join([chunk async for chunk in exporter(iter_reminders(user_id, chunk_size=1))])
+
+    @staticmethod
+    def fields(reminders):
+        return [(r.user_id, r.guild_id, r.channel_id, r.reminder_type, r.target_time, r.description)
+                for r in reminders]
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('exporter,parser', [(export_csv, parse_csv), (export_ical, parse_ical)])
+    async def test_round_trip(self, reminders, exporter, parser):
+        text = await self.export(exporter)
+        await Reminder.all().delete()
+        assert await import_reminders(parser(text), user_id=None if parser is parse_csv else 1,
+                                      guild_id=5, channel_id=10) == (2, 0)
+        imported = await Reminder.all().order_by('id')
+        expected = self.fields(reminders)
+        if parser is parse_ical:
+            # Users and locations aren't part of calendar events, they come from the importer
+            expected = [(1, 5, 10, *fields[3:]) for fields in expected]
+        assert self.fields(imported) == expected
+
+    @pytest.mark.asyncio
+    async def test_ical_format(self, reminders):
+        text = await self.export(export_ical)
+        lines = text.split('\r\n')
+        assert lines[0] == 'BEGIN:VCALENDAR' and lines[-2] == 'END:VCALENDAR'
+        assert all(len(line.encode()) <= 75 for line in lines)
+        assert 'RRULE:FREQ=DAILY' in lines
+
+    def test_parse_ical(self, now):
+        text = (
+            'BEGIN:VCALENDAR\r\n'
+            'BEGIN:VEVENT\r\n'
+            'DTSTART;TZID=Europe/Warsaw:20300101T120000\r\n'
+            'SUMMARY:New year\r\n'
+            'BEGIN:VALARM\r\nDESCRIPTION:Alarm\r\nEND:VALARM\r\n'
+            'END:VEVENT\r\n'
+            'BEGIN:VEVENT\r\nDTSTART:20300101T120000Z\r\nRRULE:FREQ=WEEKLY\r\nSUMMARY:Weekly\r\nEND:VEVENT\r\n'
+            'END:VCALENDAR\r\n'
+        )
+        records = list(parse_ical(text))
+        assert len(records) == 1
+        assert records[0].description == 'New year'
+        assert records[0].target_time == dt.datetime(2030, 1, 1, 11, tzinfo=dt.timezone.utc)
+
+    @pytest.mark.parametrize('rule,daily', [
+        ('FREQ=DAILY', True),
+        ('freq=daily;interval=1', True),
+        ('FREQ=DAILY;INTERVAL=2', False),
+        ('FREQ=DAILY;COUNT=5', False),
+        ('FREQ=DAILY;UNTIL=20300110T000000Z', False),
+        ('FREQ=DAILY;BYDAY=MO,TU', False),
+        ('FREQ=WEEKLY', False),
+    ])
+    def test_parse_ical_rules(self, rule, daily):
+        text = (
+            'BEGIN:VCALENDAR\r\n'
+            f'BEGIN:VEVENT\r\nDTSTART:20300101T120000Z\r\nRRULE:{rule}\r\nEND:VEVENT\r\n'
+            'END:VCALENDAR\r\n'
+        )
+        records = list(parse_ical(text))
+        assert [record.reminder_type for record in records] == ([ReminderType.daily] if daily else [])
+
+    @pytest.mark.asyncio
+    async def test_past_due(self, db, now):
+        text = (
+            'reminder_type,target_time,description\n'
+            f'single,{(now - dt.timedelta(days=1)).isoformat()},past\n'
+            f'daily,{(now - dt.timedelta(days=3, hours=1)).isoformat()},daily\n'
+        )
+        assert await import_reminders(parse_csv(text), user_id=1) == (1, 1)
+        daily = await Reminder.get(description='daily')
+        assert daily.target_time == pytest.approx(now + dt.timedelta(hours=23), abs=dt.timedelta(seconds=1))
+
+    @pytest.mark.asyncio
+    async def test_all_or_nothing(self, db, now):
+        rows = ''.join(f'single,{(now + dt.timedelta(days=1)).isoformat()},{i}\n' for i in range(11))
+        with pytest.raises(TransferError):
+            await import_reminders(parse_csv('reminder_type,target_time,description\n' + rows), user_id=1,
+                                   limit=10, batch_size=3)
+        with pytest.raises(TransferError):
+            await import_reminders(parse_csv('reminder_type,target_time,description\n' + rows + 'weekly,x,y\n'),
+                                   user_id=1, batch_size=3)
+        assert await Reminder.all().count() == 0
+
+
+@pytest_asyncio.fixture
+async def archive_db(pg_db):
+    """Postgres database with migrations applied, archive partitions included."""
+    archive.forget_partitions()
+    await migrate()
+    yield
+    archive.forget_partitions()
+
+
+async def archive_reminder(fired_at: dt.datetime) -> None:
+    await connections.get('default').execute_query(
+        'INSERT INTO reminder_archive '
+        '(reminder_id, user_id, reminder_type, target_time, description, fired_at, delivered) '
+        "VALUES (1, 1, 1, $1, '', $1, TRUE)", [fired_at])
+
+
+async def archived_partitions() -> list[tuple[dt.datetime, str]]:
+    """Returns the firing times of archived reminders, with the partition each of them is in."""
+    rows = await connections.get('default').execute_query_dict(
+        'SELECT fired_at, tableoid::regclass::text AS partition FROM reminder_archive ORDER BY fired_at')
+    return [(row['fired_at'], row['partition']) for row in rows]
+
+
+async def partition_exists(name: str) -> bool:
+    rows = await connections.get('default').execute_query_dict('SELECT to_regclass($1) IS NOT NULL AS found', [name])
+    return rows[0]['found']
+
+
+class TestArchive:
+    def test_months(self):
+        assert archive.next_month(dt.date(2024, 12, 1)) == dt.date(2025, 1, 1)
+        assert archive.next_month(dt.date(2024, 1, 1)) == dt.date(2024, 2, 1)
+        assert archive.partition_name(archive.month_start(dt.datetime(2024, 3, 15))) == 'reminder_archive_2024_03'
+
+    @pytest.mark.asyncio
+    async def test_dispatch(self, archive_db, cog, now):
+        user = await User.create(id=1)
+        await Reminder.create(user=user, channel_id=10, reminder_type=ReminderType.single, target_time=now,
+                              description='single')
+        await Reminder.create(user=user, channel_id=11, reminder_type=ReminderType.daily, target_time=now,
+                              description='daily')
+        cog.store = PostgresReminderStore()
+        cog.bot.channels[11] = MagicMock(send=AsyncMock(side_effect=http_error(50013)))
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        rows = await connections.get('default').execute_query_dict(
+            'SELECT description, delivered FROM reminder_archive ORDER BY description')
+        assert rows == [{'description': 'daily', 'delivered': False}, {'description': 'single', 'delivered': True}]
+        assert await Reminder.all().count() == 1
+
+    @pytest.mark.asyncio
+    async def test_retention(self, archive_db, now):
+        for month in (dt.date(2020, 1, 1), dt.date(2020, 2, 1), archive.month_start(now)):
+            await archive.ensure_partition(month)
+        await archive_reminder(dt.datetime(2019, 6, 1, tzinfo=dt.timezone.utc))
+        dropped = await archive.drop_partitions(dt.datetime(2020, 2, 15, tzinfo=dt.timezone.utc))
+        assert dropped == ['reminder_archive_2020_01']
+        assert dt.date(2020, 1, 1) not in archive._partitions
+        # Also gone from the default partition
+        assert await archived_partitions() == []
+
+    @pytest.mark.asyncio
+    async def test_default_partition(self, archive_db):
+        fired_at = dt.datetime(2024, 5, 10, tzinfo=dt.timezone.utc)
+        await archive_reminder(fired_at)
+        assert await archived_partitions() == [(fired_at, 'reminder_archive_default')]
+        await archive.ensure_partition(fired_at)
+        assert await archived_partitions() == [(fired_at, 'reminder_archive_2024_05')]
+
+    @pytest.mark.asyncio
+    async def test_dispatch_without_partition(self, archive_db, cog, now, mocker):
+        mocker.patch('cogs.reminder.store.ensure_partition', side_effect=OSError)
+        user = await User.create(id=1)
+        await Reminder.create(user=user, channel_id=10, reminder_type=ReminderType.single, target_time=now,
+                              description='')
+        cog.store = PostgresReminderStore()
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        assert [partition for _, partition in await archived_partitions()] == ['reminder_archive_default']
+        assert await Reminder.all().count() == 0
+
+    @pytest.mark.asyncio
+    async def test_partitions_forgotten(self, archive_db, cog, now):
+        await cog.maintain_archive.coro(cog)
+        name = archive.partition_name(archive.month_start(now))
+        # Dropped behind the bot's back
+        await connections.get('default').execute_script(f'DROP TABLE {name}')
+        await archive.ensure_partition(now)
+        assert not await partition_exists(name)
+        await cog.maintain_archive.coro(cog)
+        assert await partition_exists(name)
+
+    @pytest.mark.asyncio
+    async def test_maintenance_survives_errors(self, archive_db, cog, now, mocker, caplog):
+        mocker.patch('cogs.reminder.cog.ensure_partition', side_effect=OSError)
+        with caplog.at_level(logging.ERROR, logger='cogs.reminder.cog'):
+            await cog.maintain_archive.coro(cog)
+        assert 'Failed to maintain the reminder archive' in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_non_utc_session(self, archive_db):
+        async with database_timezone('Pacific/Kiritimati'):
+            await archive.ensure_partition(dt.date(2024, 3, 1))
+            # In March only at UTC+14, in March either way, in March only in UTC
+            utc = dt.timezone.utc
+            for fired_at in (dt.datetime(2024, 2, 29, 20, tzinfo=utc), dt.datetime(2024, 3, 1, tzinfo=utc),
+                             dt.datetime(2024, 3, 31, 20, tzinfo=utc)):
+                await archive_reminder(fired_at)
+            assert [partition for _, partition in await archived_partitions()] == [
+                'reminder_archive_default', 'reminder_archive_2024_03', 'reminder_archive_2024_03']
+
+class TestUserRegistry:
+    @pytest.mark.asyncio
+    async def test_warm(self, db):
+        await User.bulk_create([User(id=i) for i in range(1, 26)])
+        registry = UserRegistry()
+        await registry.warm(chunk_size=10)
+        assert len(registry) == 25
+        assert 25 in registry
+
+    @pytest.mark.asyncio
+    async def test_ensure(self, db):
+        await User.create(id=1)
+        registry = UserRegistry()
+        # Created by someone else meanwhile, or not at all
+        await registry.ensure_many([1, 2, 2])
+        assert await User.all().count() == 2
+        assert 1 in registry and 2 in registry
+
+    @pytest.mark.asyncio
+    async def test_rolled_back_import(self, db, now):
+        text = f'user_id,reminder_type,target_time,description\n5,single,{(now + dt.timedelta(days=1)).isoformat()},'
+        with pytest.raises(TransferError):
+            await import_reminders(parse_csv(text + 'x' * 3000))
+        assert 5 not in user_registry
+        await import_reminders(parse_csv(text))
+        assert 5 in user_registry
+
+
+class TestReminderStore:
+    """The Postgres store has to behave exactly like the ORM one."""
+
+    @pytest.fixture(params=['orm', 'postgres'])
+    def store(self, request):
+        if request.param == 'orm':
+            request.getfixturevalue('db')
+            return ReminderStore()
+        request.getfixturevalue('archive_db')
+        return PostgresReminderStore()
+
+    @pytest.mark.asyncio
+    async def test_window(self, store, now):
+        await create_reminders(3, now)
+        await create_reminders(2, now + dt.timedelta(minutes=1))
+        assert len(await store.load_window(now + dt.timedelta(hours=1), 4)) == 5
+        assert len(await store.load_window(now + dt.timedelta(seconds=1), 10)) == 3
+        assert await store.earliest_target_time() == now
+
+    @pytest.mark.asyncio
+    async def test_fire(self, store, now):
+        reminders = await create_reminders(3, now)
+        await Reminder.filter(id=reminders[2].id).update(reminder_type=ReminderType.daily)
+        claimed = await store.claim('a', 10, dt.timedelta(minutes=5), dt.timedelta(0))
+        loaded = await store.load(claimed)
+        assert all(isinstance(reminder, DueReminder) for reminder in loaded)
+        assert [reminder.reminder_type for reminder in loaded].count(ReminderType.daily) == 1
+        tomorrow = now + dt.timedelta(days=1)
+        await store.complete('a', [reminders[0].id, reminders[1].id], {tomorrow: [reminders[2].id]}, [])
+        remaining = await Reminder.all()
+        assert [(r.id, r.target_time, r.lease_owner) for r in remaining] == [(reminders[2].id, tomorrow, None)]
+
+    @pytest.mark.asyncio
+    async def test_claim_ids(self, store, now):
+        reminders = await create_reminders(4, now)
+        ids = [reminder.id for reminder in reminders]
+        await store.claim_ids('other', ids[:1], dt.timedelta(minutes=5), now)
+        await Reminder.filter(id=ids[1]).update(target_time=now + dt.timedelta(days=1))
+        await Reminder.filter(id=ids[2]).delete()
+        # Only what's still due and not leased to someone else is claimed, whatever time the database thinks it is
+        claimed = await store.claim_ids('a', ids, dt.timedelta(minutes=5), now + dt.timedelta(seconds=2))
+        assert claimed == [ids[3]]
+        assert (await Reminder.get(id=ids[3])).lease_owner == 'a'
+
+
+class TestReminderChangeListener:
+    @pytest.mark.asyncio
+    async def test_handle(self, scheduler, now):
+        await scheduler.refill()
+        listener = ReminderChangeListener(scheduler)
+        listener.handle(json.dumps({'id': 1, 'target_time': now.timestamp()}))
+        assert 1 in scheduler
+        assert scheduler._peek() == (now, 1)
+        listener.handle(json.dumps({'id': 1}))
+        assert 1 not in scheduler
+
+    @pytest.mark.asyncio
+    async def test_retries_any_error(self, scheduler, mocker):
+        mocker.patch('cogs.reminder.notifications.connections', MagicMock())
+        connection = MagicMock(add_listener=AsyncMock(), close=AsyncMock())
+        connect = mocker.patch('cogs.reminder.notifications.asyncpg.connect',
+                               AsyncMock(side_effect=[RuntimeError('unexpected'), connection]))
+        listener = ReminderChangeListener(scheduler, retry_delay=0)
+        listener.start()
+        try:
+            await asyncio.sleep(0.01)
+            assert connect.await_count == 2
+            connection.add_listener.assert_awaited_once()
+        finally:
+            await listener.close()
+
+    @pytest.mark.asyncio
+    async def test_logs_when_stopped(self, scheduler, mocker, caplog):
+        listener = ReminderChangeListener(scheduler)
+        mocker.patch.object(listener, '_run', AsyncMock(side_effect=RuntimeError('bug')))
+        with caplog.at_level(logging.ERROR, logger='cogs.reminder.notifications'):
+            listener.start()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        assert 'Stopped listening for reminder changes' in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_notifications(self, pg_db, scheduler, now):
+        await migrate()
+        await scheduler.refill()
+        listener = ReminderChangeListener(scheduler)
+        listener.start()
+        try:
+            # Gives the listener time to connect
+            await asyncio.sleep(0.5)
+            reminder = (await create_reminders(1, now + dt.timedelta(minutes=1)))[0]
+            await asyncio.sleep(0.5)
+            assert reminder.id in scheduler
+            await reminder.delete()
+            await asyncio.sleep(0.5)
+            assert reminder.id not in scheduler
+        finally:
+            await listener.close()
+
+
+class TestQueryPlans:
+    """Checks that the queries the scheduler and commands run most often can use the indexes added by migrations."""
+
+    @staticmethod
+    async def explain(query: str) -> str:
+        async with in_transaction() as connection:
+            # Tables this small would be scanned sequentially regardless of indexes
+            await connection.execute_script('SET LOCAL enable_seqscan = off')
+            rows = await connection.execute_query_dict(f'EXPLAIN {query}')
+        return '\n'.join(row['QUERY PLAN'] for row in rows)
+
+    @pytest_asyncio.fixture
+    async def reminders(self, pg_db, now):
+        await migrate()
+        await create_reminders(500, now)
+        await connections.get('default').execute_script('ANALYZE reminder')
+
+    @pytest.mark.asyncio
+    async def test_window(self, reminders):
+        plan = await self.explain(
+            "SELECT id, target_time FROM reminder WHERE target_time < now() ORDER BY target_time LIMIT 10000")
+        assert 'reminder_target_time_idx' in plan
+        assert 'Sort' not in plan
+
+    @pytest.mark.asyncio
+    async def test_claim(self, reminders):
+        plan = await self.explain(
+            "SELECT id FROM reminder WHERE target_time <= now() "
+            "AND (lease_expires_at IS NULL OR lease_expires_at < now()) ORDER BY target_time LIMIT 500")
+        assert 'reminder_target_time_idx' in plan
+
+    @pytest.mark.asyncio
+    async def test_display(self, reminders, now):
+        plan = await self.explain(
+            f"SELECT * FROM reminder WHERE user_id = 1 AND (target_time > '{now.isoformat()}' OR "
+            f"(target_time = '{now.isoformat()}' AND id > 10)) ORDER BY target_time, id LIMIT 10")
+        assert 'reminder_user_id_target_time_id_idx' in plan
+        assert 'Sort' not in plan
+
+
+def http_error(code: int) -> discord.HTTPException:
+    return discord.HTTPException(MagicMock(status=403), {'code': code, 'message': ''})
+
+
+class TestDmReachability:
+    @pytest.fixture
+    def reachability(self):
+        return DmReachability(closed_ttl=dt.timedelta(minutes=10))
+
+    @pytest.mark.asyncio
+    async def test_send(self, db, reachability):
+        await User.create(id=1)
+        user = MagicMock(id=1, send=AsyncMock())
+        assert await reachability.send(user, 'hi') is True
+        assert reachability.get(1) is True
+        user.send.side_effect = http_error(50007)
+        assert await reachability.send(user, 'hi') is False
+        assert reachability.get(1) is False
+        assert (await User.get(id=1)).dm_open is False
+        user.send.side_effect = http_error(50001)
+        with pytest.raises(discord.HTTPException):
+            await reachability.send(user, 'hi')
+
+    @pytest.mark.asyncio
+    async def test_is_open(self, db, reachability):
+        await User.create(id=1)
+        user = MagicMock(id=1, send=AsyncMock(side_effect=http_error(50006)))
+        assert await reachability.is_open(user) is True
+        assert await reachability.is_open(user) is True
+        assert user.send.await_count == 1
+        # Known from the database after a restart
+        assert await DmReachability().is_open(user) is True
+        assert user.send.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_expiry(self, db, reachability, mocker):
+        await reachability.record(1, False)
+        assert reachability.get(1) is False
+        mocker.patch.object(reachability, '_now', return_value=reachability._now() + 601)
+        assert reachability.get(1) is None
+
+    @pytest.mark.asyncio
+    async def test_dispatch_to_closed_dms(self, db, cog, now, mocker):
+        reachability = DmReachability()
+        mocker.patch('cogs.reminder.cog.dm_reachability', reachability)
+        dm_user = MagicMock(id=1, send=AsyncMock(side_effect=http_error(50007)))
+        cog.bot.maybe_fetch_user = AsyncMock(return_value=dm_user)
+        await create_reminders(1, now)
+        await Reminder.all().update(channel_id=None)
+        await cog._claim_and_dispatch(cog.coalesce_window)
+        # A single attempt, no probing beforehand
+        dm_user.send.assert_awaited_once_with('<@1>\n')
+        assert reachability.get(1) is False
+        assert await Reminder.all().count() == 0
@@ -1,9 +1,19 @@
+import asyncio
 import datetime as dt
+from unittest.mock import AsyncMock, MagicMock
 
+import discord
 import pytest
+from tortoise import Tortoise, connections
 
 from tests.conftest import MockException
-from utils.misc import trim_by_paragraph, next_datetime, calculate_age, get_timezones, strptime, get_as_json, dm_open
+from utils.admission import AdmissionController, AdmissionRejected, TokenBucket, admission_controlled
+from utils.interactions import AutoDefer, ERROR_MESSAGE
+from utils.metrics import MetricsRegistry, metrics
+from utils.migrations import Migration, migrate, schema_version, sql, MIGRATIONS
+from utils.misc import pack_messages, trim_by_paragraph, next_datetime, calculate_age, get_timezones, strptime, \
+    get_as_json, dm_open, parse_json_stream
+from utils.timezones import TimezoneIndex, get_timezone_index, get_zone
 
 
 class TestTrimByParagraph:
@@ -52,6 +62,14 @@ class TestNextDatetime:
         assert next_datetime(current, hour=9, minute=30) == expected
 
 
+class TestPackMessages:
+    def test_combined(self):
+        assert pack_messages(['a' * 4, 'b' * 3, 'c' * 4], max_length=10) == ['aaaa\n\nbbb', 'cccc']
+
+    def test_too_long(self):
+        assert pack_messages(['a', 'b' * 25, 'c'], max_length=10) == ['a', 'b' * 10, 'b' * 10, 'b' * 5 + '\n\nc']
+
+
 class TestCalculateAge:
     born = dt.date(year=2000, month=6, day=6)
 
@@ -92,6 +110,34 @@ class TestGetAsJson:
         assert await get_as_json('mock_url') == expected
 
 
+class MockStream:
+    def __init__(self, data: bytes, chunk_size: int = 7):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    async def read(self, n: int = -1) -> bytes:
+        size = min(n, self.chunk_size) if n >= 0 else self.chunk_size
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+class TestParseJsonStream:
+    @pytest.mark.asyncio
+    async def test_handlers(self):
+        data = b'{"id": 1, "credits": {"cast": [{"name": "a", "roles": [{"x": 1}]}, {"name": "b"}], "crew": []}, ' \
+               b'"tags": ["c", "d"], "score": 7.5}'
+        cast, tags = [], []
+        parsed = await parse_json_stream(MockStream(data), {'credits.cast': cast.append, 'tags': tags.append})
+        assert parsed == {'id': 1, 'credits': {'cast': [], 'crew': []}, 'tags': [], 'score': 7.5}
+        assert cast == [{'name': 'a', 'roles': [{'x': 1}]}, {'name': 'b'}]
+        assert tags == ['c', 'd']
+
+    @pytest.mark.asyncio
+    async def test_no_handlers(self):
+        data = b'[{"a": [1, 2]}, null]'
+        assert await parse_json_stream(MockStream(data), {}) == [{'a': [1, 2]}, None]
+
+
 class TestDmOpen:
     @pytest.mark.asyncio
     async def test_is_open(self, mocker, mock_discord_user):
@@ -111,3 +157,322 @@ class TestDmOpen:
         mock_discord_user.send.side_effect = MockException(code=50008)
         with pytest.raises(MockException):
             await dm_open(mock_discord_user)
+
+
+class TestMetricsRegistry:
+    def test_labels(self):
+        registry = MetricsRegistry()
+        registry.counter('shed_total', reason='user').inc()
+        registry.counter('shed_total', reason='user').inc(2)
+        registry.counter('shed_total', reason='guild').inc()
+        registry.gauge('queue_depth').set(4)
+        assert registry.render() == (
+            'queue_depth 4\n'
+            'shed_total{reason="guild"} 1\n'
+            'shed_total{reason="user"} 3'
+        )
+        assert registry.render('shed') == 'shed_total{reason="guild"} 1\nshed_total{reason="user"} 3'
+
+    def test_type_mismatch(self):
+        registry = MetricsRegistry()
+        registry.counter('requests')
+        with pytest.raises(TypeError):
+            registry.gauge('requests')
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency')
+        assert histogram.quantile(0.5) is None
+        for value in range(1, 101):
+            histogram.observe(value)
+        assert histogram.quantiles(0.5, 0.95, 0.99) == [51, 96, 100]
+        assert 'latency_p99 100' in registry.render()
+        assert histogram.summary() == 'p50=51 p95=96 p99=100 (n=100)'
+
+    def test_histogram_time(self):
+        histogram = MetricsRegistry().histogram('latency')
+        assert histogram.summary() == 'no data'
+        with pytest.raises(ValueError):
+            with histogram.time():
+                raise ValueError()
+        assert histogram.count == 1
+        assert 0 <= histogram.sum < 1
+
+
+class TestTokenBucket:
+    def test_burst_and_refill(self):
+        bucket = TokenBucket(rate=1, capacity=2, now=0)
+        assert bucket.try_take(0)
+        assert bucket.try_take(0)
+        assert not bucket.try_take(0.5)
+        assert bucket.try_take(1)
+        assert bucket.is_full(10)
+
+
+class TestAdmissionController:
+    @pytest.fixture
+    def controller(self, request):
+        return AdmissionController(request.node.name, max_in_flight=1, max_queue=1, queue_timeout=0.05)
+
+    def test_user_bucket(self, controller):
+        for _ in range(controller.user_burst):
+            controller._take_tokens(1, None)
+        with pytest.raises(AdmissionRejected):
+            controller._take_tokens(1, None)
+        controller._take_tokens(2, None)
+        assert metrics.counter('admission_shed_total', controller=controller.name, reason='user').value == 1
+
+    def test_guild_bucket_refunds_user(self, controller):
+        controller.guild_burst = 1
+        controller._take_tokens(1, 10)
+        with pytest.raises(AdmissionRejected):
+            controller._take_tokens(1, 10)
+        assert controller._user_buckets[1].tokens == pytest.approx(controller.user_burst - 1, abs=0.01)
+
+    @pytest.mark.asyncio
+    async def test_queue(self, controller):
+        order = []
+
+        async def command(name, delay):
+            async with controller.admit(hash(name), None):
+                order.append(name)
+                await asyncio.sleep(delay)
+
+        first = asyncio.create_task(command('first', 0.02))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(command('second', 0))
+        await asyncio.sleep(0)
+        assert len(controller._waiters) == 1
+        with pytest.raises(AdmissionRejected):
+            await command('third', 0)
+        await asyncio.gather(first, second)
+        assert order == ['first', 'second']
+        assert controller.in_flight == 0
+        assert metrics.counter('admission_shed_total', controller=controller.name, reason='queue_full').value == 1
+
+    @pytest.mark.asyncio
+    async def test_deadline(self, controller):
+        async def command(delay):
+            async with controller.admit(1, None):
+                await asyncio.sleep(delay)
+
+        slow = asyncio.create_task(command(0.2))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await command(0)
+        assert not controller._waiters
+        await slow
+        assert controller.in_flight == 0
+        assert metrics.counter('admission_shed_total', controller=controller.name, reason='deadline').value == 1
+
+    @pytest.mark.asyncio
+    async def test_decorator(self, controller):
+        controller.user_burst = 1
+
+        @admission_controlled(controller)
+        async def callback(self, interaction):
+            return 'ran'
+
+        interaction = MagicMock(guild_id=None)
+        interaction.response.send_message = AsyncMock()
+        assert await callback(None, interaction) == 'ran'
+        assert await callback(None, interaction) is None
+        interaction.response.send_message.assert_awaited_once()
+        assert interaction.response.send_message.await_args.kwargs == {'ephemeral': True}
+
+
+class TestAutoDefer:
+    @pytest.fixture
+    def interaction(self):
+        interaction = MagicMock()
+        interaction.command.qualified_name = 'test'
+        interaction.created_at = discord.utils.utcnow()
+        state = {'done': False}
+        interaction.response.is_done = lambda: state['done']
+
+        async def respond(*args, **kwargs):
+            await asyncio.sleep(0.01)
+            state['done'] = True
+
+        for method in ('send_message', 'edit_message', 'defer'):
+            setattr(interaction.response, method, AsyncMock(side_effect=respond))
+        interaction.edit_original_response = AsyncMock()
+        interaction.followup.send = AsyncMock()
+        return interaction
+
+    @pytest.mark.asyncio
+    async def test_fast(self, interaction):
+        async with AutoDefer(interaction, budget=0.05) as responder:
+            await responder.send('first')
+            await responder.send('second')
+        interaction.response.defer.assert_not_awaited()
+        interaction.response.send_message.assert_awaited_once_with('first')
+        interaction.followup.send.assert_awaited_once_with('second')
+
+    @pytest.mark.asyncio
+    async def test_slow(self, interaction):
+        async with AutoDefer(interaction, budget=0.01, ephemeral=True) as responder:
+            await asyncio.sleep(0.05)
+            await responder.send('answer', ephemeral=True)
+        interaction.response.defer.assert_awaited_once_with(thinking=True, ephemeral=True)
+        interaction.response.send_message.assert_not_awaited()
+        interaction.edit_original_response.assert_awaited_once_with(content='answer')
+        assert metrics.counter('interaction_answers_total', command='test', deferred='true').value >= 1
+
+    @pytest.mark.asyncio
+    async def test_slow_file(self, interaction):
+        file = MagicMock()
+        async with AutoDefer(interaction, budget=0) as responder:
+            await asyncio.sleep(0.02)
+            await responder.send(file=file)
+        interaction.edit_original_response.assert_awaited_once_with(content=None, attachments=[file])
+
+    @pytest.mark.asyncio
+    async def test_answer_during_deferral(self, interaction):
+        async with AutoDefer(interaction, budget=0, edit=True) as responder:
+            # Let the deferral request start, but not complete
+            await asyncio.sleep(0.001)
+            await responder.send(embed='embed')
+        interaction.response.defer.assert_awaited_once_with()
+        interaction.response.edit_message.assert_not_awaited()
+        interaction.edit_original_response.assert_awaited_once_with(content=None, embed='embed')
+
+    @pytest.mark.asyncio
+    async def test_visibility_mismatch(self, interaction):
+        async with AutoDefer(interaction, budget=0) as responder:
+            await asyncio.sleep(0.02)
+            with pytest.raises(ValueError):
+                await responder.send('answer', ephemeral=True)
+        interaction.edit_original_response.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_reject(self, interaction):
+        async with AutoDefer(interaction, budget=0.05) as responder:
+            await responder.reject('invalid')
+        interaction.response.send_message.assert_awaited_once_with('invalid', ephemeral=True)
+
+    @pytest.mark.asyncio
+    async def test_reject_after_public_deferral(self, interaction):
+        interaction.delete_original_response = AsyncMock()
+        async with AutoDefer(interaction, budget=0) as responder:
+            await asyncio.sleep(0.02)
+            await responder.reject('invalid')
+        interaction.delete_original_response.assert_awaited_once()
+        interaction.followup.send.assert_awaited_once_with('invalid', ephemeral=True)
+        interaction.edit_original_response.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_error_after_deferral(self, interaction):
+        with pytest.raises(RuntimeError):
+            async with AutoDefer(interaction, budget=0, ephemeral=True):
+                await asyncio.sleep(0.02)
+                raise RuntimeError
+        interaction.followup.send.assert_awaited_once_with(ERROR_MESSAGE, ephemeral=True)
+
+    @pytest.mark.asyncio
+    async def test_error_before_deferral(self, interaction):
+        with pytest.raises(RuntimeError):
+            async with AutoDefer(interaction, budget=0.05):
+                raise RuntimeError
+        interaction.followup.send.assert_not_awaited()
+
+    @pytest.mark.asyncio
+    async def test_elapsed_budget(self, interaction):
+        interaction.created_at -= dt.timedelta(seconds=5)
+        async with AutoDefer(interaction) as responder:
+            await asyncio.sleep(0.02)
+            assert responder.deferred
+
+
+class TestMigrate:
+    @pytest.mark.asyncio
+    async def test_migrate(self, pg_db):
+        latest = MIGRATIONS[-1].version
+        assert await migrate() == list(range(1, latest + 1))
+        assert await schema_version(connections.get('default')) == latest
+        assert await migrate() == []
+
+    @pytest.mark.asyncio
+    async def test_schema_matches_models(self, pg_db):
+        # The baseline is frozen, a model changed without a migration to go with it shows up here
+        await migrate()
+        connection = connections.get('default')
+        for model in Tortoise.apps['models'].values():
+            rows = await connection.execute_query_dict(
+                'SELECT column_name FROM information_schema.columns WHERE table_name = $1', [model._meta.db_table])
+            columns = {row['column_name'] for row in rows}
+            assert set(model._meta.fields_db_projection.values()) <= columns, model.__name__
+
+    @pytest.mark.asyncio
+    async def test_failed_migration(self, pg_db):
+        broken = MIGRATIONS + [Migration(MIGRATIONS[-1].version + 1, 'Broken', sql('SELECT * FROM missing_table'))]
+        with pytest.raises(Exception):
+            await migrate(broken)
+        # Applied together or not at all
+        assert await schema_version(connections.get('default')) == 0
+
+
+class TestTimezoneIndex:
+    @pytest.fixture
+    def index(self):
+        return get_timezone_index()
+
+    @pytest.mark.parametrize('query,expected', [
+        ('warsaw', 'Europe/Warsaw'),
+        ('WARS', 'Europe/Warsaw'),
+        ('new york', 'America/New_York'),
+        ('new_y', 'America/New_York'),
+        ('york', 'America/New_York'),
+        ('kolkata', 'Asia/Kolkata'),
+        # Typos
+        ('warsw', 'Europe/Warsaw'),
+        ('londn', 'Europe/London'),
+    ])
+    def test_best_match(self, index, query, expected):
+        assert index.search(query)[0] == expected
+
+    def test_region(self, index):
+        results = index.search('europe', limit=100)
+        assert 'Europe/Warsaw' in results
+        assert all(name.startswith('Europe/') for name in results)
+
+    def test_abbreviation(self, index):
+        # Abbreviations are indexed for both standard and daylight saving time
+        assert 'Europe/Warsaw' in index.search('cet', limit=100)
+        assert 'Europe/Warsaw' in index.search('cest', limit=100)
+        assert 'America/Los_Angeles' in index.search('pst', limit=100)
+
+    def test_offset(self, index):
+        offset = dt.datetime.now(get_zone('Asia/Kolkata')).utcoffset()
+        assert offset == dt.timedelta(hours=5, minutes=30)
+        for query in ('utc+5:30', 'UTC+05:30', '+0530', 'gmt +5:30'):
+            assert 'Asia/Kolkata' in index.search(query, limit=100)
+
+    def test_ranking(self, index):
+        # Exact matches first, canonical zones before legacy aliases within the same tier
+        assert index.search('calcutta')[0] == 'Asia/Calcutta'
+        results = index.search('ist', limit=100)
+        assert results.index('Asia/Kolkata') < results.index('Asia/Calcutta')
+
+    def test_limit(self, index):
+        assert len(index.search('')) == 25
+        assert index.search('')[0] == 'UTC'
+        assert len(index.search('a', limit=10)) == 10
+        assert index.search('qqqq') == []
+
+    def test_cache(self):
+        index = TimezoneIndex({'Europe/Warsaw', 'Europe/London'})
+        results = index.search('europe')
+        results.clear()
+        assert index.search('europe') == ['Europe/London', 'Europe/Warsaw']
+        index._day = None
+        assert index.search('europe') == ['Europe/London', 'Europe/Warsaw']
+        assert list(index._cache) == [('europe', 25)]
+
+    def test_label(self):
+        index = TimezoneIndex({'UTC', 'Asia/Kolkata'})
+        assert index.label('UTC') == 'UTC (UTC+00:00)'
+        assert index.label('Asia/Kolkata') == 'Asia/Kolkata (UTC+05:30, IST)'
+
+    def test_zone_cache(self):
+        assert get_zone('Europe/Warsaw') is get_zone('Europe/Warsaw')
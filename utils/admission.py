@@ -0,0 +1,182 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import time
+
+import discord
+
+from utils.metrics import metrics
+
+
+class AdmissionRejected(Exception):
+    """Raised when a command is shed instead of being run. The message is meant to be shown to the user."""
+
+
+class TokenBucket:
+    """Allows `capacity` actions at once, refilling at `rate` actions per second."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """Decides whether an expensive command may run right now.
+
+    Every user and every guild gets a token bucket, so that a single user (or server) spamming commands only throttles
+    themselves. On top of that, at most `max_in_flight` commands run at the same time. Commands over that cap wait in
+    a queue for up to `queue_timeout` seconds, which has to leave enough time to answer within Discord's 3 second
+    interaction window. Commands that can't get a slot in time, or find the queue full, are shed.
+
+    Queue depth, commands in flight and shed counts are published in `utils.metrics.metrics` under the
+    ``admission_`` prefix.
+    """
+    max_buckets = 10_000
+
+    def __init__(
+            self,
+            name: str,
+            *,
+            user_rate: float = 0.5,
+            user_burst: int = 5,
+            guild_rate: float = 2.0,
+            guild_burst: int = 20,
+            max_in_flight: int = 8,
+            max_queue: int = 32,
+            queue_timeout: float = 2.0,
+    ):
+        self.name = name
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._user_buckets: dict[int, TokenBucket] = {}
+        self._guild_buckets: dict[int, TokenBucket] = {}
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._in_flight_gauge = metrics.gauge('admission_in_flight', controller=name)
+        self._queue_gauge = metrics.gauge('admission_queue_depth', controller=name)
+        self._admitted = metrics.counter('admission_admitted_total', controller=name)
+        self._queue_wait = metrics.histogram('admission_queue_wait_seconds', controller=name)
+
+    @staticmethod
+    def _now() -> float:
+        return time.monotonic()
+
+    def _shed(self, reason: str, message: str) -> AdmissionRejected:
+        metrics.counter('admission_shed_total', controller=self.name, reason=reason).inc()
+        return AdmissionRejected(message)
+
+    def _bucket(self, buckets: dict[int, TokenBucket], key: int, rate: float, capacity: int, now: float) -> TokenBucket:
+        if (bucket := buckets.get(key)) is None:
+            if len(buckets) >= self.max_buckets:
+                # Full buckets behave exactly like new ones, so they can be dropped without changing anything
+                for idle in [k for k, b in buckets.items() if b.is_full(now)]:
+                    del buckets[idle]
+            bucket = buckets[key] = TokenBucket(rate, capacity, now)
+        return bucket
+
+    def _take_tokens(self, user_id: int, guild_id: int | None) -> None:
+        now = self._now()
+        user_bucket = self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst, now)
+        if not user_bucket.try_take(now):
+            raise self._shed('user', "You're going a bit fast, try again in a few seconds.")
+        if guild_id is not None:
+            guild_bucket = self._bucket(self._guild_buckets, guild_id, self.guild_rate, self.guild_burst, now)
+            if not guild_bucket.try_take(now):
+                user_bucket.refund()
+                raise self._shed('guild', 'This server is sending a lot of requests, try again in a few seconds.')
+
+    async def _acquire_slot(self) -> None:
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self._in_flight_gauge.set(self.in_flight)
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise self._shed('queue_full', "I'm a bit overloaded right now, try again in a moment.")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._queue_gauge.set(len(self._waiters))
+        started_at = self._now()
+        try:
+            # A released slot is handed over directly to the waiter, see `_release_slot`
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over right as the deadline passed, in which case it's still ours to use
+            if not waiter.done() or waiter.cancelled():
+                raise self._shed('deadline', "I'm a bit overloaded right now, try again in a moment.") from None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            raise
+        finally:
+            with contextlib.suppress(ValueError):
+                self._waiters.remove(waiter)
+            self._queue_gauge.set(len(self._waiters))
+        self._queue_wait.observe(self._now() - started_at)
+
+    def _release_slot(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._queue_gauge.set(len(self._waiters))
+                return
+        self.in_flight -= 1
+        self._in_flight_gauge.set(self.in_flight)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id: int, guild_id: int | None):
+        """Runs the enclosed block if the command is admitted, raises `AdmissionRejected` otherwise."""
+        self._take_tokens(user_id, guild_id)
+        await self._acquire_slot()
+        self._admitted.inc()
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+
+def admission_controlled(controller: AdmissionController):
+    """Runs an interaction callback (command or component) through the controller.
+
+    Shed interactions get an ephemeral message explaining why, instead of running the callback.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, interaction: discord.Interaction, *args, **kwargs):
+            try:
+                async with controller.admit(interaction.user.id, interaction.guild_id):
+                    return await func(self, interaction, *args, **kwargs)
+            except AdmissionRejected as e:
+                await interaction.response.send_message(str(e), ephemeral=True)
+
+        return wrapper
+
+    return decorator
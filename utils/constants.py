@@ -1,5 +1,7 @@
 COLOR_EMBED_DARK = 0x2F3136
 
+MESSAGE_MAX_LENGTH = 2000
+
 EMBED_TITLE_MAX_LENGTH = 256
 EMBED_DESC_MAX_LENGTH = 4096
 EMBED_DESC_MAX_FIELDS = 25
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+import discord
+
+from utils.metrics import metrics
+
+_log = logging.getLogger(__name__)
+
+# Discord gives 3 seconds for the initial response, the rest is left for the deferral request itself to get through
+DEFER_BUDGET = 2.0
+ERROR_MESSAGE = 'Error: Something went wrong, try again later.'
+
+
+class AutoDefer:
+    """Answers an interaction in time, even when the work that precedes the answer is slow.
+
+    If nothing was sent `budget` seconds after the interaction was created, the interaction gets deferred. `send` then
+    delivers the answer as the initial response if there's still time, or by editing the deferred response otherwise.
+    Anything sent after the answer goes out as a followup.
+
+    ::
+
+        async with AutoDefer(interaction) as responder:
+            movie = await client.get_movie(movie_id)
+            await responder.send(embed=...)
+
+    With ``edit=True`` the answer edits the message the component belongs to, like `InteractionResponse.edit_message`.
+    Deferred command answers keep the visibility chosen when deferring, so commands answering ephemerally should pass
+    ``ephemeral=True``. Answers asking for another visibility raise ValueError, deferred or not, so that the mismatch
+    shows up on the first try rather than only when the answer happens to be slow.
+
+    `reject` answers with a message only the user sees (e.g. about invalid input), whatever the deferral's visibility.
+
+    If the block raises after the interaction was deferred, an error message is sent in place of the answer, so that the
+    user isn't left with a response that never arrives. The exception is propagated either way.
+
+    How many answers had to be deferred and how long they took is recorded in `utils.metrics.metrics` under the
+    ``interaction_`` prefix.
+    """
+
+    def __init__(
+            self,
+            interaction: discord.Interaction,
+            *,
+            budget: float = DEFER_BUDGET,
+            edit: bool = False,
+            ephemeral: bool = False,
+    ):
+        self.interaction = interaction
+        self.budget = budget
+        self.edit = edit
+        self.ephemeral = ephemeral
+        self.deferred = False
+        self.answered = False
+        self.name = interaction.command.qualified_name if interaction.command else 'component'
+        self._deferring = False
+        self._timer: asyncio.Task | None = None
+
+    def elapsed(self) -> float:
+        """Returns the amount of seconds since the interaction was created."""
+        return max(0.0, (discord.utils.utcnow() - self.interaction.created_at).total_seconds())
+
+    async def __aenter__(self) -> 'AutoDefer':
+        self._timer = asyncio.create_task(self._defer_at_deadline())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self._stop_timer()
+        if exc_type is not None and self.deferred and not self.answered:
+            try:
+                await self.interaction.followup.send(ERROR_MESSAGE, ephemeral=self.ephemeral)
+            except discord.HTTPException as e:
+                _log.warning(f'Failed to report an error for "{self.name}": {e}')
+
+    async def _defer_at_deadline(self) -> None:
+        await asyncio.sleep(max(0.0, self.budget - self.elapsed()))
+        # From here on the deferral is awaited rather than cancelled, see `_stop_timer`
+        self._deferring = True
+        if self.interaction.response.is_done():
+            return
+        if self.edit:
+            await self.interaction.response.defer()
+        else:
+            await self.interaction.response.defer(thinking=True, ephemeral=self.ephemeral)
+        self.deferred = True
+        metrics.histogram('interaction_defer_seconds', command=self.name).observe(self.elapsed())
+
+    async def _stop_timer(self) -> None:
+        if self._timer is None:
+            return
+        timer, self._timer = self._timer, None
+        if not self._deferring:
+            timer.cancel()
+            return
+        # The deferral request may already be on its way: answering before it completes would race with it
+        try:
+            await timer
+        except discord.HTTPException as e:
+            _log.warning(f'Failed to defer interaction for "{self.name}": {e}')
+
+    async def send(self, content: str | None = None, **kwargs) -> None:
+        """Sends the answer, or a followup if the answer was already sent. Takes the same arguments as
+        `InteractionResponse.send_message` (or `InteractionResponse.edit_message` when editing)."""
+        await self._stop_timer()
+        if self.answered:
+            await self.interaction.followup.send(content, **kwargs)
+            return
+        if not self.edit and kwargs.get('ephemeral', False) != self.ephemeral:
+            raise ValueError(f'Answer for "{self.name}" must have ephemeral={self.ephemeral} like its deferral.')
+        if self.deferred:
+            kwargs.pop('ephemeral', None)
+            # Files are added to an edited message as attachments
+            files = kwargs.pop('files', []) + ([kwargs.pop('file')] if 'file' in kwargs else [])
+            if files:
+                kwargs['attachments'] = files
+            await self.interaction.edit_original_response(content=content, **kwargs)
+        elif self.edit:
+            await self.interaction.response.edit_message(content=content, **kwargs)
+        else:
+            await self.interaction.response.send_message(content, **kwargs)
+        self.answered = True
+        metrics.counter('interaction_answers_total', command=self.name, deferred=str(self.deferred).lower()).inc()
+        metrics.histogram('interaction_answer_seconds', command=self.name).observe(self.elapsed())
+
+    async def reject(self, content: str) -> None:
+        """Answers with an ephemeral message. A public deferral can't be turned ephemeral, so it's deleted to make way
+        for an ephemeral followup."""
+        await self._stop_timer()
+        if self.answered or (self.deferred and self.edit):
+            await self.interaction.followup.send(content, ephemeral=True)
+        elif self.deferred and self.ephemeral:
+            await self.interaction.edit_original_response(content=content)
+        elif self.deferred:
+            await self.interaction.delete_original_response()
+            await self.interaction.followup.send(content, ephemeral=True)
+        else:
+            await self.interaction.response.send_message(content, ephemeral=True)
+        self.answered = True
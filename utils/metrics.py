@@ -0,0 +1,127 @@
+import collections
+import contextlib
+import time
+
+
+def _label_string(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+    """Monotonically increasing value."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int | float = 1) -> None:
+        self.value += amount
+
+    def render(self, name: str) -> list[str]:
+        return [f'{name} {self.value}']
+
+
+class Gauge:
+    """Value that can go up and down."""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: int | float) -> None:
+        self.value = value
+
+    def inc(self, amount: int | float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: int | float = 1) -> None:
+        self.value -= amount
+
+    def render(self, name: str) -> list[str]:
+        return [f'{name} {self.value}']
+
+
+class Histogram:
+    """Distribution of observed values.
+
+    Keeps the total count and sum, plus a window of the most recent observations that quantiles are computed from.
+    """
+
+    def __init__(self, window: int = 2048):
+        self.count = 0
+        self.sum = 0.0
+        self._recent = collections.deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self._recent.append(value)
+
+    def quantile(self, q: float) -> float | None:
+        """Returns the q-quantile (0 <= q <= 1) of recent observations, or None if nothing was observed yet."""
+        return self.quantiles(q)[0]
+
+    def quantiles(self, *qs: float) -> list[float | None]:
+        if not self._recent:
+            return [None for _ in qs]
+        ordered = sorted(self._recent)
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs]
+
+    @contextlib.contextmanager
+    def time(self):
+        """Observes how many seconds the enclosed block took, whether it succeeded or not."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at)
+
+    def summary(self) -> str:
+        """Returns a short human readable description of recent observations, e.g. for logs."""
+        p50, p95, p99 = self.quantiles(0.5, 0.95, 0.99)
+        if p50 is None:
+            return 'no data'
+        return f'p50={p50:.3g} p95={p95:.3g} p99={p99:.3g} (n={self.count})'
+
+    def render(self, name: str) -> list[str]:
+        lines = [f'{name}_count {self.count}', f'{name}_sum {self.sum:.6g}']
+        for q, value in zip((0.5, 0.95, 0.99), self.quantiles(0.5, 0.95, 0.99)):
+            if value is not None:
+                lines.append(f'{name}_p{int(q * 100)} {value:.6g}')
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of named metrics. Metrics are created on first use and identified by their name and labels."""
+
+    def __init__(self):
+        self._metrics: dict[tuple[str, str], Counter | Gauge | Histogram] = {}
+
+    def _get(self, cls, name: str, labels: dict[str, str]):
+        key = (name, _label_string(labels))
+        if (metric := self._metrics.get(key)) is None:
+            metric = self._metrics[key] = cls()
+        elif not isinstance(metric, cls):
+            raise TypeError(f'Metric {name} is a {type(metric).__name__}, not a {cls.__name__}.')
+        return metric
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels: str) -> Gauge:
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        return self._get(Histogram, name, labels)
+
+    def render(self, prefix: str = '') -> str:
+        """Returns all metrics whose names start with prefix, one value per line."""
+        lines = []
+        for name, labels in sorted(self._metrics):
+            if name.startswith(prefix):
+                metric = self._metrics[(name, labels)]
+                lines.extend(line.replace(' ', f'{labels} ', 1) for line in metric.render(name))
+        return '\n'.join(lines)
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,150 @@
+import logging
+from typing import Awaitable, Callable, NamedTuple
+
+from tortoise import connections
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+_log = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[BaseDBAsyncClient], Awaitable]
+
+
+def sql(statement: str) -> Callable[[BaseDBAsyncClient], Awaitable]:
+    return lambda connection: connection.execute_script(statement)
+
+
+# Applied in order, each one exactly once per database. Never change a migration that was released, add a new one.
+# The baseline is the schema the models had when migrations were introduced, as Tortoise generated it back then
+# (existing databases have it already, hence IF NOT EXISTS). Changes to the models since go through migrations of their
+# own.
+MIGRATIONS = [
+    Migration(1, 'Baseline schema', sql("""
+        CREATE TABLE IF NOT EXISTS "user" (
+            "id" BIGINT NOT NULL PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS "imdbmapping" (
+            "imdb_id" VARCHAR(16) NOT NULL PRIMARY KEY,
+            "tmdb_id" INT NOT NULL,
+            "media_type" VARCHAR(8) NOT NULL,
+            "label" VARCHAR(256) NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS "reminder" (
+            "id" SERIAL NOT NULL PRIMARY KEY,
+            "guild_id" BIGINT,
+            "channel_id" BIGINT,
+            "reminder_type" SMALLINT NOT NULL,
+            "target_time" TIMESTAMPTZ NOT NULL,
+            "description" VARCHAR(2048) NOT NULL,
+            "lease_owner" VARCHAR(64),
+            "lease_expires_at" TIMESTAMPTZ,
+            "user_id" BIGINT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE
+        );
+        COMMENT ON COLUMN "reminder"."reminder_type" IS 'single: 1\\ndaily: 2';
+    """)),
+    Migration(2, 'Reminder leases', sql("""
+        ALTER TABLE reminder
+            ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ
+    """)),
+    Migration(3, 'Reminder indexes', sql("""
+        CREATE INDEX IF NOT EXISTS reminder_target_time_idx ON reminder (target_time);
+        CREATE INDEX IF NOT EXISTS reminder_user_id_target_time_idx ON reminder (user_id, target_time);
+    """)),
+    Migration(4, 'Reminder change notifications', sql("""
+        CREATE OR REPLACE FUNCTION notify_reminder_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('reminder_changes', json_build_object('id', OLD.id)::text);
+                RETURN OLD;
+            END IF;
+            PERFORM pg_notify(
+                'reminder_changes',
+                json_build_object('id', NEW.id, 'target_time', extract(epoch FROM NEW.target_time))::text
+            );
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS reminder_notify ON reminder;
+        CREATE TRIGGER reminder_notify
+            AFTER INSERT OR DELETE OR UPDATE OF target_time ON reminder
+            FOR EACH ROW EXECUTE FUNCTION notify_reminder_change();
+    """)),
+    Migration(5, 'DM reachability', sql("""
+        ALTER TABLE "user"
+            ADD COLUMN IF NOT EXISTS dm_open BOOLEAN,
+            ADD COLUMN IF NOT EXISTS dm_checked_at TIMESTAMPTZ
+    """)),
+    Migration(6, 'Reminder keyset pagination index', sql("""
+        CREATE INDEX IF NOT EXISTS reminder_user_id_target_time_id_idx ON reminder (user_id, target_time, id);
+        DROP INDEX IF EXISTS reminder_user_id_target_time_idx;
+    """)),
+    Migration(7, 'Reminder archive', sql("""
+        CREATE TABLE IF NOT EXISTS reminder_archive (
+            reminder_id INT NOT NULL,
+            user_id BIGINT NOT NULL,
+            guild_id BIGINT,
+            channel_id BIGINT,
+            reminder_type SMALLINT NOT NULL,
+            target_time TIMESTAMPTZ NOT NULL,
+            description VARCHAR(2048) NOT NULL,
+            fired_at TIMESTAMPTZ NOT NULL,
+            delivered BOOLEAN NOT NULL
+        ) PARTITION BY RANGE (fired_at);
+        CREATE INDEX IF NOT EXISTS reminder_archive_user_id_fired_at_idx ON reminder_archive (user_id, fired_at);
+    """)),
+    Migration(8, 'Reminder archive default partition', sql("""
+        CREATE TABLE IF NOT EXISTS reminder_archive_default PARTITION OF reminder_archive DEFAULT;
+    """)),
+]
+
+_CREATE_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+# Arbitrary key of the advisory lock that keeps several instances of the bot from migrating at the same time
+_LOCK_KEY = 0x5048594E58
+
+
+async def schema_version(connection: BaseDBAsyncClient) -> int:
+    """Returns the version of the last migration applied to the database, 0 if there's none."""
+    rows = await connection.execute_query_dict("SELECT to_regclass('schema_version') IS NOT NULL AS present")
+    if not rows[0]['present']:
+        return 0
+    rows = await connection.execute_query_dict('SELECT coalesce(max(version), 0) AS version FROM schema_version')
+    return rows[0]['version']
+
+
+async def migrate(migrations: list[Migration] = MIGRATIONS) -> list[int]:
+    """Applies pending migrations to the default (Postgres) database, all or none of them. Returns their versions.
+
+    Databases that are up to date are only queried for their version, without running any DDL.
+    """
+    latest = max(migration.version for migration in migrations)
+    if await schema_version(connections.get('default')) >= latest:
+        return []
+    async with in_transaction() as connection:
+        await connection.execute_query('SELECT pg_advisory_xact_lock($1)', [_LOCK_KEY])
+        await connection.execute_script(_CREATE_VERSION_TABLE)
+        # Another instance may have migrated while this one waited for the lock
+        current = await schema_version(connection)
+        applied = []
+        for migration in sorted(migrations, key=lambda m: m.version):
+            if migration.version <= current:
+                continue
+            _log.info(f'Applying migration {migration.version}: {migration.description}.')
+            await migration.apply(connection)
+            await connection.execute_query(
+                'INSERT INTO schema_version (version, description) VALUES ($1, $2)',
+                [migration.version, migration.description])
+            applied.append(migration.version)
+    return applied
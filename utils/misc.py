@@ -1,9 +1,14 @@
+import asyncio
 import datetime as dt
 import zoneinfo
 from functools import lru_cache
+from typing import Any, Callable
 
 import aiohttp
 import discord
+import ijson
+
+from utils.constants import MESSAGE_MAX_LENGTH
 
 
 def trim_by_paragraph(text: str, fallback_length: int = 900) -> str:
@@ -20,6 +25,30 @@ def trim_by_paragraph(text: str, fallback_length: int = 900) -> str:
     return trimmed
 
 
+def pack_messages(parts: list[str], separator: str = '\n\n', max_length: int = MESSAGE_MAX_LENGTH) -> list[str]:
+    """Joins parts into as few messages as possible without going over the length limit.
+    Parts too long to fit into a message on their own are split up."""
+    messages = []
+    current = ''
+    for part in parts:
+        while len(part) > max_length:
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(part[:max_length])
+            part = part[max_length:]
+        if not current:
+            current = part
+        elif len(current) + len(separator) + len(part) <= max_length:
+            current += separator + part
+        else:
+            messages.append(current)
+            current = part
+    if current:
+        messages.append(current)
+    return messages
+
+
 def calculate_age(born: dt.date, died: dt.date = None) -> int:
     """Calculates someone's current age in years. Calculates age at death if second date is provided."""
     last_alive = died if died else dt.date.today()
@@ -43,6 +72,66 @@ async def get_as_json(url: str):
             return await r.json()
 
 
+async def get_as_bytes(url: str) -> bytes:
+    """Returns the raw body of a response from url."""
+    async with aiohttp.ClientSession() as cs:
+        async with cs.get(url) as r:
+            return await r.read()
+
+
+async def stream_json(url: str, item_handlers: dict[str, Callable[[Any], None]]) -> Any:
+    """Returns a parsed json response from url, reading it incrementally. See `parse_json_stream`."""
+    async with aiohttp.ClientSession() as cs:
+        async with cs.get(url) as r:
+            return await parse_json_stream(_YieldingReader(r.content), item_handlers)
+
+
+class _YieldingReader:
+    """Stream wrapper that yields to the event loop after every read.
+
+    Reads from an already buffered stream complete without suspending, so without this a large body would be parsed in
+    one go, blocking the event loop for the whole time.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def read(self, n: int = -1) -> bytes:
+        data = await self.stream.read(n)
+        await asyncio.sleep(0)
+        return data
+
+
+async def parse_json_stream(stream, item_handlers: dict[str, Callable[[Any], None]]) -> Any:
+    """Parses a json document from an async stream (any object with an async `read` method).
+
+    Items of arrays located under prefixes from `item_handlers` (dot-separated keys, e.g. ``'credits.cast'``) are passed
+    to the matching handler as soon as each of them is complete and are left out of the returned document, which
+    keeps those arrays empty. This way the largest parts of a payload never have to be held in memory all at once.
+    """
+    item_prefixes = {prefix + '.item': handler for prefix, handler in item_handlers.items()}
+    document = ijson.ObjectBuilder()
+    item = None
+    handler = None
+    depth = 0
+    # Small reads keep each uninterrupted stretch of parsing short when the stream yields between them
+    async for prefix, event, value in ijson.parse_async(stream, buf_size=16 * 1024, use_float=True):
+        if item is None and (handler := item_prefixes.get(prefix)):
+            item = ijson.ObjectBuilder()
+        if item is None:
+            document.event(event, value)
+            continue
+        item.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        if depth == 0:
+            handler(item.value)
+            item = None
+    return document.value
+
+
 @lru_cache(maxsize=None)
 def get_timezones():
     return zoneinfo.available_timezones()
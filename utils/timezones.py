@@ -0,0 +1,180 @@
+import bisect
+import collections
+import datetime as dt
+import heapq
+import re
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from utils.misc import get_timezones
+
+# Zones under these areas are the canonical ones, the rest (US/Eastern, EST5EDT, Etc/GMT+5...) are kept for
+# compatibility and ranked after them
+_AREAS = {'africa', 'america', 'antarctica', 'arctic', 'asia', 'atlantic', 'australia', 'europe', 'indian', 'pacific'}
+_OFFSET = re.compile(r'^(?:utc|gmt)?\s*([+-])\s*(\d{1,2})(?::?(\d{2}))?$')
+
+# Kinds of search keys, from the most to the least relevant
+_NAME, _ABBREVIATION, _TOKEN = range(3)
+# Match tiers, each one ranked entirely before the next
+_EXACT, _PREFIX, _SUBSTRING, _FUZZY = range(4)
+# Results of recent searches, autocomplete sends the same short queries over and over
+_MAX_CACHED = 1024
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> ZoneInfo:
+    """Returns the timezone, creating it only once. Raises `ZoneInfoNotFoundError` if it doesn't exist."""
+    return ZoneInfo(name)
+
+
+def _normalize(text: str) -> str:
+    return ' '.join(text.lower().replace('_', ' ').split())
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _format_offset(offset: dt.timedelta) -> str:
+    minutes = int(offset.total_seconds()) // 60
+    sign = '-' if minutes < 0 else '+'
+    hours, minutes = divmod(abs(minutes), 60)
+    return f'UTC{sign}{hours:02}:{minutes:02}'
+
+
+class TimezoneIndex:
+    """Searches timezones by name, city, region, abbreviation (e.g. CEST, PST) or UTC offset (e.g. UTC+2, -03:30).
+
+    Search keys are computed once, lowercased and sorted, so that prefixes are found by bisection. Results are ranked
+    by how well they match: exact matches first, then prefixes, substrings and finally fuzzy matches (by trigram
+    similarity, which tolerates typos). Within a tier canonical zones come first, then shorter names.
+
+    Offsets and abbreviations depend on the date because of daylight saving time. Abbreviations cover both the standard
+    and the daylight saving time of a zone, offsets and labels are only correct for the current day and get recomputed
+    when it changes.
+    """
+
+    def __init__(self, zones: set[str] | None = None):
+        self.zones = sorted(zones if zones is not None else get_timezones())
+        # Tie-breakers within a tier: canonical zones first, then shorter names
+        self._order = {name: (0 if name == 'UTC' or name.split('/')[0].lower() in _AREAS else 1, len(name), name)
+                       for name in self.zones}
+        # Sorted (key, kind, zone) tuples, prefixes of a query are all next to each other
+        self._keys: list[tuple[str, int, str]] = []
+        self._exact: dict[str, list[tuple[int, str]]] = collections.defaultdict(list)
+        self._trigrams: dict[str, set[str]] = collections.defaultdict(set)
+        self._zone_trigrams: dict[str, set[str]] = {}
+        self._normalized = {name: _normalize(name) for name in self.zones}
+        year = dt.date.today().year
+        for name in self.zones:
+            for key, kind in self._zone_keys(name, year):
+                self._keys.append((key, kind, name))
+                self._exact[key].append((kind, name))
+            city = self._normalized[name].split('/')[-1]
+            self._zone_trigrams[name] = _trigrams(city)
+            for trigram in self._zone_trigrams[name]:
+                self._trigrams[trigram].add(name)
+        self._keys.sort()
+        self._default = sorted(self.zones, key=self._order.get)
+        self._day: dt.date | None = None
+        self._offsets: dict[dt.timedelta, list[str]] = {}
+        self._labels: dict[str, str] = {}
+        self._cache: dict[tuple[str, int], list[str]] = {}
+
+    def _zone_keys(self, name: str, year: int) -> set[tuple[str, int]]:
+        normalized = self._normalized[name]
+        parts = normalized.split('/')
+        keys = {(normalized, _NAME), (parts[-1], _NAME)}
+        for part in parts[:-1]:
+            keys.add((part, _TOKEN))
+        for word in parts[-1].split(' ')[1:]:
+            keys.add((word, _TOKEN))
+        # Abbreviations in winter and summer cover both standard and daylight saving time
+        zone = get_zone(name)
+        for month in (1, 7):
+            abbreviation = dt.datetime(year, month, 1, tzinfo=zone).tzname()
+            if abbreviation and abbreviation[0] not in '+-' and abbreviation.lower() != normalized:
+                keys.add((abbreviation.lower(), _ABBREVIATION))
+        return keys
+
+    def _refresh(self) -> None:
+        """Recomputes current offsets and labels, once a day."""
+        today = dt.date.today()
+        if self._day == today:
+            return
+        now = dt.datetime.now(dt.timezone.utc)
+        offsets = collections.defaultdict(list)
+        labels = {}
+        for name in self.zones:
+            local = now.astimezone(get_zone(name))
+            offset = local.utcoffset()
+            offsets[offset].append(name)
+            abbreviation = local.tzname()
+            label = f'{name} ({_format_offset(offset)}'
+            if abbreviation and abbreviation[0] not in '+-' and abbreviation != name:
+                label += f', {abbreviation}'
+            labels[name] = label + ')'
+        self._offsets, self._labels, self._day = offsets, labels, today
+        # Offsets may have changed, and results with them
+        self._cache.clear()
+
+    def label(self, name: str) -> str:
+        """Returns the name of the zone with its current UTC offset and abbreviation, e.g. Europe/Warsaw (UTC+02:00,
+        CEST)."""
+        self._refresh()
+        return self._labels.get(name, name)
+
+    def search(self, query: str, limit: int = 25) -> list[str]:
+        """Returns names of the zones matching the query best, best first."""
+        self._refresh()
+        query = _normalize(query)
+        if not query:
+            return self._default[:limit]
+        if (cached := self._cache.get((query, limit))) is not None:
+            return list(cached)
+        results = self._search(query, limit)
+        if len(self._cache) >= _MAX_CACHED:
+            self._cache.clear()
+        self._cache[query, limit] = results
+        return list(results)
+
+    def _search(self, query: str, limit: int) -> list[str]:
+        # Zone -> (tier, kind of key, -similarity), the best match of each zone wins
+        ranks: dict[str, tuple] = {}
+        for kind, name in self._exact.get(query, ()):
+            ranks[name] = min(ranks.get(name, (_EXACT, kind, 0)), (_EXACT, kind, 0))
+        if match := _OFFSET.match(query):
+            sign, hours, minutes = match.groups()
+            offset = dt.timedelta(hours=int(hours), minutes=int(minutes or 0)) * (-1 if sign == '-' else 1)
+            for name in self._offsets.get(offset, ()):
+                ranks.setdefault(name, (_EXACT, _NAME, 0))
+        keys = self._keys
+        index = bisect.bisect_left(keys, (query,))
+        while index < len(keys) and keys[index][0].startswith(query):
+            _, kind, name = keys[index]
+            rank = (_PREFIX, kind, 0)
+            if rank < ranks.get(name, (_FUZZY + 1,)):
+                ranks[name] = rank
+            index += 1
+        if len(ranks) < limit:
+            for name, normalized in self._normalized.items():
+                if name not in ranks and query in normalized:
+                    ranks[name] = (_SUBSTRING, _NAME, 0)
+        if len(ranks) < limit and len(query) >= 3:
+            query_trigrams = _trigrams(query.split('/')[-1])
+            shared = collections.Counter()
+            for trigram in query_trigrams:
+                shared.update(self._trigrams.get(trigram, ()))
+            for name, count in shared.items():
+                similarity = count / len(query_trigrams | self._zone_trigrams[name])
+                if similarity >= 0.3 and name not in ranks:
+                    ranks[name] = (_FUZZY, _NAME, -similarity)
+        order = self._order
+        return heapq.nsmallest(limit, ranks, key=lambda name: (ranks[name], order[name]))
+
+
+@lru_cache(maxsize=None)
+def get_timezone_index() -> TimezoneIndex:
+    """Returns the index of all available timezones, built on first use."""
+    return TimezoneIndex()